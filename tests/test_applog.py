@@ -0,0 +1,157 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from tlsrpt_reporter import tlsrpt
+from tlsrpt_reporter.applog import TLSRPTCollectdAppLog, TLSRPTFetcherAppLog, make_failed_segment_name, \
+    make_segment_name, read_segment, segment_header
+from tlsrpt_reporter.utility import make_yesterday_dbname, tlsrpt_utc_date_yesterday
+from tests.test_collectd import make_collectd_config, make_datagram
+from tests.test_collectd_schema import make_fetcher_config
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "collectd.applog")
+        self.url = "applog://" + self.path
+
+    def make_collectd(self, **kwargs):
+        collectd = TLSRPTCollectdAppLog(self.url, make_collectd_config(**kwargs))
+        self.addCleanup(collectd.close)
+        return collectd
+
+    def fetch(self, day, domain=None):
+        """
+        Run the fetcher on the compacted database and capture its output
+        """
+        fetcher = TLSRPTFetcherAppLog(self.url, make_fetcher_config())
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            if domain is None:
+                fetcher.fetch_domain_list(day)
+            else:
+                fetcher.fetch_domain_details(day, domain)
+        fetcher.con.close()
+        return output.getvalue().splitlines()
+
+    def counters(self, day, domain):
+        details = json.loads("\n".join(self.fetch(day, domain)))
+        (policies,) = details["policies"].values()
+        (counters,) = policies.values()
+        return counters["cntrtotal"], counters["cntrfailure"]
+
+    def test_fresh_install(self):
+        """
+        Test that an empty database of yesterday is created on the first start
+        """
+        self.make_collectd()
+        self.assertFalse(os.path.exists(make_segment_name(self.path)))
+        lines = self.fetch(str(tlsrpt_utc_date_yesterday()))
+        self.assertEqual(lines[2], str(tlsrpt_utc_date_yesterday()))
+        self.assertListEqual(lines[3:], ["."])
+
+    def test_compaction(self):
+        """
+        Test that the counters of a day are compacted into a database the fetcher reads
+        """
+        collectd = self.make_collectd()
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com"), make_datagram("example.com", True),
+                                make_datagram("example.org")])
+        delta = collectd.datagram_delta(make_datagram("example.com", True))
+        collectd.add_deltas([(delta, 3)])
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.compaction_thread.join()
+        self.assertFalse(os.path.exists(make_segment_name(self.path)))
+        self.assertListEqual(self.fetch(day)[2:], [day, "example.com", "example.org", "."])
+        self.assertTupleEqual(self.counters(day, "example.com"), (5, 4))
+        self.assertTupleEqual(self.counters(day, "example.org"), (1, 0))
+
+    def test_crash_recovery(self):
+        """
+        Test that a restart continues the segment of today and discards an incomplete last record
+        """
+        collectd = self.make_collectd()
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com")])
+        collectd.socket_timeout()
+        collectd.segment.write(b"C\x00\x00")  # record interrupted by a crash
+        collectd.segment.flush()
+        collectd.segment.close()
+        collectd.segment = None
+        collectd = self.make_collectd()
+        collectd.add_datagrams([make_datagram("example.com", True)])
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.compaction_thread.join()
+        self.assertTupleEqual(self.counters(day, "example.com"), (2, 1))
+
+    def test_failed_compaction(self):
+        """
+        Test that a segment whose compaction failed is compacted again and kept instead of being overwritten by the
+        segment of the next day
+        """
+        collectd = self.make_collectd()
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com")])
+        os.mkdir(make_yesterday_dbname(self.path) + ".tmp")  # makes the compaction fail
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.compaction_thread.join()
+        self.assertTrue(os.path.exists(make_segment_name(self.path)))
+        self.assertIsNotNone(collectd.next_compaction_retry)
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.compaction_thread.join()
+        kept = make_failed_segment_name(self.path, day)
+        self.assertEqual(read_segment(kept)[0], day)
+        os.rmdir(make_yesterday_dbname(self.path) + ".tmp")
+        collectd.next_compaction_retry = 0  # retry due
+        collectd.socket_timeout()
+        collectd.compaction_thread.join()
+        self.assertFalse(os.path.exists(make_segment_name(self.path)))
+        self.assertIsNone(collectd.next_compaction_retry)
+        collectd.close()
+        os.rename(kept, make_segment_name(self.path))
+        self.make_collectd()
+        self.assertTupleEqual(self.counters(day, "example.com"), (1, 0))
+
+    def test_stale_segment(self):
+        """
+        Test that a segment of a previous day found on startup is compacted under its own day
+        """
+        day = str(tlsrpt_utc_date_yesterday())
+        collectd = self.make_collectd()
+        collectd.close()
+        os.remove(self.path)
+        with open(self.path, "wb") as f:
+            f.write(segment_header(day))
+        collectd = self.make_collectd()
+        collectd.close()
+        self.assertTrue(os.path.exists(make_yesterday_dbname(self.path)))
+        self.assertEqual(read_segment(self.path)[0], str(collectd.today))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,893 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import json
+import os
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from tlsrpt_reporter import plugins
+from tlsrpt_reporter import tlsrpt
+from tlsrpt_reporter.statsfile import read_stats_file
+
+
+def make_collectd_config(**kwargs):
+    """
+    Create a collectd configuration from the option defaults
+    :param kwargs: options overriding the defaults
+    :return: the ConfigCollectd
+    """
+    configvars = {k: v["default"] for k, v in tlsrpt.options_collectd.items()}
+    configvars.update(kwargs)
+    return tlsrpt.ConfigCollectd(**configvars)
+
+
+def make_datagram(domain, failed=False, policy_string="mx.example.com"):
+    """
+    Create a datagram as sent by the tlsrpt library
+    :param domain: the domain of the datagram
+    :param failed: create a failed session with one failure detail
+    :param policy_string: the policy string to use in the policy
+    :return: the datagram as dict
+    """
+    policy = {"policy-type": 2, "policy-string": [policy_string], "policy-domain": domain, "f": int(failed), "t": 0}
+    if failed:
+        policy["t"] = 1
+        policy["failure-details"] = [{"c": 202, "n": "mx." + domain}]
+    return {"dpv": "1", "d": domain, "pr": "v=TLSRPTv1;rua=mailto:tlsrpt@" + domain, "policies": [policy]}
+
+
+class RecordingCollectd(tlsrpt.TLSRPTCollectd):
+    """
+    Storage backend recording the datagrams and the threads it was called from
+    """
+    def __init__(self):
+        self.datagrams = []
+        self.timeouts = 0
+        self.threads = set()
+
+    def add_datagram(self, datagram):
+        self.threads.add(threading.current_thread().name)
+        self.datagrams.append(datagram)
+
+    def socket_timeout(self):
+        self.threads.add(threading.current_thread().name)
+        self.timeouts += 1
+
+    def switch_to_next_day(self, rolloverreason):
+        pass
+
+
+class StalledCollectd(RecordingCollectd):
+    """
+    Storage backend blocking until it is released
+    """
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def add_datagram(self, datagram):
+        self.entered.set()
+        self.release.wait()
+        super().add_datagram(datagram)
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)  # runs after the cleanups closing the collectds
+        self.dbname = os.path.join(self.tmpdir.name, "collectd.sqlite")
+
+    def make_collectd(self, **kwargs):
+        collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + self.dbname, make_collectd_config(**kwargs))
+        self.addCleanup(collectd.close)
+        return collectd
+
+    def query(self, sql):
+        con = sqlite3.connect(self.dbname)
+        try:
+            return con.execute(sql).fetchall()
+        finally:
+            con.close()
+
+    def counters(self, collectd):
+        return {domain: (total, failure) for (domain, total, failure) in self.query(
+            "SELECT domain, SUM(cntrtotal), SUM(cntrfailure) FROM finalresults JOIN domains USING(domain_id) "
+            "GROUP BY domain")}
+
+    def test_add_datagrams(self):
+        """
+        Test that a batch of datagrams is aggregated like single datagrams
+        """
+        collectd = self.make_collectd()
+        collectd.add_datagrams([make_datagram("example.com"), make_datagram("example.com", True),
+                                make_datagram("example.org")])
+        collectd.add_datagram(make_datagram("Example.ORG."))
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {"example.com": (2, 1), "example.org": (2, 0)})
+
+    def test_batch_commit(self):
+        """
+        Test that a batch exceeding max_uncommited_datagrams triggers a commit
+        """
+        collectd = self.make_collectd(max_uncommited_datagrams=3, sockettimeout=3600)
+        collectd.add_datagram(make_datagram("example.com"))  # first datagram is committed as overdue
+        self.assertEqual(collectd.uncommitted_datagrams, 0)
+        collectd.add_datagrams([make_datagram("example.com") for i in range(2)])
+        self.assertEqual(collectd.uncommitted_datagrams, 2)
+        collectd.add_datagrams([make_datagram("example.com") for i in range(2)])
+        self.assertEqual(collectd.uncommitted_datagrams, 0)
+
+    def test_failed_commit_retried(self):
+        """
+        Test that the counters of a failed commit are written once by the next commit
+        """
+        collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + self.dbname + "?busy_timeout=10",
+                                               make_collectd_config(sockettimeout=3600))
+        self.addCleanup(collectd.close)
+        reader = sqlite3.connect(self.dbname, isolation_level=None)
+        reader.execute("BEGIN")
+        reader.execute("SELECT * FROM finalresults").fetchall()  # the shared lock blocks the commit of collectd
+        with self.assertLogs(tlsrpt.logger, "ERROR"):
+            collectd.add_datagrams([make_datagram("example.com"), make_datagram("example.com", True)])
+            collectd.timed_commit()
+        self.assertEqual(collectd.failed_commits, 2)  # the overdue commit of the batch and the timed commit
+        self.assertFalse(collectd.con.in_transaction)
+        reader.execute("COMMIT")
+        reader.close()
+        collectd.timed_commit()
+        self.assertDictEqual(self.counters(collectd), {"example.com": (2, 1)})
+        self.assertDictEqual(self.failure_counters(collectd), {("example.com", "mx.example.com"): 1})
+
+    def test_rollover_deadline(self):
+        """
+        Test that the day roll-over happens at the monotonic deadline only if the UTC day changed
+        """
+        collectd = self.make_collectd()
+        self.assertGreater(collectd.next_rollover, time.monotonic())
+        self.assertLessEqual(collectd.next_rollover, time.monotonic() + 24 * 3600)
+        collectd.add_datagram(make_datagram("example.com"))
+        # deadline passed, but the system clock was set back and the day did not change yet
+        today = collectd.today
+        collectd.next_rollover = 0.0
+        collectd.add_datagram(make_datagram("example.com"))
+        self.assertEqual(collectd.today, today)
+        self.assertGreater(collectd.next_rollover, time.monotonic())
+        # deadline passed at midnight
+        collectd.today = today - datetime.timedelta(days=1)
+        collectd.next_rollover = 0.0
+        collectd.add_datagram(make_datagram("example.org"))
+        self.assertEqual(collectd.today, today)
+        self.assertGreater(collectd.next_rollover, time.monotonic())
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {"example.org": (1, 0)})
+
+    def test_pipeline_rollover_wakeup(self):
+        """
+        Test that the writer thread wakes up at the roll-over deadline instead of waiting for the socket timeout
+        """
+        class RollingCollectd(RecordingCollectd):
+            def seconds_until_rollover(self):
+                return 0.05
+
+        collectd = RollingCollectd()
+        pipeline = tlsrpt.CollectdPipeline(None, [collectd], make_collectd_config(sockettimeout=60))
+        pipeline.threads[2].daemon = True
+        pipeline.threads[2].start()
+        try:
+            for i in range(100):
+                if collectd.timeouts != 0:
+                    break
+                time.sleep(0.01)
+            self.assertNotEqual(collectd.timeouts, 0)
+        finally:
+            pipeline.write_queues[0].put((time.monotonic(), tlsrpt.CollectdPipeline.STOP))
+            pipeline.threads[2].join()
+
+    def test_counted_datagram(self):
+        """
+        Test that pre-aggregated datagrams of protocol version 2 add their session counts
+        """
+        collectd = self.make_collectd()
+        counted = make_datagram("example.com", True)
+        counted["dpv"] = "2"
+        counted["policies"][0].update({"cnt": 100, "f": 7, "t": 7})
+        counted["policies"][0]["failure-details"] = [{"c": 202, "n": "mx.example.com", "cnt": 5},
+                                                     {"c": 202, "n": "mx.example.com", "cnt": 2}]
+        collectd.add_datagrams([counted, make_datagram("example.com", True)])
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {"example.com": (101, 8)})
+        self.assertDictEqual(self.failure_counters(collectd), {("example.com", "mx.example.com"): 8})
+        # the same payload in protocol version 1 does not treat the cnt fields as counts
+        counted["dpv"] = "1"
+        with self.assertLogs(tlsrpt.logger, "ERROR"):
+            collectd.add_datagram(counted)
+
+    def test_counted_datagram_invalid(self):
+        """
+        Test that a datagram with invalid counts is rejected as a whole
+        """
+        collectd = self.make_collectd()
+        counted = make_datagram("example.com")
+        counted["dpv"] = "2"
+        counted["policies"].append(dict(counted["policies"][0], cnt=3, f=4))
+        with self.assertLogs(tlsrpt.logger, "ERROR"):
+            collectd.add_datagrams([counted])
+        # booleans are no counts, although Python treats them as integers
+        for (policy, detail) in (({"cnt": True}, {}), ({"cnt": 2, "f": True}, {}), ({"cnt": 2, "f": 1}, {"cnt": True})):
+            with self.subTest(policy=policy, detail=detail):
+                counted = make_datagram("example.com", True)
+                counted["dpv"] = "2"
+                counted["policies"][0].update(policy)
+                counted["policies"][0]["failure-details"][0].update(detail)
+                with self.assertLogs(tlsrpt.logger, "ERROR") as cm:
+                    collectd.add_datagrams([counted])
+                self.assertIn("ValueError", cm.output[-1])
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {})
+
+    def test_invalid_datagram_in_batch(self):
+        """
+        Test that an invalid datagram does not prevent processing the other datagrams of the batch
+        """
+        collectd = self.make_collectd()
+        collectd.add_datagrams([make_datagram("example.com"), {"policies": [{}]}, make_datagram("example.org")])
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {"example.com": (1, 0), "example.org": (1, 0)})
+
+    def failure_counters(self, collectd):
+        return {(domain, json.loads(reason)["n"]): cntr for (domain, reason, cntr) in self.query(
+            "SELECT domain, reason, cntr FROM failures JOIN domains USING(domain_id) JOIN reasons USING(reason_id)")}
+
+    def test_write_behind_cache(self):
+        """
+        Test that counter deltas are accumulated in memory and added to existing rows on commit
+        """
+        collectd = self.make_collectd(sockettimeout=3600)
+        collectd.socket_timeout()
+        collectd.add_datagrams([make_datagram("example.com", i % 2 == 0) for i in range(10)])
+        self.assertEqual(len(collectd.pending_finalresults), 1)
+        self.assertEqual(len(collectd.pending_failures), 1)
+        self.assertDictEqual(self.counters(collectd), {})
+        collectd.socket_timeout()
+        self.assertEqual(len(collectd.pending_finalresults), 0)
+        self.assertEqual(len(collectd.pending_failures), 0)
+        self.assertDictEqual(self.counters(collectd), {"example.com": (10, 5)})
+        collectd.add_datagrams([make_datagram("example.com", True) for i in range(3)])
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {"example.com": (13, 8)})
+        self.assertDictEqual(self.failure_counters(collectd), {("example.com", "mx.example.com"): 8})
+
+    def test_policy_cache(self):
+        """
+        Test that repeated policies are served from the policy cache with the same result
+        """
+        collectd = self.make_collectd(policy_cache_size=2)
+        collectd.add_datagrams([make_datagram("example.com", i % 2 == 0) for i in range(10)])
+        collectd.add_datagrams([make_datagram("example.com", True), make_datagram("example.org")])
+        collectd.socket_timeout()
+        self.assertEqual(collectd.policy_cache.misses, 3)
+        self.assertEqual(collectd.policy_cache.hits, 9)
+        self.assertEqual(len(collectd.policy_cache), 2)
+        self.assertDictEqual(self.counters(collectd), {"example.com": (11, 6), "example.org": (1, 0)})
+        self.assertDictEqual(self.failure_counters(collectd), {("example.com", "mx.example.com"): 6})
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_receive_datagram_batch(self):
+        """
+        Test that the socket is drained up to the batch limit
+        """
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        try:
+            for i in range(5):
+                sender.send(json.dumps(make_datagram("example%d.com" % i)).encode())
+            buffer = bytearray(4096)
+            batch = tlsrpt.receive_datagram_batch(receiver, 3, buffer)
+            self.assertEqual(len(batch), 3)
+            batch = tlsrpt.receive_datagram_batch(receiver, 3, buffer)
+            self.assertEqual(len(batch), 2)
+            self.assertEqual(json.loads(batch[0])["d"], "example3.com")
+            self.assertEqual(json.loads(batch[1])["d"], "example4.com")
+            self.assertListEqual(tlsrpt.receive_datagram_batch(receiver, 3, buffer), [])
+        finally:
+            sender.close()
+            receiver.close()
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_receive_truncated_datagram(self):
+        """
+        Test that datagrams exceeding the receive buffer are detected and discarded
+        """
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        try:
+            sender.send(b"x" * 100)
+            sender.send(b"y" * 10)
+            with self.assertLogs(tlsrpt.logger, "ERROR"):
+                batch = tlsrpt.receive_datagram_batch(receiver, 3, bytearray(50))
+            self.assertListEqual(batch, [b"y" * 10])
+        finally:
+            sender.close()
+            receiver.close()
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_pipeline(self):
+        """
+        Test that the pipeline delivers all datagrams to the backend on the writer thread only
+        """
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        collectd = RecordingCollectd()
+        pipeline = tlsrpt.CollectdPipeline(receiver, [collectd], make_collectd_config(max_datagrams_per_batch=7))
+        pipeline.start()
+        try:
+            for i in range(50):
+                sender.send(json.dumps(make_datagram("example%d.com" % i)).encode())
+            sender.send(b"invalid")
+        finally:
+            self.assertEqual(pipeline.stop(), 0)
+            sender.close()
+            receiver.close()
+        self.assertListEqual([d["d"] for d in collectd.datagrams], ["example%d.com" % i for i in range(50)])
+        self.assertEqual(collectd.timeouts, 1)  # the final socket timeout during shutdown
+        self.assertSetEqual(collectd.threads, {"collectd-write-0"})
+        self.assertEqual(pipeline.receive_stats.total_datagrams, 51)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_pipeline_datagram_cache(self):
+        """
+        Test that repeated raw datagrams are served from the datagram cache and counted correctly
+        """
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        collectd = self.make_collectd()
+        pipeline = tlsrpt.CollectdPipeline(receiver, [collectd], make_collectd_config(datagram_cache_size=10))
+        pipeline.start()
+        try:
+            ok = json.dumps(make_datagram("example.com")).encode()
+            failed = json.dumps(make_datagram("example.com", True)).encode()
+            for i in range(20):
+                sender.send(ok)
+                sender.send(failed)
+            sender.send(ok.replace(b"example.com", b"example.org"))  # differs by a single byte
+            sender.send(b"invalid")
+        finally:
+            self.assertEqual(pipeline.stop(), 0)
+            sender.close()
+            receiver.close()
+        self.assertEqual(pipeline.datagram_cache.misses, 4)
+        self.assertEqual(pipeline.datagram_cache.hits, 38)
+        self.assertDictEqual(self.counters(collectd), {"example.com": (40, 20), "example.org": (1, 0)})
+        self.assertDictEqual(self.failure_counters(collectd), {("example.com", "mx.example.com"): 20})
+        self.assertEqual(collectd.total_datagrams_read, 41)
+
+    def test_datagram_cache_flawed_datagrams(self):
+        """
+        Test that repeated datagrams failing the checks are still logged, rate-limited, when served from the cache
+        """
+        pipeline = tlsrpt.CollectdPipeline(None, [self.make_collectd()], make_collectd_config(datagram_cache_size=10))
+        datagram = make_datagram("example.com")
+        datagram["dpv"] = 99
+        flawed = json.dumps(datagram).encode()
+        with self.assertLogs(tlsrpt.logger, "ERROR") as cm:
+            batch = pipeline._delta_batch([flawed] * 3)
+        self.assertEqual(batch.datagrams, 3)
+        self.assertEqual(len(cm.output), 2)
+        self.assertIn("Wrong datagram protocol version", cm.output[0])
+        self.assertIn("Counted 1 repeated datagrams failing the checks", cm.output[1])
+        with self.assertLogs(tlsrpt.logger, "DEBUG") as cm:
+            pipeline._delta_batch([flawed, json.dumps(make_datagram("example.org")).encode()])
+            tlsrpt.logger.debug("done")
+        self.assertEqual(len(cm.output), 1)  # neither the hit within the minute nor the datagram passing the checks
+        self.assertEqual(pipeline.flawed_cache_hits, 3)
+
+    def test_datagram_cache_unsupported(self):
+        """
+        Test that the datagram cache is disabled if a storage backend does not support deltas
+        """
+        pipeline = tlsrpt.CollectdPipeline(None, [self.make_collectd(), RecordingCollectd()],
+                                           make_collectd_config(datagram_cache_size=10))
+        self.assertIsNone(pipeline.datagram_cache)
+
+    def test_record_stream(self):
+        """
+        Test splitting received data into length-prefixed records
+        """
+        stream = tlsrpt.RecordStream(10)
+        data = b"\0\0\0\x03abc\0\0\0\0\0\0\0\x05hello"
+        self.assertListEqual(stream.feed(data[:9]), [b"abc"])
+        self.assertEqual(stream.pending(), 2)
+        self.assertListEqual(stream.feed(data[9:]), [b"", b"hello"])
+        self.assertEqual(stream.pending(), 0)
+        with self.assertRaises(ValueError):
+            stream.feed(b"\0\0\0\x0b")
+
+    def run_connected_pipeline(self, socket_type):
+        """
+        Send records over two connections to a pipeline listening on a connection-oriented socket
+        :param socket_type: the socket type, e.g. socket.SOCK_STREAM
+        :return: the RecordingCollectd backend
+        """
+        socketname = os.path.join(self.tmpdir.name, "collectd.socket")
+        listener = socket.socket(socket.AF_UNIX, socket_type)
+        listener.bind(socketname)
+        listener.listen()
+        listener.setblocking(False)
+        collectd = RecordingCollectd()
+        pipeline = tlsrpt.CollectdPipeline(listener, [collectd], make_collectd_config(max_datagrams_per_batch=7))
+        pipeline.start()
+        clients = [socket.socket(socket.AF_UNIX, socket_type) for i in range(2)]
+        try:
+            for client in clients:
+                client.connect(socketname)
+            for i in range(20):
+                record = json.dumps(make_datagram("example%d.com" % i)).encode()
+                clients[i % 2].sendall(tlsrpt.RecordStream.HEADER.pack(len(record)) + record)
+            clients[0].close()
+            clients[1].sendall(b"\0\0")  # incomplete record, discarded at shutdown
+        finally:
+            self.assertEqual(pipeline.stop(), 0)
+            for client in clients:
+                client.close()
+            listener.close()
+        self.assertEqual(pipeline.receive_stats.total_datagrams, 20)
+        return collectd
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_pipeline_stream(self):
+        """
+        Test receiving length-prefixed records over stream connections
+        """
+        collectd = self.run_connected_pipeline(socket.SOCK_STREAM)
+        self.assertListEqual(sorted(d["d"] for d in collectd.datagrams), sorted("example%d.com" % i for i in range(20)))
+
+    @unittest.skipUnless(hasattr(socket, "SOCK_SEQPACKET"), "requires seqpacket sockets")
+    def test_pipeline_seqpacket(self):
+        """
+        Test receiving length-prefixed records over seqpacket connections
+        """
+        collectd = self.run_connected_pipeline(socket.SOCK_SEQPACKET)
+        self.assertEqual(len(collectd.datagrams), 20)
+
+    def test_precreated_next_database(self):
+        """
+        Test that the day roll-over moves the database prepared for the next day into place
+        """
+        collectd = self.make_collectd()
+        collectd.next_db_thread.join()
+        nextdbname = tlsrpt.make_next_dbname(self.dbname)
+        self.assertTrue(collectd.next_db_ready)
+        self.assertTrue(os.path.exists(nextdbname))
+        collectd.add_datagram(make_datagram("example.com"))
+        with self.assertLogs(tlsrpt.logger, "INFO") as cm:
+            collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        self.assertTrue(any("using pre-created database" in line for line in cm.output))
+        self.assertTrue(any("blocked processing of datagrams" in line for line in cm.output))
+        self.assertGreater(collectd.max_rollover_stall, 0.0)
+        # the new database is empty and usable, the data went to yesterday's database
+        collectd.add_datagram(make_datagram("example.org"))
+        collectd.socket_timeout()
+        self.assertDictEqual(self.counters(collectd), {"example.org": (1, 0)})
+        con = sqlite3.connect(tlsrpt.make_yesterday_dbname(self.dbname))
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM finalresults").fetchone()[0], 1)
+        con.close()
+        # the database for the following day is prepared again
+        collectd.next_db_thread.join()
+        self.assertTrue(collectd.next_db_ready)
+
+    def crash(self, collectd):
+        """
+        Simulate a crash of collectd: uncommitted data is lost
+        """
+        collectd.next_db_thread.join()
+        collectd.con.close()
+        collectd.journal.close()
+
+    def test_journal_replay(self):
+        """
+        Test that data not committed before a crash is replayed from the journal
+        """
+        collectd = self.make_collectd(datagram_journal=1, sockettimeout=3600)
+        collectd.add_datagram(make_datagram("example.com"))  # first datagram is committed as overdue
+        journalname = tlsrpt.make_journal_name(self.dbname)
+        self.assertEqual(os.path.getsize(journalname), 0)
+        collectd.add_datagrams([make_datagram("example.com", True), make_datagram("example.org")])
+        collectd.add_deltas([(collectd.datagram_delta(make_datagram("example.org")), 3)])
+        self.assertGreater(os.path.getsize(journalname), 0)
+        self.crash(collectd)
+        self.assertDictEqual(self.counters(collectd), {"example.com": (1, 0)})
+        with self.assertLogs(tlsrpt.logger, "WARNING"):
+            collectd = self.make_collectd(datagram_journal=1)
+        self.assertDictEqual(self.counters(collectd), {"example.com": (2, 1), "example.org": (4, 0)})
+        self.assertDictEqual(self.failure_counters(collectd), {("example.com", "mx.example.com"): 1})
+        self.assertEqual(os.path.getsize(journalname), 0)
+        # a second start does not replay the data again
+        self.crash(collectd)
+        collectd = self.make_collectd(datagram_journal=1)
+        self.assertEqual(collectd.uncommitted_datagrams, 0)
+
+    def test_journal_committed_not_truncated(self):
+        """
+        Test that journal lines already committed and lines partially written during a crash are not replayed
+        """
+        collectd = self.make_collectd(datagram_journal=1, sockettimeout=3600)
+        collectd.add_datagram(make_datagram("example.com"))
+        collectd.journal.append(0, str(collectd.today), [[collectd.datagram_delta(make_datagram("example.net")), 1]])
+        collectd.journal.file.write(b'[1,"2025-01-01",[[')
+        self.crash(collectd)
+        collectd = self.make_collectd(datagram_journal=1)
+        self.assertEqual(collectd.uncommitted_datagrams, 0)
+        self.assertDictEqual(self.counters(collectd), {"example.com": (1, 0)})
+
+    def test_pipeline_drop_policy(self):
+        """
+        Test that the drop policy discards batches when a queue is full and counts the dropped datagrams
+        """
+        pipeline = tlsrpt.CollectdPipeline(None, [RecordingCollectd()],
+                                           make_collectd_config(write_queue_size=1, queue_overflow_policy="drop"))
+        pipeline._put(pipeline.write_queues[0], "write-0", [1, 2])
+        pipeline._put(pipeline.write_queues[0], "write-0", [3, 4, 5])
+        self.assertEqual(pipeline.dropped["write-0"], 3)
+        self.assertEqual(pipeline.max_depth["write-0"], 1)
+
+    def test_storage_overflow_policies(self):
+        """
+        Test the per storage backend overflow policies
+        """
+        self.assertListEqual(tlsrpt.parse_storage_overflow_policies(make_collectd_config(), 2), ["block", "block"])
+        config = make_collectd_config(storage_overflow_policy="block, drop")
+        self.assertListEqual(tlsrpt.parse_storage_overflow_policies(config, 2), ["block", "drop"])
+        with self.assertRaises(ValueError):
+            tlsrpt.parse_storage_overflow_policies(config, 3)
+        with self.assertRaises(ValueError):
+            tlsrpt.parse_storage_overflow_policies(make_collectd_config(storage_overflow_policy="block,wait"), 2)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_pipeline_slow_backend(self):
+        """
+        Test that a stalled storage backend does not hold up the other storage backends
+        """
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        stalled = StalledCollectd()
+        collectd = RecordingCollectd()
+        pipeline = tlsrpt.CollectdPipeline(receiver, [stalled, collectd],
+                                           make_collectd_config(max_datagrams_per_batch=1, write_queue_size=2,
+                                                                storage_overflow_policy="drop,block"))
+        pipeline.start()
+        try:
+            for i in range(20):
+                sender.send(json.dumps(make_datagram("example%d.com" % i)).encode())
+            for i in range(100):
+                if len(collectd.datagrams) == 20:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(len(collectd.datagrams), 20)
+        finally:
+            stalled.release.set()
+            self.assertEqual(pipeline.stop(), 0)
+            sender.close()
+            receiver.close()
+        self.assertEqual(pipeline.dropped["write-1"], 0)
+        self.assertGreater(pipeline.dropped["write-0"], 0)
+        self.assertEqual(len(stalled.datagrams) + pipeline.dropped["write-0"], 20)
+        self.assertGreater(pipeline.max_lag["write-0"], pipeline.max_lag["write-1"])
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_pipeline_stalled_control_items(self):
+        """
+        Test that roll-over and shutdown do not hang on a stalled storage backend with the drop policy
+        """
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        stalled = StalledCollectd()
+        pipeline = tlsrpt.CollectdPipeline(receiver, [stalled],
+                                           make_collectd_config(sockettimeout=0.1, write_queue_size=1,
+                                                                storage_overflow_policy="drop"))
+        pipeline.start()
+        try:
+            sender.send(json.dumps(make_datagram("example.com")).encode())
+            self.assertTrue(stalled.entered.wait(5))
+            sender.send(json.dumps(make_datagram("example.org")).encode())
+            for i in range(100):
+                if pipeline.write_queues[0].full():
+                    break
+                time.sleep(0.01)
+            with self.assertLogs(tlsrpt.logger, "ERROR") as cm:
+                pipeline.request_rollover()
+            self.assertIn("could not queue rollover", cm.output[0])
+            with self.assertLogs(tlsrpt.logger, "ERROR") as cm:
+                self.assertEqual(pipeline.stop(), tlsrpt.EXIT_SHUTDOWN_COLLECTDPLUGIN)
+            self.assertIn("Abandoning the stalled writer thread write-0", cm.output[-1])
+        finally:
+            stalled.release.set()
+            sender.close()
+            receiver.close()
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_pipeline_stats_file(self):
+        """
+        Test that the pipeline publishes its counters and those of the SQLite storage in the stats file
+        """
+        statsname = os.path.join(self.tmpdir.name, "collectd.stats")
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        collectd = self.make_collectd()
+        pipeline = tlsrpt.CollectdPipeline(receiver, [collectd], make_collectd_config(stats_file=statsname))
+        pipeline.start()
+        try:
+            self.assertEqual(read_stats_file(statsname)["datagrams"], 0)
+            payloads = [json.dumps(make_datagram("example%d.com" % i)).encode() for i in range(5)]
+            for payload in payloads:
+                sender.send(payload)
+            sender.send(b"invalid")
+            for i in range(100):
+                pipeline.log_statistics_if_due()
+                stats = read_stats_file(statsname)
+                if stats["storage_0_policies"] == 5:
+                    break
+                time.sleep(0.05)
+        finally:
+            self.assertEqual(pipeline.stop(), 0)
+            sender.close()
+            receiver.close()
+        self.assertEqual(stats["datagrams"], 6)
+        self.assertEqual(stats["bytes"], sum(map(len, payloads)) + len(b"invalid"))
+        self.assertEqual(stats["parse_errors"], 1)
+        self.assertEqual(stats["storage_0_policies"], 5)
+        self.assertIn("queue_depth_write-0", stats)
+        self.assertIn("storage_0_commit_latency_le_1ms", stats)
+        self.assertFalse(os.path.exists(statsname))
+        histogram = [v for (k, v) in collectd.statistics().items() if k.startswith("commit_latency_")]
+        self.assertEqual(sum(histogram), collectd.commits)
+        self.assertEqual(collectd.commits, 1)  # the final commit during shutdown
+
+    def test_datagram_shard(self):
+        """
+        Test that datagrams are routed by their normalized domain
+        """
+        shards = [tlsrpt.datagram_shard(json.dumps(make_datagram("example%d.com" % i)).encode(), 4)
+                  for i in range(40)]
+        self.assertSetEqual(set(shards), {0, 1, 2, 3})
+        shard = tlsrpt.datagram_shard(json.dumps(make_datagram("example.com")).encode(), 4)
+        self.assertEqual(tlsrpt.datagram_shard(json.dumps(make_datagram("Example.COM.")).encode(), 4), shard)
+        self.assertEqual(tlsrpt.datagram_shard(b"invalid", 4), 0)
+
+    def test_make_shard_config(self):
+        """
+        Test that the storage URLs and files of a worker process get the suffix of its shard
+        """
+        config = make_collectd_config(storage="sqlite:///var/lib/tlsrpt/collectd.sqlite?profile=high-throughput,"
+                                              "dummy://?log", stats_file="/run/collectd.stats", shards=4)
+        shard = tlsrpt.make_shard_config(config, 2)
+        self.assertEqual(shard.storage, "sqlite:///var/lib/tlsrpt/collectd.sqlite.shard2?profile=high-throughput,"
+                                        "dummy://?log")
+        self.assertEqual(shard.stats_file, "/run/collectd.stats.shard2")
+        self.assertEqual(shard.dump_path_for_invalid_datagram, "")
+        self.assertEqual(shard.shards, 1)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_sharding_pipeline(self):
+        """
+        Test that the worker processes of a sharded collectd write all datagrams of a domain to the same shard
+        """
+        try:  # the worker processes create their storage backends via the plugin entry points
+            plugins.get_plugin("tlsrpt.collectd", "sqlite://")
+        except plugins.NoImplementationException:
+            self.skipTest("requires the installed package")
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        pipeline = tlsrpt.ShardingPipeline(receiver, make_collectd_config(storage="sqlite://" + self.dbname,
+                                                                          shards=2))
+        pipeline.start()
+        try:
+            for i in range(40):
+                sender.send(json.dumps(make_datagram("example%d.com" % (i % 8), i % 4 == 0)).encode())
+        finally:
+            self.assertEqual(pipeline.stop(), 0)
+            sender.close()
+            receiver.close()
+        self.assertEqual(sum(pipeline.routed), 40)
+        counters = {}
+        for index in range(2):
+            con = sqlite3.connect(tlsrpt.make_shard_name(self.dbname, index))
+            for (domain, total, failure) in con.execute(
+                    "SELECT domain, SUM(cntrtotal), SUM(cntrfailure) FROM finalresults JOIN domains USING(domain_id) "
+                    "GROUP BY domain"):
+                self.assertNotIn(domain, counters)  # each domain is written by one shard only
+                counters[domain] = (total, failure)
+            con.close()
+        self.assertDictEqual(counters, {"example%d.com" % i: (5, 5 if i % 4 == 0 else 0) for i in range(8)})
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_sharding_pipeline_large_records(self):
+        """
+        Test that a sharded collectd with overflow policies per storage backend forwards records exceeding the size of
+        a unix domain datagram to its worker processes
+        """
+        try:  # the worker processes create their storage backends via the plugin entry points
+            plugins.get_plugin("tlsrpt.collectd", "sqlite://")
+        except plugins.NoImplementationException:
+            self.skipTest("requires the installed package")
+        socketname = os.path.join(self.tmpdir.name, "collectd.socket")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socketname)
+        listener.listen()
+        listener.setblocking(False)
+        pipeline = tlsrpt.ShardingPipeline(listener, make_collectd_config(storage="sqlite://" + self.dbname, shards=2,
+                                                                          socket_type="stream",
+                                                                          storage_overflow_policy="block"))
+        pipeline.start()
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sender.connect(socketname)
+            datagram = make_datagram("example.com")
+            datagram["padding"] = "x" * 1000000
+            record = json.dumps(datagram).encode()
+            sender.sendall(tlsrpt.RecordStream.HEADER.pack(len(record)) + record)
+            sender.close()
+            time.sleep(0.5)  # let the receive thread read the whole record before stopping
+        finally:
+            self.assertEqual(pipeline.stop(), 0)
+            listener.close()
+        self.assertEqual(sum(pipeline.routed), 1)
+        counters = []
+        for index in range(2):
+            con = sqlite3.connect(tlsrpt.make_shard_name(self.dbname, index))
+            counters += con.execute("SELECT domain, cntrtotal FROM finalresults JOIN domains USING(domain_id)").fetchall()
+            con.close()
+        self.assertListEqual(counters, [("example.com", 1)])
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_socket_handover(self):
+        """
+        Test that a restarted collectd takes over the socket of the running collectd without losing datagrams
+        """
+        try:  # the daemon creates its storage backends via the plugin entry points
+            plugins.get_plugin("tlsrpt.collectd", "sqlite://")
+        except plugins.NoImplementationException:
+            self.skipTest("requires the installed package")
+        socketname = os.path.join(self.tmpdir.name, "collectd.socket")
+        config = make_collectd_config(storage="sqlite://" + self.dbname, socketname=socketname,
+                                      handover_socket=os.path.join(self.tmpdir.name, "handover.socket"))
+        exitcodes = []
+
+        def start_daemon():
+            daemon = threading.Thread(target=lambda: exitcodes.append(tlsrpt.tlsrpt_collectd_daemon(config)))
+            daemon.start()
+            return daemon
+
+        def send(count):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for i in range(count):
+                client.sendto(json.dumps(make_datagram("example%d.com" % (i % 4))).encode(), socketname)
+            client.close()
+
+        old = start_daemon()
+        while not os.path.exists(config.handover_socket):
+            time.sleep(0.01)
+        sender = threading.Thread(target=send, args=(10000,))
+        sender.start()
+        time.sleep(0.05)
+        new = start_daemon()  # takes over while the sender keeps sending
+        old.join()
+        sender.join()
+        time.sleep(0.1)
+        tlsrpt.interrupt_write.send(bytes([signal.SIGTERM]))
+        new.join()
+        self.assertListEqual(exitcodes, [0, 0])
+        self.assertFalse(os.path.exists(socketname))
+        con = sqlite3.connect(self.dbname)
+        (total,) = con.execute("SELECT SUM(cntrtotal) FROM finalresults").fetchone()
+        con.close()
+        self.assertEqual(total, 10000)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires unix domain sockets")
+    def test_socket_handover_ownership_and_timeout(self):
+        """
+        Test that a handover passes on the ownership of the socket and that the restarted collectd gives up waiting
+        """
+        path = os.path.join(self.tmpdir.name, "handover.socket")
+        release = threading.Event()
+
+        class StalledPipeline:
+            def stop(self):
+                release.wait()
+                return 0
+
+        for (remove_socket, timeout) in ((False, 10), (True, 0.2)):
+            release.clear()
+            listener = tlsrpt.listen_for_handover(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            old = threading.Thread(target=tlsrpt.collectd_handover,
+                                   args=(StalledPipeline(), sock, listener, remove_socket))
+            old.start()
+            if remove_socket:
+                with self.assertRaises(OSError):
+                    tlsrpt.take_over_socket(path, timeout)
+                release.set()
+            else:
+                release.set()
+                (newsock, newremove) = tlsrpt.take_over_socket(path, timeout)
+                newsock.close()
+                self.assertFalse(newremove)
+            old.join()
+
+    def test_decode_datagram(self):
+        """
+        Test decoding of valid and invalid datagrams
+        """
+        self.assertEqual(tlsrpt.decode_datagram(b'{"d": "example.com"}')["d"], "example.com")
+        with self.assertLogs(tlsrpt.logger, "ERROR"):
+            self.assertIsNone(tlsrpt.decode_datagram(b'{"d": '))
+        quarantine = tlsrpt.InvalidDatagramQuarantine("", 1, 10)
+        self.assertIsNone(tlsrpt.decode_datagram(b'\xff\xfe', quarantine))
+        self.assertEqual(quarantine.rejected, 1)
+
+    def test_quarantine(self):
+        """
+        Test that samples of invalid datagrams are rate-limited and saved to a ring of files
+        """
+        path = os.path.join(self.tmpdir.name, "invalid")
+        quarantine = tlsrpt.InvalidDatagramQuarantine(path, 2, 3)
+        for i in range(10):
+            tlsrpt.decode_datagram(b"invalid %d" % i, quarantine)
+        self.assertEqual(quarantine.rejected, 10)
+        self.assertEqual(len(quarantine.pending), 3)
+        with self.assertLogs(tlsrpt.logger, "ERROR") as cm:
+            quarantine.flush()
+        self.assertEqual(len(cm.output), 3)
+        self.assertListEqual(sorted(os.listdir(self.tmpdir.name)), ["invalid.0", "invalid.1"])
+        with open(path + ".0", "rb") as f:
+            self.assertEqual(f.read(), b"invalid 2")
+        with open(path + ".1", "rb") as f:
+            self.assertEqual(f.read(), b"invalid 1")
+        # a new minute allows new samples and logs the number of invalid datagrams
+        quarantine.minute_start -= 60
+        with self.assertLogs(tlsrpt.logger, "WARNING") as cm:
+            quarantine.flush()
+        self.assertIn("Rejected 10 invalid datagrams", cm.output[0])
+        tlsrpt.decode_datagram(b"invalid", quarantine)
+        self.assertEqual(len(quarantine.pending), 1)
+
+    def test_quarantine_default_file(self):
+        """
+        Test that by default an invalid datagram is saved under the configured name itself, like earlier versions did
+        """
+        path = os.path.join(self.tmpdir.name, "invalid")
+        config = make_collectd_config(dump_path_for_invalid_datagram=path)
+        quarantine = tlsrpt.InvalidDatagramQuarantine(config.dump_path_for_invalid_datagram,
+                                                      config.invalid_datagram_samples,
+                                                      config.invalid_datagram_samples_per_minute)
+        tlsrpt.decode_datagram(b"invalid", quarantine)
+        with self.assertLogs(tlsrpt.logger, "ERROR"):
+            quarantine.flush()
+        self.assertListEqual(os.listdir(self.tmpdir.name), ["invalid"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,412 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+from tlsrpt_reporter import tlsrpt
+from tlsrpt_reporter.utility import tlsrpt_utc_date_yesterday
+from tests.test_collectd import make_collectd_config, make_datagram
+
+V1_DDL = ["CREATE TABLE finalresults(day, domain, tlsrptrecord, policy, cntrtotal, cntrfailure, "
+          "its datetime default CURRENT_TIMESTAMP, PRIMARY KEY(day, domain, tlsrptrecord, policy))",
+          "CREATE TABLE failures(day, domain, tlsrptrecord, policy, reason, cntr, "
+          "PRIMARY KEY(day, domain, tlsrptrecord, policy, reason))",
+          "CREATE TABLE daystatus(daycomplete, its datetime default CURRENT_TIMESTAMP, PRIMARY KEY(daycomplete))",
+          "CREATE TABLE dbversion(version, installdate, purpose)"]
+
+
+def make_fetcher_config():
+    configvars = {k: v["default"] for k, v in tlsrpt.options_fetcher.items()}
+    return tlsrpt.ConfigFetcher(**configvars)
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dbname = os.path.join(self.tmpdir.name, "collectd.sqlite")
+        self.url = "sqlite://" + self.dbname
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fetch(self, day, domain=None):
+        """
+        Run the fetcher on the database of yesterday and capture its output
+        """
+        fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config())
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            if domain is None:
+                fetcher.fetch_domain_list(day)
+            else:
+                fetcher.fetch_domain_details(day, domain)
+        fetcher.con.close()
+        return output.getvalue()
+
+    def create_v1_database(self, dbname):
+        con = sqlite3.connect(dbname)
+        for statement in V1_DDL:
+            con.execute(statement)
+        con.execute("INSERT INTO dbversion VALUES(1, '2025-01-01', ?)", ("TLSRPT-Collectd-DB" + tlsrpt.DB_Purpose_Suffix,))
+        con.execute("INSERT INTO daystatus(daycomplete) VALUES('2025-01-01')")
+        policy = json.dumps({"policy-type": 2, "policy-string": ["mx.example.com"], "policy-domain": "example.com"})
+        for (domain, total, failure) in [("example.com", 10, 2), ("example.org", 5, 0)]:
+            con.execute("INSERT INTO finalresults(day, domain, tlsrptrecord, policy, cntrtotal, cntrfailure) "
+                        "VALUES('2025-01-01', ?, 'v=TLSRPTv1;rua=mailto:r@example.com', ?, ?, ?)",
+                        (domain, policy, total, failure))
+        con.execute("INSERT INTO failures(day, domain, tlsrptrecord, policy, reason, cntr) "
+                    "VALUES('2025-01-01', 'example.com', 'v=TLSRPTv1;rua=mailto:r@example.com', ?, '{\"c\": 202}', 2)",
+                    (policy,))
+        con.commit()
+        con.close()
+
+    def test_migrate_v1(self):
+        """
+        Test that the fetcher migrates a version 1 database and reports the same data
+        """
+        self.create_v1_database(tlsrpt.make_yesterday_dbname(self.dbname))
+        lines = self.fetch("2025-01-01").splitlines()
+        self.assertListEqual(sorted(lines[3:-1]), ["example.com", "example.org"])
+        details = json.loads(self.fetch("2025-01-01", "example.com"))
+        (policies,) = details["policies"].values()
+        (counters,) = policies.values()
+        self.assertDictEqual(counters, {"cntrtotal": 10, "cntrfailure": 2, "failures": {'{"c": 202}': 2}})
+        con = sqlite3.connect(tlsrpt.make_yesterday_dbname(self.dbname))
+        self.assertEqual(con.execute("SELECT version FROM dbversion").fetchone()[0], 3)
+        con.close()
+
+    def test_compact(self):
+        """
+        Test that policies and failure reasons differing only in their serialization are merged
+        """
+        dbname = tlsrpt.make_yesterday_dbname(self.dbname)
+        self.create_v1_database(dbname)
+        con = sqlite3.connect(dbname)
+        policy = json.dumps({"policy-domain": "example.com", "policy-string": ["mx.example.com"], "policy-type": 2})
+        con.execute("INSERT INTO finalresults(day, domain, tlsrptrecord, policy, cntrtotal, cntrfailure) "
+                    "VALUES('2025-01-01', 'example.com', 'v=TLSRPTv1;rua=mailto:r@example.com', ?, 3, 1)", (policy,))
+        con.execute("INSERT INTO failures(day, domain, tlsrptrecord, policy, reason, cntr) "
+                    "VALUES('2025-01-01', 'example.com', 'v=TLSRPTv1;rua=mailto:r@example.com', ?, '{\"c\":202}', 1)",
+                    (policy,))
+        con.commit()
+        con.close()
+        db = tlsrpt.VersionedSQLiteCollectdBase(dbname)
+        self.assertTrue(db._check_database())
+        self.assertTupleEqual(db.compact(), (5, 3))
+        self.assertListEqual(db.cur.execute("SELECT policy FROM policies").fetchall(),
+                             [(tlsrpt.canonical_json(json.loads(policy)),)])
+        self.assertListEqual(db.cur.execute("SELECT reason FROM reasons").fetchall(), [('{"c":202}',)])
+        db.con.close()
+        details = json.loads(self.fetch("2025-01-01", "example.com"))
+        (policies,) = details["policies"].values()
+        (counters,) = policies.values()
+        self.assertDictEqual(counters, {"cntrtotal": 13, "cntrfailure": 3, "failures": {'{"c":202}': 3}})
+
+    def test_collectd_to_fetcher(self):
+        """
+        Test that data written by collectd is reported by the fetcher after the day roll-over
+        """
+        collectd = tlsrpt.TLSRPTCollectdSQLite(self.url, make_collectd_config())
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com", True), make_datagram("example.com"),
+                                make_datagram("example.net")])
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.close()
+        lines = self.fetch(day).splitlines()
+        self.assertListEqual(sorted(lines[3:-1]), ["example.com", "example.net"])
+        self.assertEqual(lines[-1], ".")
+        details = json.loads(self.fetch(day, "example.com"))
+        self.assertEqual(details["d"], "example.com")
+        (policies,) = details["policies"].values()
+        (counters,) = policies.values()
+        self.assertEqual(counters["cntrtotal"], 2)
+        self.assertEqual(counters["cntrfailure"], 1)
+        self.assertEqual(len(counters["failures"]), 1)
+
+    def test_fetch_day_details(self):
+        """
+        Test that bulk mode prints the same details as fetching domain by domain, merged over all shards
+        """
+        days = []
+        for (index, domains) in enumerate([["example.com", "example.net"], ["example.com", "example.org"]]):
+            collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + tlsrpt.make_shard_name(self.dbname, index),
+                                                   make_collectd_config())
+            days.append(str(collectd.today))
+            collectd.add_datagrams([make_datagram(domain, True) for domain in domains])
+            collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+            collectd.close()
+        fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config()._replace(shards=2))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            fetcher.fetch_day_details(days[0])
+        bulk = output.getvalue().splitlines()
+        self.assertEqual(bulk[0], tlsrpt.TLSRPT_FETCHER_VERSION_STRING_V1_BULK)
+        self.assertEqual(bulk[-1], ".")
+        for line in bulk[3:-1]:
+            details = json.loads(line)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                fetcher.fetch_domain_details(days[0], details["d"])
+            self.assertDictEqual(details, json.loads(output.getvalue()))
+        self.assertListEqual([json.loads(line)["d"] for line in bulk[3:-1]],
+                             ["example.com", "example.net", "example.org"])
+        (policies,) = json.loads(bulk[3])["policies"].values()
+        (counters,) = policies.values()
+        self.assertEqual(counters["cntrfailure"], 2)
+        self.assertEqual(list(counters["failures"].values()), [2])
+        for database in fetcher.databases:
+            database.con.close()
+
+    def test_fetch_day_counts(self):
+        """
+        Test that the counters of protocol version 2 convert to the same details as sent by protocol version 1, with
+        each TLSRPT record, policy and failure reason sent once for all domains and shards
+        """
+        days = []
+        for (index, domains) in enumerate([["example.com", "example.net"], ["example.com", "example.org"]]):
+            collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + tlsrpt.make_shard_name(self.dbname, index),
+                                                   make_collectd_config())
+            days.append(str(collectd.today))
+            collectd.add_datagrams([make_datagram(domain, True) for domain in domains])
+            collectd.add_datagrams([make_datagram(domain) for domain in domains])
+            collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+            collectd.close()
+        fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config()._replace(shards=2))
+        outputs = []
+        for method in (fetcher.fetch_day_details, fetcher.fetch_day_counts):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                method(days[0])
+            outputs.append(output.getvalue().splitlines())
+        for database in fetcher.databases:
+            database.con.close()
+        (v1, v2) = outputs
+        self.assertEqual(v2[0], tlsrpt.TLSRPT_FETCHER_VERSION_STRING_V2_BULK)
+        self.assertEqual(v2[-1], ".")
+        records = [json.loads(line) for line in v2[3:-1]]
+        dictionary = {"r": {}, "p": {}, "f": {}}
+        details = []
+        for record in records:
+            if record[0] == "d":
+                details.append({"d": record[1],
+                                "policies": tlsrpt.TLSRPTReportd._policies_from_counts(dictionary, record[2])})
+            else:
+                self.assertEqual(record[1], len(dictionary[record[0]]))
+                dictionary[record[0]].update(enumerate(record[2], record[1]))
+        self.assertListEqual(details, [json.loads(line) for line in v1[3:-1]])
+        policies = [(record, policy, counters) for domain in details
+                    for (record, recordpolicies) in domain["policies"].items()
+                    for (policy, counters) in recordpolicies.items()]
+        self.assertCountEqual(dictionary["r"].values(), set(record for (record, _, _) in policies))
+        self.assertCountEqual(dictionary["p"].values(), set(policy for (_, policy, _) in policies))
+        self.assertCountEqual(dictionary["f"].values(), set(reason for (_, _, counters) in policies
+                                                            for reason in counters["failures"]))
+        self.assertLess(len("\n".join(v2)), len("\n".join(v1)))
+
+    def test_fetch_day_changes(self):
+        """
+        Test that the intraday export of the current day sends the domains changed since the checkpoint
+        """
+        def fetch(day, since):
+            fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config()._replace(bulk=1, protocol=2))
+            output = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(output):
+                    fetcher.fetch_day_counts(day, since)
+            finally:
+                for database in fetcher.databases:
+                    database.con.close()
+            lines = output.getvalue().splitlines()
+            self.assertEqual(lines[0], tlsrpt.TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL)
+            self.assertEqual(lines[-1], ".")
+            return [json.loads(line) for line in lines[3:-1]]
+
+        collectd = tlsrpt.TLSRPTCollectdSQLite(self.url, make_collectd_config())
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com"), make_datagram("example.net", True)])
+        collectd.timed_commit()
+        lines = fetch(day, "0")
+        checkpoint = lines[0][1]
+        self.assertEqual(lines[0][0], "c")
+        self.assertListEqual([line[1] for line in lines if line[0] == "d"], ["example.com", "example.net"])
+        self.assertListEqual(fetch(day, checkpoint), [["c", checkpoint]])
+        collectd.add_datagrams([make_datagram("example.net")])
+        collectd.timed_commit()
+        lines = fetch(day, checkpoint)
+        self.assertNotEqual(lines[0], ["c", checkpoint])
+        (domain,) = [line for line in lines if line[0] == "d"]
+        ((_, _, cntrtotal, cntrfailure, _),) = domain[2]
+        self.assertListEqual(domain[:2], ["d", "example.net"])
+        self.assertEqual((cntrtotal, cntrfailure), (2, 1))
+        lines = fetch(day, "0123456789abcdef:" + checkpoint.split(":")[1])  # checkpoint of another database
+        self.assertListEqual(lines[0], ["reset"])
+        self.assertListEqual([line[1] for line in lines if line[0] == "d"], ["example.com", "example.net"])
+        with self.assertRaises(ValueError):
+            fetch(day, "1000")
+        # the database already holds the next day, no checkpoint is sent so reportd retries later
+        collectd.con.execute("INSERT INTO domainsperday(day, domain_id) VALUES('2999-01-01', 1)")
+        collectd.con.commit()
+        self.assertListEqual(fetch(day, checkpoint), [])
+        collectd.close()
+
+    def test_fetch_day_changes_locked(self):
+        """
+        Test that an intraday export while the collectd locks its database ends without a checkpoint to be retried
+        """
+        def fetch():
+            fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config()._replace(bulk=1, protocol=2))
+            output = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(output), self.assertLogs(tlsrpt.logger, "WARNING"):
+                    fetcher.fetch_day_counts(day, "0")
+            finally:
+                for database in fetcher.databases:
+                    database.con.close()
+            lines = output.getvalue().splitlines()
+            self.assertEqual(lines[0], tlsrpt.TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL)
+            self.assertListEqual(lines[3:], ["."])  # no checkpoint line, reportd retries later
+
+        collectd = tlsrpt.TLSRPTCollectdSQLite(self.url, make_collectd_config())
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com")])
+        collectd.timed_commit()
+        # the collectd holds the lock of its commit while the fetcher reads the checkpoint
+        collectd.cur.execute("BEGIN EXCLUSIVE")
+        with unittest.mock.patch.object(tlsrpt.ReadOnlyCollectdDatabase, "BUSY_TIMEOUT", 0.01):
+            fetch()
+        collectd.con.rollback()
+        # the collectd locks its database after the checkpoint was read
+        with unittest.mock.patch.object(tlsrpt.TLSRPTFetcherSQLite, "_day_details",
+                                        side_effect=sqlite3.OperationalError("database is locked")):
+            fetch()
+        collectd.close()
+
+    def test_fetcher_session(self):
+        """
+        Test that a fetcher session answers several requests and follows the day roll-over of collectd
+        """
+        def rollover(domain):
+            collectd = tlsrpt.TLSRPTCollectdSQLite(self.url, make_collectd_config())
+            collectd.today = tlsrpt_utc_date_yesterday()
+            collectd.add_datagrams([make_datagram(domain)])
+            collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+            collectd.close()
+
+        day = str(tlsrpt_utc_date_yesterday())
+
+        def requests():
+            yield ("list %s\n" % day).encode()
+            yield ("details %s example.com\n" % day).encode()
+            rollover("example.org")  # replaces the database of yesterday the fetcher has open
+            yield ("list %s\n" % day).encode()
+            yield b"quit\n"
+            yield ("list %s\n" % day).encode()
+
+        rollover("example.com")
+        fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config())
+        output = io.BytesIO()
+        tlsrpt.tlsrpt_fetcher_session(fetcher, requests(), output)
+        fetcher.con.close()
+        stream = io.BytesIO(output.getvalue())
+        self.assertEqual(stream.readline().decode(), tlsrpt.TLSRPT_FETCHER_SESSION_STRING + "\n")
+        replies = []
+        while True:
+            reply = tlsrpt.ChunkedReplyReader(stream)
+            replies.append(io.BufferedReader(reply).read().decode())
+            if reply.broken:
+                break
+        self.assertEqual(replies.pop(), "")  # end of the output, nothing answered after the quit request
+        self.assertEqual(len(replies), 3)
+        self.assertListEqual(replies[0].splitlines()[3:], ["example.com", "."])
+        self.assertEqual(json.loads(replies[1])["d"], "example.com")
+        self.assertListEqual(replies[2].splitlines()[3:], ["example.org", "."])
+
+    def test_compressed_output(self):
+        """
+        Test that compressed fetcher output decompresses to the uncompressed output, also within a session
+        """
+        collectd = tlsrpt.TLSRPTCollectdSQLite(self.url, make_collectd_config())
+        collectd.today = tlsrpt_utc_date_yesterday()
+        collectd.add_datagrams([make_datagram("d%d.example.com" % i, i % 2 == 0) for i in range(100)])
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.close()
+        day = str(tlsrpt_utc_date_yesterday())
+        fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config())
+        outputs = {}
+        for compression in ("", "zlib"):
+            output = io.BytesIO()
+            with tlsrpt.fetcher_stdout(output, compression):
+                fetcher.fetch_day_details(day)
+            outputs[compression] = output.getvalue()
+        self.assertLess(len(outputs["zlib"]) * 5, len(outputs[""]))
+        stream = tlsrpt.decompress_fetcher_output(io.BytesIO(outputs["zlib"]), "zlib")
+        self.assertEqual(stream.read(), outputs[""])
+        with self.assertRaises(OSError):
+            tlsrpt.decompress_fetcher_output(io.BytesIO(outputs[""]), "zlib")
+
+        output = io.BytesIO()
+        requests = [("details %s d1.example.com\n" % day).encode(), ("list %s\n" % day).encode()]
+        tlsrpt.tlsrpt_fetcher_session(fetcher, requests, output, "zlib")
+        fetcher.con.close()
+        stream = io.BytesIO(output.getvalue())
+        stream.readline()
+        replies = [tlsrpt.decompress_fetcher_output(io.BufferedReader(tlsrpt.ChunkedReplyReader(stream)), "zlib")
+                   .read().decode() for request in requests]
+        self.assertEqual(json.loads(replies[0])["d"], "d1.example.com")
+        self.assertEqual(len(replies[1].splitlines()), 3 + 100 + 1)
+
+    def test_sharded_fetcher(self):
+        """
+        Test that the fetcher merges the domain lists and sums up the counters of all shards
+        """
+        days = []
+        for (index, domains) in enumerate([["example.com", "example.net"], ["example.com", "example.org"]]):
+            collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + tlsrpt.make_shard_name(self.dbname, index),
+                                                   make_collectd_config())
+            days.append(str(collectd.today))
+            collectd.add_datagrams([make_datagram(domain, index == 0) for domain in domains])
+            collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+            collectd.close()
+        self.assertEqual(days[0], days[1])
+        output = io.StringIO()
+        fetcher = tlsrpt.TLSRPTFetcherSQLite(self.url, make_fetcher_config()._replace(shards=2))
+        with contextlib.redirect_stdout(output):
+            fetcher.fetch_domain_list(days[0])
+            fetcher.fetch_domain_details(days[0], "example.com")
+        for database in fetcher.databases:
+            database.con.close()
+        lines = output.getvalue().splitlines()
+        self.assertListEqual(lines[3:6], ["example.com", "example.net", "example.org"])
+        self.assertEqual(lines[6], ".")
+        details = json.loads("\n".join(lines[7:]))
+        (policies,) = details["policies"].values()
+        (counters,) = policies.values()
+        self.assertEqual(counters["cntrtotal"], 2)
+        self.assertEqual(counters["cntrfailure"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,7 +37,9 @@ class MyTestCase(unittest.TestCase):
         """
         self.plugin_entrypoint("tlsrpt.collectd", "sqlite:///tmp/test-collectd.sqlite", "TLSRPTCollectdSQLite")
         self.plugin_entrypoint("tlsrpt.collectd", "dummy://", "DummyCollectd")
+        self.plugin_entrypoint("tlsrpt.collectd", "applog:///tmp/test-collectd.applog", "TLSRPTCollectdAppLog")
         self.plugin_entrypoint("tlsrpt.fetcher", "sqlite:///tmp/test-collectd.sqlite", "TLSRPTFetcherSQLite")
+        self.plugin_entrypoint("tlsrpt.fetcher", "applog:///tmp/test-collectd.applog", "TLSRPTFetcherAppLog")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from tlsrpt_reporter import tlsrpt
+from tlsrpt_reporter.utility import tlsrpt_utc_date_now, tlsrpt_utc_date_yesterday
+from tests.test_collectd import make_collectd_config, make_datagram
+
+# Fetcher run by reportd as a separate process, optionally behaving like a fetcher without bulk and session mode
+FETCHER_SCRIPT = """
+import sys
+sys.path.insert(0, {path!r})
+if {old!r} and any(arg.startswith("--bulk") or arg.startswith("--session") for arg in sys.argv):
+    sys.exit(2)
+from tlsrpt_reporter.tlsrpt import tlsrpt_fetcher_main
+tlsrpt_fetcher_main()
+"""
+
+
+def make_reportd_config(**kwargs):
+    """
+    Create a reportd configuration from the option defaults
+    :param kwargs: options overriding the defaults
+    :return: the ConfigReportd
+    """
+    configvars = {k: v["default"] for k, v in tlsrpt.options_reportd.items()}
+    configvars.update(kwargs)
+    return tlsrpt.ConfigReportd(**configvars)
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.collectd_dbname = os.path.join(self.tmpdir.name, "collectd.sqlite")
+        collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + self.collectd_dbname, make_collectd_config())
+        collectd.today = tlsrpt_utc_date_yesterday()  # the data of yesterday is ready to be reported
+        collectd.add_datagrams([make_datagram("example.com", True), make_datagram("example.com"),
+                                make_datagram("example.net")])
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.close()
+
+    def make_reportd(self, old, **kwargs):
+        """
+        Create a reportd with one fetcher
+        :param old: True to use a fetcher without bulk and session mode
+        :param kwargs: options overriding the defaults
+        """
+        script = os.path.join(self.tmpdir.name, "fetcher.py")
+        with open(script, "w") as f:
+            f.write(FETCHER_SCRIPT.format(path=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), old=old))
+        fetcher = "%s %s --storage sqlite://%s" % (sys.executable, script, self.collectd_dbname)
+        reportd = tlsrpt.TLSRPTReportd(make_reportd_config(dbname=os.path.join(self.tmpdir.name, "reportd.sqlite"),
+                                                           fetchers=fetcher, **kwargs))
+        self.addCleanup(reportd.con.close)
+        self.addCleanup(reportd.close_fetcher_sessions)
+        return reportd
+
+    def reportdata(self, reportd):
+        reportd.cur.execute("SELECT domain, data, status FROM reportdata ORDER BY domain")
+        return [(domain, json.loads(data) if data is not None else None, status)
+                for (domain, data, status) in reportd.cur.fetchall()]
+
+    def test_bulk_details(self):
+        """
+        Test that the details of all domains are stored by the single bulk mode run of a fetcher
+        """
+        reportd = self.make_reportd(False)
+        reportd.check_day()
+        reportd.collect_domains()
+        self.assertDictEqual(reportd.fetcher_protocols, {1: 2})
+        rows = self.reportdata(reportd)
+        self.assertListEqual([(domain, status) for (domain, data, status) in rows],
+                             [("example.com", "fetched"), ("example.net", "fetched")])
+        (policies,) = rows[0][1].values()
+        (counters,) = policies.values()
+        self.assertEqual((counters["cntrtotal"], counters["cntrfailure"]), (2, 1))
+
+    def test_session(self):
+        """
+        Test that all requests of the collection phase are sent to one fetcher process kept running
+        """
+        reportd = self.make_reportd(False)
+        reportd.check_day()
+        reportd.collect_domains()
+        (session,) = reportd.fetcher_sessions.values()
+        pid = session.process.pid
+        day = str(tlsrpt_utc_date_yesterday())
+        for request in (["list", day], ["bulk", day], ["details", day, "example.net"]):
+            with reportd.fetcher_output(1, None, request) as stdout:
+                stdout.readline()  # the rest of the reply is skipped
+        with reportd.fetcher_output(1, None, ["details", day, "example.com"]) as stdout:
+            self.assertEqual(json.loads(stdout.read().decode())["d"], "example.com")
+        self.assertEqual(reportd.fetcher_sessions[1].process.pid, pid)
+        self.assertTrue(reportd.collection_finished())
+        reportd.close_fetcher_sessions()
+        self.assertEqual(session.process.returncode, 0)
+
+    def test_intraday_export(self):
+        """
+        Test that the counters of the current day are staged during the day and only the remaining changes are pulled
+        after the end of the day
+        """
+        reportd = self.make_reportd(False, interval_intraday_export=3600)
+        (fetcher,) = reportd.get_fetchers()
+        collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + self.collectd_dbname, make_collectd_config())
+        day = str(collectd.today)
+        collectd.add_datagrams([make_datagram("example.com"), make_datagram("example.org")])
+        collectd.timed_commit()
+        reportd.export_intraday()
+        self.assertTrue(reportd.staging_checkpoint(day, fetcher, 1).endswith(":1"))
+        collectd.add_datagrams([make_datagram("example.org", True)])
+        collectd.timed_commit()
+        self.assertTrue(reportd.pull_day_counts(day, fetcher, 1, False))
+        reportd.cur.execute("SELECT domain FROM stagingdata WHERE day=? ORDER BY domain", (day,))
+        self.assertListEqual(reportd.cur.fetchall(), [("example.com",), ("example.org",)])
+        collectd.add_datagrams([make_datagram("example.net")])
+        collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+        collectd.close()
+        con = sqlite3.connect(tlsrpt.make_yesterday_dbname(self.collectd_dbname))
+        con.execute("UPDATE daystatus SET daycomplete=?", (day,))  # as after the roll-over at the end of the day
+        con.commit()
+        con.close()
+        self.assertTrue(reportd.collect_day_details_from(day, fetcher, 1))
+        self.assertIsNone(reportd.staging_checkpoint(day, fetcher, 1))
+        reportd.cur.execute("SELECT domain, data, status FROM reportdata WHERE day=? ORDER BY domain", (day,))
+        rows = reportd.cur.fetchall()
+        self.assertListEqual([(domain, status) for (domain, data, status) in rows],
+                             [("example.com", "fetched"), ("example.net", "fetched"), ("example.org", "fetched")])
+        (policies,) = json.loads(rows[2][1]).values()
+        (counters,) = policies.values()
+        self.assertEqual((counters["cntrtotal"], counters["cntrfailure"]), (2, 1))
+
+    def test_intraday_export_after_migration(self):
+        """
+        Test that the first intraday export includes the counters written to the current day before the database was
+        migrated to the version with change sequence numbers
+        """
+        os.remove(self.collectd_dbname)
+        day = str(tlsrpt_utc_date_now())
+        con = sqlite3.connect(self.collectd_dbname)
+        for statement in tlsrpt.VersionedSQLiteCollectdBase._ddl_v2_tables() + [
+                "CREATE TABLE daystatus(daycomplete, its datetime default CURRENT_TIMESTAMP, PRIMARY KEY(daycomplete))",
+                "CREATE TABLE dbversion(version, installdate, purpose)"]:
+            con.execute(statement)
+        con.execute("INSERT INTO dbversion VALUES(2, '2025-01-01', ?)", ("TLSRPT-Collectd-DB" + tlsrpt.DB_Purpose_Suffix,))
+        con.execute("INSERT INTO domains VALUES(1, 'example.com')")
+        con.execute("INSERT INTO tlsrptrecords VALUES(1, 'v=TLSRPTv1;rua=mailto:r@example.com')")
+        con.execute("INSERT INTO policies VALUES(1, ?)", (json.dumps({"policy-type": 9}),))
+        con.execute("INSERT INTO finalresults(day, domain_id, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure) "
+                    "VALUES(?, 1, 1, 1, 5, 0)", (day,))
+        con.execute("INSERT INTO domainsperday VALUES(?, 1)", (day,))
+        con.commit()
+        con.close()
+        collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + self.collectd_dbname, make_collectd_config())
+        collectd.add_datagrams([make_datagram("example.org")])
+        collectd.timed_commit()
+        reportd = self.make_reportd(False)
+        (fetcher,) = reportd.get_fetchers()
+        self.assertTrue(reportd.pull_day_counts(day, fetcher, 1, False))
+        collectd.close()
+        reportd.cur.execute("SELECT domain FROM stagingdata WHERE day=? ORDER BY domain", (day,))
+        self.assertListEqual(reportd.cur.fetchall(), [("example.com",), ("example.org",)])
+
+    def test_unsupported_fetcher_compression(self):
+        """
+        Test that an unsupported fetcher compression is rejected with a readable message
+        """
+        with self.assertRaises(tlsrpt.TLSRPTReportdSetupException) as cm:
+            tlsrpt.TLSRPTReportd(make_reportd_config(dbname=os.path.join(self.tmpdir.name, "reportd.sqlite"),
+                                                     fetcher_compression="lz4"))
+        self.assertEqual(str(cm.exception), "Unsupported fetcher compression: lz4")
+
+    def test_fallback(self):
+        """
+        Test that reportd fetches domain by domain from fetchers without bulk mode
+        """
+        reportd = self.make_reportd(True)
+        reportd.check_day()
+        reportd.collect_domains()
+        self.assertListEqual(self.reportdata(reportd), [("example.com", None, None), ("example.net", None, None)])
+        reportd.fetch_data()
+        self.assertDictEqual(reportd.fetcher_protocols, {1: 1})
+        self.assertDictEqual(reportd.fetcher_compressions, {1: "zlib"})
+        rows = self.reportdata(reportd)
+        self.assertListEqual([(domain, status) for (domain, data, status) in rows],
+                             [("example.com", "fetched"), ("example.net", "fetched")])
+        (policies,) = rows[0][1].values()
+        (counters,) = policies.values()
+        self.assertEqual((counters["cntrtotal"], counters["cntrfailure"]), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
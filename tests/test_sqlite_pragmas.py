@@ -0,0 +1,92 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import tempfile
+import unittest
+
+from tlsrpt_reporter import tlsrpt
+from tests.test_collectd import make_collectd_config, make_datagram
+
+
+class MyTestCase(unittest.TestCase):
+    def test_parse_pragmas(self):
+        """
+        Test parsing of SQLite settings and profiles
+        """
+        self.assertDictEqual(tlsrpt.parse_sqlite_pragmas(""), {})
+        self.assertDictEqual(tlsrpt.parse_sqlite_pragmas("journal_mode=WAL&cache_size=-2000"),
+                             {"journal_mode": "WAL", "cache_size": "-2000"})
+        pragmas = tlsrpt.parse_sqlite_pragmas("synchronous=FULL&profile=high-throughput")
+        self.assertEqual(pragmas["synchronous"], "FULL")  # explicit settings override the profile
+        self.assertEqual(pragmas["journal_mode"], "WAL")
+
+    def test_parse_pragmas_errors(self):
+        """
+        Test rejection of unknown settings and values that could inject SQL
+        """
+        for query in ["profile=fast", "page_size=4096", "synchronous=OFF;DROP TABLE x", "journal_mode="]:
+            with self.subTest(query=query):
+                with self.assertRaises(ValueError):
+                    tlsrpt.parse_sqlite_pragmas(query)
+
+    def test_collectd_profile(self):
+        """
+        Test that the settings of the storage URL are applied to the collectd database and survive a rollover
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbname = os.path.join(tmpdir, "collectd.sqlite")
+            collectd = tlsrpt.TLSRPTCollectdSQLite("sqlite://" + dbname + "?profile=high-throughput",
+                                                   make_collectd_config())
+            collectd.add_datagram(make_datagram("example.com"))
+            collectd.switch_to_next_day(tlsrpt.RolloverReason.MIDNIGHT)
+            for (pragma, expected) in [("journal_mode", "wal"), ("synchronous", 1), ("busy_timeout", 5000)]:
+                collectd.cur.execute("PRAGMA " + pragma)
+                self.assertEqual(collectd.cur.fetchone()[0], expected)
+            collectd.close()
+
+
+    def test_check_storage_pragmas(self):
+        """
+        Test that invalid settings in storage URLs are reported before a storage backend is opened
+        """
+        with self.assertLogs(tlsrpt.logger, "INFO"):
+            self.assertTrue(tlsrpt.check_storage_sqlite_pragmas(["sqlite:///tmp/c.sqlite?profile=high-throughput",
+                                                                 "dummy://?log"]))
+        with self.assertLogs(tlsrpt.logger, "ERROR"):
+            self.assertFalse(tlsrpt.check_storage_sqlite_pragmas(["applog:///tmp/c.applog?page_size=4096"]))
+
+    def test_fetcher_keeps_journal_mode(self):
+        """
+        Test that the fetcher does not switch the journal mode of the database it reads
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbname = os.path.join(tmpdir, "collectd.sqlite")
+            tlsrpt.TLSRPTCollectdSQLite("sqlite://" + dbname, make_collectd_config()).close()
+            configvars = {k: v["default"] for k, v in tlsrpt.options_fetcher.items()}
+            fetcher = tlsrpt.TLSRPTFetcherSQLite("sqlite://" + dbname + "?profile=high-throughput",
+                                                 tlsrpt.ConfigFetcher(**configvars))
+            fetcher.cur.execute("PRAGMA journal_mode")
+            self.assertEqual(fetcher.cur.fetchone()[0], "delete")
+            fetcher.cur.execute("PRAGMA busy_timeout")
+            self.assertEqual(fetcher.cur.fetchone()[0], 5000)
+            fetcher.con.close()
+
+if __name__ == '__main__':
+    unittest.main()
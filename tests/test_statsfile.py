@@ -0,0 +1,76 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import struct
+import tempfile
+import unittest
+
+from tlsrpt_reporter.statsfile import StatsFile, StatsFileException, read_stats_file
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filename = os.path.join(self.tmpdir.name, "collectd.stats")
+
+    def test_round_trip(self):
+        """
+        Test that published counters are read back in order and the file is removed on close
+        """
+        stats = StatsFile(self.filename, ["datagrams", "bytes", "commits"])
+        self.assertDictEqual(read_stats_file(self.filename), {"datagrams": 0, "bytes": 0, "commits": 0})
+        stats.update({"datagrams": 3, "bytes": 2 ** 40, "unknown": 7})
+        self.assertListEqual(list(read_stats_file(self.filename).items()),
+                             [("datagrams", 3), ("bytes", 2 ** 40), ("commits", 0)])
+        stats.close()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_torn_read(self):
+        """
+        Test that a reader does not return values while an update is in progress
+        """
+        stats = StatsFile(self.filename, ["datagrams"])
+        self.addCleanup(stats.close)
+        struct.pack_into("<Q", stats.map, StatsFile.SEQUENCE_OFFSET, 1)  # writer interrupted during an update
+        with self.assertRaises(StatsFileException):
+            read_stats_file(self.filename, retries=3)
+
+    def test_long_name(self):
+        """
+        Test that counter names exceeding the slot are rejected instead of truncated
+        """
+        StatsFile(self.filename, ["x" * StatsFile.NAME_SIZE]).close()
+        with self.assertRaises(StatsFileException):
+            StatsFile(self.filename, ["x" * (StatsFile.NAME_SIZE + 1)])
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_invalid_file(self):
+        """
+        Test that files not written by StatsFile are rejected
+        """
+        with open(self.filename, "wb") as f:
+            f.write(b"x" * 100)
+        with self.assertRaises(StatsFileException):
+            read_stats_file(self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
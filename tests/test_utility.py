@@ -34,6 +34,24 @@ class MyTestCase(unittest.TestCase):
             domain = utility.extract_domain_from_email_address('example.com')
         self.assertEqual(cm.exception.__str__(), "Could not extract domain part from example.com")
 
+    def test_canonical_json(self):
+        self.assertEqual(utility.canonical_json({"b": [1, {"d": 2, "c": 3}], "a": "x"}),
+                         '{"a":"x","b":[1,{"c":3,"d":2}]}')
+        self.assertEqual(utility.canonical_json({"a": 1, "b": 2}), utility.canonical_json({"b": 2, "a": 1}))
+
+    def test_lru_cache(self):
+        cache = utility.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)  # discards b as least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 1, 2))
+        disabled = utility.LRUCache(0)
+        disabled.put("a", 1)
+        self.assertIsNone(disabled.get("a"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,475 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Log-structured storage backend for collectd, selected with storage URLs like applog:///var/lib/tlsrpt/collectd.applog
+#
+# During the day the serialized policies are appended as compact binary records to a segment file. At the day
+# roll-over the segment is compacted in a background thread into a database with the standard collectd layout,
+# named like the database of the previous day of the SQLite storage, so the fetcher reads it like an SQLite storage.
+
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+from tlsrpt_reporter.tlsrpt import ConfigCollectd, DatagramSerializer, RolloverReason, TLSRPTCollectd, \
+    TLSRPTFetcherSQLite, VersionedSQLiteCollectdBase, logger, parse_sqlite_pragmas, remove_sqlite_database, \
+    run_daily_rollover_script
+from tlsrpt_reporter.utility import LRUCache, make_yesterday_dbname, tlsrpt_utc_date_now, \
+    tlsrpt_utc_date_yesterday, tlsrpt_utc_seconds_until_day_end
+
+# A segment starts with the magic and version header followed by a day record and any number of string and counter
+# records. Strings are numbered in the order of their string records and referenced by counter records.
+SEGMENT_MAGIC = b"TLSRPTAL"
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct("<8sI")
+STRING_RECORD = struct.Struct("<cI")  # type b"S" or b"D" for the day, length of the UTF-8 string following
+COUNT_RECORD = struct.Struct("<cIIIQQI")  # type b"C", domain, record and policy ids, sessions, failed, failures
+FAILURE_RECORD = struct.Struct("<IQ")  # reason id, count, following their counter record
+COMPACTION_RETRY_INTERVAL = 300  # seconds to wait before compacting a segment again after a failed compaction
+
+
+class SegmentException(Exception):
+    pass
+
+
+def make_segment_name(path):
+    """
+    Create name for the segment file being compacted
+    :param path: name of the segment file of today
+    :return: name of the segment file during compaction
+    """
+    return path + ".compacting"
+
+
+def make_failed_segment_name(path, day):
+    """
+    Create name for a segment kept because it could not be compacted before the next segment needed its name
+    :param path: name of the segment file of today
+    :param day: the day of the data in the segment
+    :return: name of the kept segment file
+    """
+    return path + "." + day + ".failed"
+
+
+def segment_header(day):
+    """
+    Create the start of a segment file
+    :param day: the day of the data in the segment
+    :return: the header followed by the day record
+    """
+    encoded = day.encode("utf-8")
+    return SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION) + STRING_RECORD.pack(b"D", len(encoded)) + encoded
+
+
+def read_segment(filename, count=None):
+    """
+    Read the records of a segment file, stopping at an incomplete last record left by a crash
+    :param filename: the segment file
+    :param count: function called with domain, TLSRPT record, policy, sessions, failed sessions and a list of tuples
+                  of failure reasons and their counts for each counter record
+    :return: tuple of the day of the segment, the list of its strings and the length of its complete records
+    :raises SegmentException: if the file is not a segment
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            raise SegmentException(f"{filename} is too short for a segment")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version) = SEGMENT_HEADER.unpack_from(data, 0)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise SegmentException(f"{filename} is not a segment of version {SEGMENT_VERSION}")
+        day = None
+        strings = []
+        offset = SEGMENT_HEADER.size
+        while offset + STRING_RECORD.size <= size:
+            rtype = data[offset:offset + 1]
+            if rtype == b"C":
+                if offset + COUNT_RECORD.size > size:
+                    break
+                (_, domain, tlsrptrecord, policy, sessions, failed, nfailures) = COUNT_RECORD.unpack_from(data, offset)
+                end = offset + COUNT_RECORD.size + nfailures * FAILURE_RECORD.size
+                if end > size:
+                    break
+                if count is not None:
+                    failures = [(strings[reason], cntr) for (reason, cntr) in
+                                FAILURE_RECORD.iter_unpack(data[offset + COUNT_RECORD.size:end])]
+                    count(strings[domain], strings[tlsrptrecord], strings[policy], sessions, failed, failures)
+            elif rtype in (b"S", b"D"):
+                (_, length) = STRING_RECORD.unpack_from(data, offset)
+                end = offset + STRING_RECORD.size + length
+                if end > size:
+                    break
+                value = data[offset + STRING_RECORD.size:end].decode("utf-8")
+                if rtype == b"D":
+                    day = value
+                else:
+                    strings.append(value)
+            else:
+                raise SegmentException(f"Unknown record type {rtype} at offset {offset} of {filename}")
+            offset = end
+        if day is None:
+            raise SegmentException(f"{filename} contains no day")
+        return day, strings, offset
+    finally:
+        data.close()
+
+
+def compact_segment(segment, dbname, pragmas, day=None):
+    """
+    Compact a segment into a collectd database and remove the segment.
+    The database is built under a temporary name and renamed when it is complete, so a crash during compaction
+    leaves the segment to be compacted again.
+    :param segment: the segment file
+    :param dbname: the name of the database to create
+    :param pragmas: dict of SQLite settings for the database
+    :param day: the day to store the counters under, defaults to the day of the segment
+    :return: the number of counter records compacted
+    """
+    finalresults = {}  # (domain, tlsrptrecord, policy) -> [sessions, failed]
+    failures = {}  # (domain, tlsrptrecord, policy, reason) -> count
+    records = 0
+
+    def count(domain, tlsrptrecord, policy, sessions, failed, reasons):
+        nonlocal records
+        records += 1
+        key = (domain, tlsrptrecord, policy)
+        counters = finalresults.get(key)
+        if counters is None:
+            finalresults[key] = [sessions, failed]
+        else:
+            counters[0] += sessions
+            counters[1] += failed
+        for (reason, cntr) in reasons:
+            fkey = key + (reason,)
+            failures[fkey] = failures.get(fkey, 0) + cntr
+
+    (segmentday, strings, end) = read_segment(segment, count)
+    if day is None:
+        day = segmentday
+    tmpname = dbname + ".tmp"
+    remove_sqlite_database(tmpname)
+    db = VersionedSQLiteCollectdBase(tmpname, pragmas)
+    try:
+        db._setup_database()
+        db.pending_finalresults = {(day,) + key: counters for (key, counters) in finalresults.items()}
+        db.pending_failures = {(day,) + key: cntr for (key, cntr) in failures.items()}
+        db._flush_pending()
+        db.cur.execute("INSERT INTO daystatus (daycomplete) VALUES(?)", (day,))
+        db.con.commit()
+    finally:
+        db.con.close()
+    remove_sqlite_database(dbname)
+    os.rename(tmpname, dbname)
+    os.remove(segment)
+    return records
+
+
+class TLSRPTCollectdAppLog(DatagramSerializer, TLSRPTCollectd):
+    """
+    Log-structured collectd storage backend appending the serialized policies to a segment file.
+    Appending is sequential I/O without any index maintenance, the aggregation is deferred to the compaction at the
+    day roll-over. The segment is flushed and synced to disk like the SQLite storage commits.
+    """
+    def __init__(self, url: str, config: ConfigCollectd):
+        """
+        :url str: URL defining the parameters for this reciever instance, the query string holds the SQLite settings
+                  of the compacted databases
+        :type config: ConfigCollectd
+        """
+        parsed = urllib.parse.urlparse(urllib.parse.unquote(url))
+        if parsed.scheme != "applog":
+            raise Exception(f"{self.__class__.__name__} can not be instantiated from '{url}'")
+        self.cfg = config
+        self.url = url
+        self.path = parsed.path
+        self.pragmas = parse_sqlite_pragmas(parsed.query)
+        self.policy_cache = LRUCache(self.cfg.policy_cache_size)
+        self.segment = None
+        self.ids = {}  # string -> id within the current segment
+        self.unflushed_datagrams = 0
+        self.compaction_thread = None
+        self.compaction_day = None  # the day to store the counters of the segment being compacted under
+        self.next_compaction_retry = None  # monotonic time to compact a segment again after a failed compaction
+        # Counters published via statistics()
+        self.policies_processed = 0
+        self.flushes = 0
+        self.last_rollover_stall = 0.0
+        self.today = tlsrpt_utc_date_now()
+        self.next_rollover = 0.0
+        self._schedule_rollover()
+        self.next_flush = time.monotonic() + self.cfg.sockettimeout
+        # finish a compaction interrupted by a crash
+        if os.path.exists(make_segment_name(self.path)):
+            logger.warning("Compacting segment %s left over from an interrupted compaction", make_segment_name(self.path))
+            self._compact(make_segment_name(self.path), None)
+        if os.path.exists(self.path):
+            (day, strings, end) = read_segment(self.path)
+            if day != str(self.today):
+                logger.info("Segment %s holds data of %s, compacting it", self.path, day)
+                self._keep_failed_segment()
+                os.rename(self.path, make_segment_name(self.path))
+                self._compact(make_segment_name(self.path), None)
+            else:
+                self._reopen_segment(strings, end)
+        if not os.path.exists(make_yesterday_dbname(self.path)):
+            # a fresh install needs the database of yesterday as well, just like the SQLite storage
+            logger.info("Create empty database %s for initialization", make_yesterday_dbname(self.path))
+            self._keep_failed_segment()
+            with open(make_segment_name(self.path), "wb") as f:
+                f.write(segment_header(str(tlsrpt_utc_date_yesterday())))
+            self._compact(make_segment_name(self.path), None)
+        if self.segment is None:
+            self._start_segment()
+
+    def _start_segment(self):
+        """
+        Create a new segment file for today
+        """
+        self.segment = open(self.path, "wb", buffering=1024 * 1024)
+        self.segment.write(segment_header(str(self.today)))
+        self.ids = {}
+        self._flush_segment()
+
+    def _reopen_segment(self, strings, end):
+        """
+        Continue appending to an existing segment, discarding an incomplete last record
+        :param strings: the strings of the segment as returned by read_segment
+        :param end: the length of the complete records of the segment
+        """
+        logger.info("Continuing segment %s with %d bytes", self.path, end)
+        self.segment = open(self.path, "r+b", buffering=1024 * 1024)
+        self.segment.truncate(end)
+        self.segment.seek(end)
+        self.ids = {value: stringid for (stringid, value) in enumerate(strings)}
+
+    def _flush_segment(self):
+        """
+        Write the buffered records to the segment file and sync them to disk
+        """
+        self.next_flush = time.monotonic() + self.cfg.sockettimeout
+        self._schedule_rollover()  # follow adjustments of the system clock
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.unflushed_datagrams = 0
+        self.flushes += 1
+
+    def _string_id(self, value, out):
+        """
+        Look up the id of a string in the current segment, appending a string record for new strings
+        :param value: the string
+        :param out: the buffer of records to append the string record to
+        :return: the id of the string
+        """
+        stringid = self.ids.get(value)
+        if stringid is None:
+            stringid = len(self.ids)
+            self.ids[value] = stringid
+            encoded = value.encode("utf-8")
+            out += STRING_RECORD.pack(b"S", len(encoded))
+            out += encoded
+        return stringid
+
+    def _append_deltas(self, deltas):
+        """
+        Append the counter records of a batch of deltas to the segment
+        :param deltas: list of tuples of a delta and the number of datagrams causing it
+        """
+        out = bytearray()
+        for ((tlsrptrecord, entries), n) in deltas:
+            if len(entries) == 0:
+                continue
+            recordid = self._string_id(tlsrptrecord, out)
+            self.policies_processed += n * len(entries)
+            for (domain, policy, sessions, failed, fkeys) in entries:
+                domainid = self._string_id(domain, out)
+                policyid = self._string_id(policy, out)
+                failures = [(self._string_id(reason, out), n * cntr) for (reason, cntr) in fkeys]
+                out += COUNT_RECORD.pack(b"C", domainid, recordid, policyid, n * sessions, n * failed, len(failures))
+                for failure in failures:
+                    out += FAILURE_RECORD.pack(*failure)
+        self.segment.write(out)
+
+    def _schedule_rollover(self):
+        """
+        Set the monotonic deadline of the roll-over to the end of the current UTC day according to the system clock
+        """
+        self.next_rollover = time.monotonic() + tlsrpt_utc_seconds_until_day_end(self.today)
+
+    def seconds_until_rollover(self):
+        return max(0.0, self.next_rollover - time.monotonic())
+
+    def _switch_day_if_due(self):
+        """
+        Switch to the next day if the roll-over deadline passed and the UTC day according to the system clock changed
+        """
+        self._retry_compaction_if_due()
+        if time.monotonic() < self.next_rollover:
+            return
+        if self.today != tlsrpt_utc_date_now():
+            self.switch_to_next_day(RolloverReason.MIDNIGHT)
+        else:  # the system clock was set back, wait for its midnight
+            self._schedule_rollover()
+
+    def _flush_if_due(self, n):
+        """
+        Account for processed datagrams and flush the segment if enough datagrams or time have accumulated
+        :param n: the number of datagrams processed
+        """
+        self.unflushed_datagrams += n
+        if self.unflushed_datagrams >= self.cfg.max_uncommited_datagrams or time.monotonic() >= self.next_flush:
+            self._flush_segment()
+
+    def add_datagram(self, datagram):
+        self.add_datagrams([datagram])
+
+    def add_datagrams(self, datagrams):
+        self._switch_day_if_due()
+        deltas = []
+        for datagram in datagrams:
+            try:
+                deltas.append((self._cached_datagram_delta(datagram), 1))
+            except (KeyError, ValueError) as err:
+                logger.error("%s %s during processing datagram: %s", err.__class__.__name__, str(err), datagram)
+        self._append_deltas(deltas)
+        self._flush_if_due(len(datagrams))
+
+    def add_deltas(self, deltas):
+        self._switch_day_if_due()
+        self._append_deltas(deltas)
+        self._flush_if_due(sum(n for (delta, n) in deltas))
+
+    def socket_timeout(self):
+        self._switch_day_if_due()
+        if self.unflushed_datagrams != 0:
+            self._flush_segment()
+
+    def _compact(self, segment, day):
+        """
+        Compact a segment into the database of the previous day and run the daily rollover script
+        :param segment: the segment file to compact
+        :param day: the day to store the counters under, defaults to the day of the segment
+        """
+        yesterdaydbname = make_yesterday_dbname(self.path)
+        begin = time.monotonic()
+        try:
+            records = compact_segment(segment, yesterdaydbname, self.pragmas, day)
+        except Exception as e:
+            logger.error("Compacting segment %s failed, retrying in %d seconds: %s %s", segment,
+                         COMPACTION_RETRY_INTERVAL, e.__class__.__name__, e)
+            self.next_compaction_retry = time.monotonic() + COMPACTION_RETRY_INTERVAL
+            return
+        self.next_compaction_retry = None
+        logger.info("Compacted %d records of segment %s into %s in %.1f seconds", records, segment, yesterdaydbname,
+                    time.monotonic() - begin)
+        run_daily_rollover_script(self.cfg.daily_rollover_script, self.url, yesterdaydbname)
+
+    def _retry_compaction_if_due(self):
+        """
+        Compact a segment again in the background after its compaction failed
+        """
+        if self.next_compaction_retry is None or time.monotonic() < self.next_compaction_retry:
+            return
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+        self.next_compaction_retry = None
+        if not os.path.exists(make_segment_name(self.path)):
+            return
+        logger.info("Retrying compaction of segment %s", make_segment_name(self.path))
+        self.compaction_thread = threading.Thread(target=self._compact,
+                                                  args=(make_segment_name(self.path), self.compaction_day),
+                                                  name="collectd-compact")
+        self.compaction_thread.start()
+
+    def _keep_failed_segment(self):
+        """
+        Move a segment that could not be compacted out of the way of the next segment to compact, so its data is kept
+        for a manual compaction instead of being overwritten
+        """
+        segment = make_segment_name(self.path)
+        if not os.path.exists(segment):
+            return
+        try:
+            day = read_segment(segment)[0]
+        except Exception as e:  # the segment may be the reason of the failure
+            logger.warning("Could not read the day of segment %s: %s", segment, e)
+            day = time.strftime("unknown-%Y%m%d%H%M%S", time.gmtime())
+        kept = make_failed_segment_name(self.path, day)
+        logger.error("Segment %s of %s could not be compacted, keeping it as %s", segment, day, kept)
+        os.rename(segment, kept)
+        self.next_compaction_retry = None
+
+    def switch_to_next_day(self, rolloverreason):
+        """
+        Start a new segment and compact the segment of the previous day in the background
+        :param rolloverreason: reason for the database rollover
+        """
+        logger.info("Performing segment roll-over, reason %s", rolloverreason.name)
+        begin = time.monotonic()
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self._flush_segment()
+        self.segment.close()
+        self._keep_failed_segment()
+        os.rename(self.path, make_segment_name(self.path))
+        day = None
+        if rolloverreason == RolloverReason.MANUALLYINDUCED:
+            day = str(tlsrpt_utc_date_yesterday())  # move the data of today to yesterday for development
+        self.compaction_day = day
+        self.compaction_thread = threading.Thread(target=self._compact, args=(make_segment_name(self.path), day),
+                                                  name="collectd-compact")
+        self.compaction_thread.start()
+        self.today = tlsrpt_utc_date_now()
+        self._schedule_rollover()
+        self._start_segment()
+        self.last_rollover_stall = time.monotonic() - begin
+        logger.info("Day roll-over blocked processing of datagrams for %.1f ms", self.last_rollover_stall * 1000)
+
+    def statistics(self):
+        return {"policies": self.policies_processed, "flushes": self.flushes,
+                "segment_bytes": self.segment.tell() if self.segment is not None else 0,
+                "last_rollover_us": int(self.last_rollover_stall * 1000000)}
+
+    def close(self):
+        """
+        Wait for a running compaction and close the segment
+        """
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        if self.segment is not None:
+            self.segment.close()
+
+
+class TLSRPTFetcherAppLog(TLSRPTFetcherSQLite):
+    """
+    Fetcher class for the log-structured collectd, reading the database its compaction created
+    """
+    SCHEME = "applog"
+
+    def fetch_day_counts(self, day, since=None):
+        """
+        The counters of the current day are only in the segment until the compaction at the end of the day, so the
+        intraday export is answered with all counters in the database, making reportd fall back to the bulk mode
+        """
+        if since is not None:
+            logger.info("No intraday export from the applog storage, sending the bulk domain counts of %s", day)
+        super().fetch_day_counts(day)
@@ -0,0 +1,121 @@
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+import mmap
+import os
+import struct
+import time
+
+
+class StatsFileException(Exception):
+    pass
+
+
+class StatsFile:
+    """
+    Memory-mapped file publishing named 64 bit counters.
+    The file starts with a header of magic, format version, number of counters and a sequence number, followed by one
+    slot per counter holding its name and value. The writer makes the sequence number odd while updating the values,
+    so readers can detect and retry torn reads without any locking.
+    """
+    MAGIC = b"TLSRPTST"
+    VERSION = 1
+    HEADER = struct.Struct("<8sIIQ")
+    NAME_SIZE = 48
+    SLOT = struct.Struct("<48sQ")
+    VALUE = struct.Struct("<Q")
+    SEQUENCE_OFFSET = 16
+
+    def __init__(self, filename, names):
+        """
+        Create the stats file with all counters set to zero
+        :param filename: the name of the stats file
+        :param names: the names of the counters, at most NAME_SIZE ASCII characters each
+        :raises StatsFileException: if a name is too long, it would be truncated and could collide with another name
+        """
+        self.filename = filename
+        self.names = list(names)
+        for name in self.names:
+            if len(name.encode("ascii")) > self.NAME_SIZE:
+                raise StatsFileException(f"Counter name {name} is longer than {self.NAME_SIZE} characters")
+        self.sequence = 0
+        size = self.HEADER.size + len(self.names) * self.SLOT.size
+        data = bytearray(size)
+        self.HEADER.pack_into(data, 0, self.MAGIC, self.VERSION, len(self.names), self.sequence)
+        for (i, name) in enumerate(self.names):
+            self.SLOT.pack_into(data, self.HEADER.size + i * self.SLOT.size, name.encode("ascii"), 0)
+        # readers must never see a partially initialized file
+        tmpname = filename + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(data)
+        os.rename(tmpname, filename)
+        self.file = open(filename, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.offsets = [self.HEADER.size + i * self.SLOT.size + self.NAME_SIZE for i in range(len(self.names))]
+
+    def update(self, counters):
+        """
+        Publish new values of the counters
+        :param counters: dict of counter names and values, counters missing in the dict are set to zero
+        """
+        self.sequence += 1
+        self.VALUE.pack_into(self.map, self.SEQUENCE_OFFSET, self.sequence)
+        for (name, offset) in zip(self.names, self.offsets):
+            self.VALUE.pack_into(self.map, offset, counters.get(name, 0))
+        self.sequence += 1
+        self.VALUE.pack_into(self.map, self.SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        """
+        Unmap and remove the stats file, so readers do not mistake stale values for live ones
+        """
+        self.map.close()
+        self.file.close()
+        os.remove(self.filename)
+
+
+def read_stats_file(filename, retries=100):
+    """
+    Read the counters of a stats file written by StatsFile
+    :param filename: the name of the stats file
+    :param retries: how often to retry if the values are updated while reading
+    :return: dict of counter names and values in the order of the file
+    :raises StatsFileException: if the file is not a stats file or no consistent values could be read
+    """
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(data) < StatsFile.HEADER.size:
+            raise StatsFileException(f"{filename} is too short for a stats file")
+        (magic, version, count, sequence) = StatsFile.HEADER.unpack_from(data, 0)
+        if magic != StatsFile.MAGIC or version != StatsFile.VERSION:
+            raise StatsFileException(f"{filename} is not a stats file of version {StatsFile.VERSION}")
+        for i in range(retries):
+            (sequence,) = StatsFile.VALUE.unpack_from(data, StatsFile.SEQUENCE_OFFSET)
+            if sequence % 2 == 0:
+                counters = {}
+                for j in range(count):
+                    (name, value) = StatsFile.SLOT.unpack_from(data, StatsFile.HEADER.size + j * StatsFile.SLOT.size)
+                    counters[name.rstrip(b"\0").decode("ascii")] = value
+                if StatsFile.VALUE.unpack_from(data, StatsFile.SEQUENCE_OFFSET)[0] == sequence:
+                    return counters
+            time.sleep(0.001)
+        raise StatsFileException(f"Could not read consistent values from {filename}")
+    finally:
+        data.close()
@@ -17,14 +17,24 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #
 
+import array
+import bisect
 import collections
+import contextlib
 import email.message
 import email.utils
 import gzip
+import heapq
+import io
+import itertools
 import json
 import logging
+import multiprocessing
+import queue
 import random
+import re
 import tempfile
+import time
 from abc import ABCMeta, abstractmethod
 import os
 from pathlib import Path
@@ -32,12 +42,15 @@ from selectors import DefaultSelector, EVENT_READ
 import shutil
 import signal
 import socket
+import struct
 import subprocess
 import sys
 import sqlite3
+import threading
 import urllib.error
 import urllib.parse
 import urllib.request
+import zlib
 import shlex
 from enum import Enum, unique
 
@@ -48,13 +61,24 @@ from tlsrpt_reporter.config import options_from_cmd_env_cfg
 from tlsrpt_reporter import randpool
 from tlsrpt_reporter import plugins
 from tlsrpt_reporter import mapping
+from tlsrpt_reporter.statsfile import StatsFile, StatsFileException
 
 # Constants
 DB_Purpose_Suffix = "-devel-2024-10-28"
 TLSRPT_FETCHER_VERSION_STRING_V1 = "TLSRPT FETCHER v1devel-c domain list"
+TLSRPT_FETCHER_VERSION_STRING_V1_BULK = "TLSRPT FETCHER v1devel-c bulk domain details"
+TLSRPT_FETCHER_VERSION_STRING_V2_BULK = "TLSRPT FETCHER v2devel-c bulk domain counts"
+TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL = "TLSRPT FETCHER v2devel-c incremental domain counts"
+TLSRPT_FETCHER_SESSION_STRING = "TLSRPT FETCHER v1devel-c session"
+# Header line preceding the compressed output of a fetcher, for each supported compression
+TLSRPT_FETCHER_COMPRESSION_STRINGS = {"zlib": "TLSRPT FETCHER v1devel-c zlib"}
 TLSRPT_TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
 TLSRPT_MAX_READ_FETCHER = 16*1024*1024
 TLSRPT_MAX_READ_COLLECTD = 16*1024*1024
+# Datagram protocol versions: one datagram per TLS session or, pre-aggregated by the sender, with session counts
+DATAGRAM_PROTOCOL_VERSION_SINGLE = "1"
+DATAGRAM_PROTOCOL_VERSION_COUNTED = "2"
+DATAGRAM_PROTOCOL_VERSIONS = (DATAGRAM_PROTOCOL_VERSION_SINGLE, DATAGRAM_PROTOCOL_VERSION_COUNTED)
 
 # Exit codes
 EXIT_USAGE = 2  # argparse default
@@ -114,17 +138,32 @@ def setup_daemon_signalhandlers():
 ConfigCollectd = collections.namedtuple("ConfigCollectd",
                                         ['storage',
                                          'socketname',
+                                         'socket_type',
                                          'socketuser',
                                          'socketgroup',
                                          'socketmode',
                                          'sockettimeout',
                                          'max_uncommited_datagrams',
                                          'retry_commit_datagram_count',
+                                         'max_datagrams_per_batch',
+                                         'receive_queue_size',
+                                         'write_queue_size',
+                                         'queue_overflow_policy',
+                                         'storage_overflow_policy',
+                                         'policy_cache_size',
+                                         'datagram_cache_size',
+                                         'datagram_journal',
                                          'pidfilename',
                                          'logfilename',
                                          'log_level',
                                          'daily_rollover_script',
-                                         'dump_path_for_invalid_datagram'])
+                                         'dump_path_for_invalid_datagram',
+                                         'invalid_datagram_samples',
+                                         'invalid_datagram_samples_per_minute',
+                                         'stats_file',
+                                         'shards',
+                                         'handover_socket',
+                                         'handover_timeout'])
 
 
 # Available command line options for the collectd
@@ -132,6 +171,8 @@ options_collectd = {
     "storage": {"type": str, "default": "",
                 "help": "Storage backend, multiple backends separated by comma"},
     "socketname": {"type": str, "default": "", "help": "Name of the unix domain socket to receive data"},
+    "socket_type": {"type": str, "default": "dgram",
+                    "help": "Type of the unix domain socket: dgram, or seqpacket or stream for length-prefixed records"},
     "socketuser": {"type": str, "default": "", "help": "User owning the unix domain socket to receive data"},
     "socketgroup": {"type": str, "default": "", "help": "Group of the unix domain socket to receive data"},
     "socketmode": {"type": str, "default": "", "help": "Permissions of the unix domain in octal, eg 0220"},
@@ -140,11 +181,39 @@ options_collectd = {
                                  "help": "Commit after that many datagrams were received"},
     "retry_commit_datagram_count": {"type": int, "default": 1000,
                                     "help": "Retry commit after that many datagrams more were received"},
+    "max_datagrams_per_batch": {"type": int, "default": 100,
+                                "help": "Maximum number of datagrams read from the socket before processing them"},
+    "receive_queue_size": {"type": int, "default": 100,
+                           "help": "Maximum number of received batches waiting to be parsed"},
+    "write_queue_size": {"type": int, "default": 100,
+                         "help": "Maximum number of parsed batches waiting to be written to the storage backends"},
+    "queue_overflow_policy": {"type": str, "default": "block",
+                              "help": "Action if a queue is full: block to wait or drop to discard the batch"},
+    "storage_overflow_policy": {"type": str, "default": "",
+                                "help": "Comma-separated queue_overflow_policy per storage backend"},
+    "policy_cache_size": {"type": int, "default": 1024,
+                          "help": "Number of serialized policies cached by the SQLite storage, 0 to disable"},
+    "datagram_cache_size": {"type": int, "default": 0,
+                            "help": "Number of raw datagrams whose decoded deltas are cached, 0 to disable"},
+    "datagram_journal": {"type": int, "default": 0,
+                         "help": "Journal uncommitted data of SQLite storages to survive crashes"},
     "pidfilename": {"type": str, "default": "", "help": "PID file name for collectd"},
     "logfilename": {"type": str, "default": "", "help": "Log file name for collectd"},
     "log_level": {"type": str, "default": "warn", "help": "Choose log level: debug, info, warning, error, critical"},
     "daily_rollover_script": {"type": str, "default": "", "help": "Hook script to run after day has changed"},
     "dump_path_for_invalid_datagram": {"type": str, "default": "", "help": "Filename to save an invalid datagram"},
+    "invalid_datagram_samples": {"type": int, "default": 1,
+                                 "help": "Number of files to keep samples of invalid datagrams in"},
+    "invalid_datagram_samples_per_minute": {"type": int, "default": 10,
+                                            "help": "Maximum number of invalid datagrams saved and logged per minute"},
+    "stats_file": {"type": str, "default": "",
+                   "help": "Memory-mapped file to publish live counters in, empty to disable"},
+    "shards": {"type": int, "default": 1,
+               "help": "Number of worker processes each writing its own shard of the storage"},
+    "handover_socket": {"type": str, "default": "",
+                        "help": "Unix domain socket to hand the listening socket over to a restarted collectd"},
+    "handover_timeout": {"type": int, "default": 60,
+                         "help": "Maximum seconds to wait for the running collectd to commit its data on a handover"},
 }
 
 
@@ -152,6 +221,12 @@ ConfigFetcher = collections.namedtuple("ConfigFetcher",
                                        ['storage',
                                         'logfilename',
                                         'log_level',
+                                        'shards',
+                                        'bulk',
+                                        'session',
+                                        'compression',
+                                        'protocol',
+                                        'since',
                                         ])
 
 
@@ -162,12 +237,23 @@ options_fetcher = {
                         "Note: only the first storage will be used to fetch data from!"},
     "logfilename": {"type": str, "default": "", "help": "Log file name for fetcher"},
     "log_level": {"type": str, "default": "warn", "help": "Choose log level: debug, info, warning, error, critical"},
+    "shards": {"type": int, "default": 1, "help": "Number of shards the collectd writes, see its option shards"},
+    "bulk": {"type": int, "default": 0,
+             "help": "Print the details of all domains of the day instead of the domain list, used by reportd"},
+    "session": {"type": int, "default": 0,
+                "help": "Answer requests read from standard input until its end, used by reportd"},
+    "compression": {"type": str, "default": "",
+                    "help": "Compress the output with zlib if set to zlib, used by reportd"},
+    "protocol": {"type": int, "default": 1,
+                 "help": "Protocol version of the bulk mode output, 2 for compact counts, used by reportd"},
+    "since": {"type": str, "default": "",
+              "help": "Only print the counters changed after this checkpoint, also for the current day, used by reportd"},
 }
 
 
 # Positional parameters for the fetcher
 pospars_fetcher = {
-    "day": {"type": str, "nargs": 1, "help": "Day to fetch data for"},
+    "day": {"type": str, "nargs": "?", "help": "Day to fetch data for, omitted in session mode"},
     "domain": {"type": str, "nargs": "?", "help": "Domain to fetch data for, if omitted fetch list of domains"},
 }
 
@@ -181,8 +267,10 @@ ConfigReportd = collections.namedtuple("ConfigReportd",
                                          'debug_send_http_dest',
                                          'debug_send_file_dest',
                                          'dbname',
+                                         'sqlite_pragmas',
                                          'keep_days',
                                          'fetchers',
+                                         'fetcher_compression',
                                          'organization_name',
                                          'contact_info',
                                          'sender_address',
@@ -196,6 +284,7 @@ ConfigReportd = collections.namedtuple("ConfigReportd",
                                          'sendmail_timeout',
                                          'spread_out_delivery',
                                          'interval_main_loop',
+                                         'interval_intraday_export',
                                          'max_collectd_timeout',
                                          'max_collectd_timediff',
                                          'max_retries_delivery',
@@ -221,8 +310,12 @@ options_reportd = {
     "debug_send_file_dest": {"type": str, "default": "",
                              "help": "Save all mail reports to this directory additionally"},
     "dbname": {"type": str, "default": "", "help": "Name of database file"},
+    "sqlite_pragmas": {"type": str, "default": "",
+                       "help": "SQLite settings for the database, e.g. profile=high-throughput"},
     "fetchers": {"type": str, "default": "",
                  "help": "Comma-separated list of fetchers to collect data"},
+    "fetcher_compression": {"type": str, "default": "zlib",
+                            "help": "Compression of the fetcher output, empty to transfer it uncompressed"},
     "organization_name": {"type": str, "default": "",
                           "help": "The name of the organization sending out the TLSRPT reports"},
     "contact_info": {"type": str, "default": "", "help": "The contact information of the sending organization"},
@@ -240,6 +333,9 @@ options_reportd = {
     "spread_out_delivery": {"type": int, "default": 36000,
                             "help": "Time range in seconds to spread out report delivery"},
     "interval_main_loop": {"type": int, "default": 300, "help": "Maximum sleep interval in main loop"},
+    "interval_intraday_export": {"type": int, "default": 0,
+                                 "help": "Interval in seconds to pull the changed counters of the current day, 0 to "
+                                         "disable"},
     "max_collectd_timeout": {"type": int, "default": 10, "help": "Maximum expected collectd timeout"},
     "max_collectd_timediff": {"type": int, "default": 10, "help": "Maximum expected collectd time difference"},
     "max_retries_delivery": {"type": int, "default": 5, "help": "Maximum attempts to deliver a report"},
@@ -313,7 +409,11 @@ class PidFile:
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
             if self.filename != "":
-                os.remove(self.filename)
+                with open(self.filename) as fd:
+                    pid = fd.read().strip()
+                # after a socket handover the new collectd has already written its own pid
+                if pid == str(os.getpid()):
+                    os.remove(self.filename)
         except Exception as e:
             logger.warning("Error while removing pid-file %s: %s", self.filename, e)
 
@@ -334,6 +434,53 @@ class TLSRPTCollectd(metaclass=ABCMeta):
         """
         pass
 
+    def add_datagrams(self, datagrams):
+        """
+        Process a batch of received datagrams.
+        Implementations can override this to perform per-batch work like day and commit checks only once.
+        :param datagrams: list of datagrams received e.g. from the tlsrpt library
+        """
+        for datagram in datagrams:
+            try:
+                self.add_datagram(datagram)
+            except (KeyError, ValueError) as err:
+                logger.error("%s %s during processing datagram: %s", err.__class__.__name__, str(err),
+                             json.dumps(datagram))
+
+    def datagram_delta(self, datagram):
+        """
+        Compute the changes a received datagram causes to this storage backend, independent of the day it arrives.
+        Identical raw datagrams cause identical deltas, so the pipeline caches them to skip decoding repeated payloads.
+        Called from the parse thread, so implementations must not touch state used by the writer thread.
+        Backends not supporting deltas keep this default and get the decoded datagrams via add_datagrams.
+        :param datagram: datagram received e.g. from the tlsrpt library, must not be modified
+        :return: the delta to be passed to add_deltas or None if deltas are not supported
+        """
+        return None
+
+    def checked_datagram_delta(self, datagram):
+        """
+        Compute the delta like datagram_delta and report whether the datagram passed the checks of this backend.
+        The pipeline caches the result, so it can report repeated datagrams that failed the checks.
+        :param datagram: datagram received e.g. from the tlsrpt library, must not be modified
+        :return: tuple of the delta and False if a check failed and was logged
+        """
+        return self.datagram_delta(datagram), True
+
+    def add_deltas(self, deltas):
+        """
+        Apply a batch of deltas as returned by datagram_delta
+        :param deltas: list of tuples of a delta and the number of datagrams causing it
+        """
+        raise NotImplementedError("Storage backend does not support deltas")
+
+    def seconds_until_rollover(self):
+        """
+        Time left until the day roll-over is due, so the writer thread can wake up for it in time
+        :return: the number of seconds or None if this backend has no roll-over deadline
+        """
+        return None
+
     @abstractmethod
     def socket_timeout(self):
         """
@@ -349,6 +496,21 @@ class TLSRPTCollectd(metaclass=ABCMeta):
         """
         pass
 
+    def statistics(self):
+        """
+        Report counters of this storage backend to be published in the stats file.
+        Called from the main thread, so implementations must only read plain values updated by the writer thread.
+        The keys must be the same on every call because the layout of the stats file is fixed at startup.
+        :return: dict of counter names and non-negative integer values
+        """
+        return {}
+
+    def close(self):
+        """
+        Release the resources of this storage backend during shutdown, after the final socket timeout
+        """
+        pass
+
     @staticmethod
     def factory(url: str, config: ConfigCollectd):
         cls = plugins.get_plugin("tlsrpt.collectd", url)
@@ -380,15 +542,124 @@ class DummyCollectd(TLSRPTCollectd):
             logger.info("Dummy collectd got socket timeout")
 
 
+# Settings that can be tuned via the query string of sqlite: storage URLs and the reportd option sqlite_pragmas
+SQLITE_PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout")
+# Settings stored in the database file itself, which the fetcher leaves to the collectd writing the database
+SQLITE_PERSISTENT_PRAGMAS = ("journal_mode",)
+# Schemes of the storage URLs whose query string holds SQLite settings
+SQLITE_PRAGMA_SCHEMES = ("sqlite", "applog")
+
+# Predefined sets of settings selected with profile=name
+SQLITE_PRAGMA_PROFILES = {
+    "default": {},
+    "high-throughput": {"journal_mode": "WAL",  # readers do not block the writer and commits append to the log
+                        "synchronous": "NORMAL",  # no fsync per commit, durable at checkpoints
+                        "cache_size": "-65536",  # 64 MiB page cache
+                        "mmap_size": "268435456",  # 256 MiB memory mapped I/O
+                        "temp_store": "MEMORY",
+                        "busy_timeout": "5000"},  # wait up to 5 seconds for locks instead of failing
+}
+
+
+def parse_sqlite_pragmas(query: str):
+    """
+    Parse SQLite settings given in URL query string syntax, e.g. "profile=high-throughput&synchronous=FULL".
+    Settings given explicitly override the settings of a profile.
+    :param query: the query string
+    :return: dict of pragma names and values
+    :raises ValueError: on unknown profiles, unknown settings or invalid values
+    """
+    profile = {}
+    pragmas = {}
+    for (k, v) in urllib.parse.parse_qsl(query, keep_blank_values=True):
+        if k == "profile":
+            if v not in SQLITE_PRAGMA_PROFILES:
+                raise ValueError(f"Unknown SQLite profile '{v}'")
+            profile = SQLITE_PRAGMA_PROFILES[v]
+        elif k in SQLITE_PRAGMAS:
+            # values are inserted into the PRAGMA statement and can not be bound as parameters
+            if not re.fullmatch(r"-?\w+", v):
+                raise ValueError(f"Invalid value '{v}' for SQLite setting {k}")
+            pragmas[k] = v
+        else:
+            raise ValueError(f"Unknown SQLite setting '{k}'")
+    result = dict(profile)
+    result.update(pragmas)
+    return result
+
+
+def check_storage_sqlite_pragmas(urls):
+    """
+    Validate and log the SQLite settings in the query strings of storage URLs before the storage backends are opened
+    :param urls: list of storage URLs
+    :return: True if the settings of all URLs are valid, False after logging an error otherwise
+    """
+    for url in urls:
+        parsed = urllib.parse.urlparse(urllib.parse.unquote(url))
+        if parsed.scheme not in SQLITE_PRAGMA_SCHEMES:
+            continue
+        try:
+            pragmas = parse_sqlite_pragmas(parsed.query)
+        except ValueError as e:
+            logger.error("Invalid SQLite settings in storage URL '%s': %s", url, e)
+            return False
+        logger.info("Storage %s uses SQLite settings %s", parsed.path,
+                    ", ".join("%s=%s" % setting for setting in pragmas.items()) if pragmas else "default")
+    return True
+
+
+def remove_sqlite_database(dbname):
+    """
+    Remove an SQLite database file together with its WAL and shared memory files
+    :param dbname: the name of the database file
+    """
+    for filename in (dbname, dbname + "-wal", dbname + "-shm"):
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def run_daily_rollover_script(script, url, yesterdaydbname):
+    """
+    Start the hook script configured to run after the day roll-over of a storage backend
+    :param script: the script with optional arguments, nothing is started if it is empty
+    :param url: the URL of the storage backend, passed as additional argument
+    :param yesterdaydbname: the database holding the data of the previous day, passed as last argument
+    """
+    if script is not None and script != "":
+        try:
+            args = script.split()
+            args.append(url)
+            args.append(yesterdaydbname)
+            logger.info("Starting daily rollover script '%s'", args)
+            subprocess.Popen(args)
+        except Exception as e:
+            logger.error("Unexpected problem while starting daily rollover script '%s': %s", script, e)
+
+
 class VersionedSQLite(metaclass=ABCMeta):
     """
     Abstract base class for versioned SQLite databases
     """
-    def __init__(self, dbname):
+    def __init__(self, dbname, pragmas=None):
+        """
+        :param dbname: the name of the database file
+        :param pragmas: dict of SQLite settings to apply to each connection, see parse_sqlite_pragmas
+        """
         self.dbname = dbname
+        self.pragmas = pragmas if pragmas is not None else {}
         logger.debug("Try to open database '%s'", self.dbname)
-        self.con = sqlite3.connect("file:///"+self.dbname, uri=True)
+        self._connect()
+
+    def _connect(self):
+        """
+        Open the database connection, apply the configured settings and create the default cursor
+        """
+        # collectd opens its databases on the main thread and hands them over to its writer thread
+        self.con = sqlite3.connect("file:///"+self.dbname, uri=True, check_same_thread=False)
         self.cur = self.con.cursor()
+        for (k, v) in self.pragmas.items():
+            self.cur.execute(f"PRAGMA {k}={v}")
+            logger.debug("Database '%s' setting %s=%s", self.dbname, k, self.cur.fetchone())
 
     def _setup_database(self):
         """
@@ -418,9 +689,11 @@ class VersionedSQLite(metaclass=ABCMeta):
             if purpose != self._db_purpose():
                 logger.error("Database has wrong purpose, expected %s but got %s", self._db_purpose(), purpose)
                 sys.exit(EXIT_WRONG_DB_VERSION)
-            if version != 1:
-                logger.error("Database has wrong version, expected 1 but got %s", version)
-                sys.exit(EXIT_WRONG_DB_VERSION)
+            if version != self._db_version():
+                if version not in self._migrations() or version > self._db_version():
+                    logger.error("Database has wrong version, expected %s but got %s", self._db_version(), version)
+                    sys.exit(EXIT_WRONG_DB_VERSION)
+                self._migrate_database(version)
             # test if database is read-write
             try:
                 tmp_writetest = "tmp_writetest"
@@ -435,6 +708,28 @@ class VersionedSQLite(metaclass=ABCMeta):
             logger.info("Database check failed: %s", err)
             return False
 
+    def _migrate_database(self, version):
+        """
+        Migrate the database step by step from an older version to the current version.
+        Each step runs in its own transaction, a failed step terminates the whole program execution.
+        :param version: the version of the existing database
+        """
+        migrations = self._migrations()
+        while version != self._db_version():
+            logger.info("Migrating database '%s' from version %d to version %d", self.dbname, version, version + 1)
+            try:
+                self.cur.execute("BEGIN")
+                for statement in migrations[version]:
+                    logger.debug("DDL %s", statement)
+                    self.cur.execute(statement)
+                self.cur.execute("UPDATE dbversion SET version=? WHERE purpose=?", (version + 1, self._db_purpose()))
+                self.con.commit()
+            except Exception as err:
+                logger.error("Database '%s' migration to version %d failed: %s", self.dbname, version + 1, err)
+                self.con.rollback()
+                sys.exit(EXIT_DB_SETUP_FAILURE)
+            version += 1
+
     @abstractmethod
     def _ddl(self):
         """
@@ -443,6 +738,20 @@ class VersionedSQLite(metaclass=ABCMeta):
         """
         pass
 
+    def _db_version(self):
+        """
+        Defines the current version of the database structure created by _ddl
+        :return: the version number
+        """
+        return 1
+
+    def _migrations(self):
+        """
+        Defines how to migrate databases created by older versions
+        :return: a dict mapping a version to the statements migrating the database from this version to the next one
+        """
+        return {}
+
     @abstractmethod
     def _db_purpose(self):
         """
@@ -453,23 +762,405 @@ class VersionedSQLite(metaclass=ABCMeta):
 
 
 class VersionedSQLiteCollectdBase(VersionedSQLite):
-    def __init__(self, dbname):
-        super().__init__(dbname)
+    """
+    The collectd database.
+    Since version 2 domains, TLSRPT records, policies and failure reasons are stored once in dictionary tables and
+    referenced by integer ids from the counter tables.
+    Since version 3 each commit increments a change sequence and stores it in the counters it changed, so the fetcher
+    can export the counters changed since a checkpoint. A random database id tells the databases of different days
+    apart. Counters written before the migration keep sequence number 0 and are exported by the first export.
+    """
+    def __init__(self, dbname, pragmas=None):
+        # Write-behind cache of counter deltas, written to the database by _flush_pending
+        self.pending_finalresults = {}  # (day, domain, tlsrptrecord, policy) -> [cntrtotal, cntrfailure]
+        self.pending_failures = {}  # (day, domain, tlsrptrecord, policy, reason) -> cntr
+        self._reset_id_caches()
+        super().__init__(dbname, pragmas)
     def _db_purpose(self):
         return "TLSRPT-Collectd-DB" + DB_Purpose_Suffix
 
+    def _db_version(self):
+        return 3
+
+    @staticmethod
+    def _ddl_v2_tables():
+        return ["CREATE TABLE domains(domain_id INTEGER PRIMARY KEY, domain TEXT NOT NULL UNIQUE)",
+                "CREATE TABLE tlsrptrecords(tlsrptrecord_id INTEGER PRIMARY KEY, tlsrptrecord TEXT NOT NULL UNIQUE)",
+                "CREATE TABLE policies(policy_id INTEGER PRIMARY KEY, policy TEXT NOT NULL UNIQUE)",
+                "CREATE TABLE reasons(reason_id INTEGER PRIMARY KEY, reason TEXT NOT NULL UNIQUE)",
+                "CREATE TABLE finalresults(day, domain_id INTEGER, tlsrptrecord_id INTEGER, policy_id INTEGER, "
+                "cntrtotal, cntrfailure, its datetime default CURRENT_TIMESTAMP, "
+                "PRIMARY KEY(day, domain_id, tlsrptrecord_id, policy_id)) WITHOUT ROWID",
+                "CREATE TABLE failures(day, domain_id INTEGER, tlsrptrecord_id INTEGER, policy_id INTEGER, "
+                "reason_id INTEGER, cntr, "
+                "PRIMARY KEY(day, domain_id, tlsrptrecord_id, policy_id, reason_id)) WITHOUT ROWID",
+                "CREATE TABLE domainsperday(day, domain_id INTEGER, PRIMARY KEY(day, domain_id)) WITHOUT ROWID"]
+
+    @staticmethod
+    def _ddl_v3_changes():
+        # no index on seq, it would be updated with every counter while the export only scans the rows of one day
+        return ["ALTER TABLE finalresults ADD COLUMN seq INTEGER NOT NULL DEFAULT 0",
+                "ALTER TABLE failures ADD COLUMN seq INTEGER NOT NULL DEFAULT 0",
+                "CREATE TABLE changeseq(dbid TEXT NOT NULL, seq INTEGER NOT NULL)",
+                "INSERT INTO changeseq(dbid, seq) VALUES(lower(hex(randomblob(8))), 0)"]
+
     def _ddl(self):
-        return ["CREATE TABLE finalresults(day, domain, tlsrptrecord, policy, cntrtotal, cntrfailure, its datetime default CURRENT_TIMESTAMP,"
-                "PRIMARY KEY(day, domain, tlsrptrecord, policy))",
-                "CREATE TABLE failures(day, domain, tlsrptrecord, policy, reason, cntr, "
-                "PRIMARY KEY(day, domain, tlsrptrecord, policy, reason))",
+        return self._ddl_v2_tables() + self._ddl_v3_changes() + [
                 "CREATE TABLE daystatus(daycomplete, its datetime default CURRENT_TIMESTAMP, PRIMARY KEY(daycomplete))",
                 "CREATE TABLE dbversion(version, installdate, purpose)",
                 "INSERT INTO dbversion(version, installdate, purpose) "
-                " VALUES(1,strftime('%Y-%m-%d %H-%M-%f','now'),'"+self._db_purpose()+"')"]
+                " VALUES("+str(self._db_version())+",strftime('%Y-%m-%d %H-%M-%f','now'),'"+self._db_purpose()+"')"]
+
+    def _migrations(self):
+        # version 1 stored the strings directly in the counter tables
+        v1_to_v2 = ["ALTER TABLE finalresults RENAME TO finalresults_v1",
+                    "ALTER TABLE failures RENAME TO failures_v1"] + self._ddl_v2_tables() + [
+                    "INSERT INTO domains(domain) SELECT domain FROM finalresults_v1 "
+                    "UNION SELECT domain FROM failures_v1",
+                    "INSERT INTO tlsrptrecords(tlsrptrecord) SELECT tlsrptrecord FROM finalresults_v1 "
+                    "UNION SELECT tlsrptrecord FROM failures_v1",
+                    "INSERT INTO policies(policy) SELECT policy FROM finalresults_v1 "
+                    "UNION SELECT policy FROM failures_v1",
+                    "INSERT INTO reasons(reason) SELECT DISTINCT reason FROM failures_v1",
+                    "INSERT INTO finalresults(day, domain_id, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure, its) "
+                    "SELECT day, domain_id, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure, its "
+                    "FROM finalresults_v1 JOIN domains USING(domain) JOIN tlsrptrecords USING(tlsrptrecord) "
+                    "JOIN policies USING(policy)",
+                    "INSERT INTO failures(day, domain_id, tlsrptrecord_id, policy_id, reason_id, cntr) "
+                    "SELECT day, domain_id, tlsrptrecord_id, policy_id, reason_id, cntr "
+                    "FROM failures_v1 JOIN domains USING(domain) JOIN tlsrptrecords USING(tlsrptrecord) "
+                    "JOIN policies USING(policy) JOIN reasons USING(reason)",
+                    "INSERT INTO domainsperday(day, domain_id) SELECT DISTINCT day, domain_id FROM finalresults",
+                    "DROP TABLE finalresults_v1",
+                    "DROP TABLE failures_v1"]
+        return {1: v1_to_v2, 2: self._ddl_v3_changes()}
+
+    @staticmethod
+    def _canonical_mapping(rows):
+        """
+        Group JSON strings by their canonical form
+        :param rows: iterable of (id, JSON string)
+        :return: tuple of a dict mapping ids of duplicates to the id they are merged into and
+                 a dict mapping ids to be kept to their new canonical string
+        """
+        groups = {}
+        for (rowid, value) in rows:
+            groups.setdefault(canonical_json(json.loads(value)), []).append((rowid, value))
+        idmap = {}
+        rename = {}
+        for (canonical, members) in groups.items():
+            # keep the row already in canonical form if there is one, otherwise the oldest row
+            (targetid, targetvalue) = min(members, key=lambda m: (m[1] != canonical, m[0]))
+            for (rowid, value) in members:
+                if rowid != targetid:
+                    idmap[rowid] = targetid
+            if targetvalue != canonical:
+                rename[targetid] = canonical
+        return idmap, rename
+
+    def compact(self):
+        """
+        Merge policies and failure reasons that only differ in their JSON serialization, e.g. the order of keys,
+        into one row with the canonical serialization and sum up their counters.
+        Must not run on a database currently written by collectd because collectd caches the ids.
+        :return: tuple of the number of counter rows before and after compaction
+        """
+        self.cur.execute("SELECT (SELECT COUNT(*) FROM finalresults) + (SELECT COUNT(*) FROM failures)")
+        (before,) = self.cur.fetchone()
+        self.cur.execute("SELECT policy_id, policy FROM policies")
+        (policymap, policyrename) = self._canonical_mapping(self.cur.fetchall())
+        self.cur.execute("SELECT reason_id, reason FROM reasons")
+        (reasonmap, reasonrename) = self._canonical_mapping(self.cur.fetchall())
+        self.cur.execute("CREATE TEMP TABLE policymap(old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+        self.cur.execute("CREATE TEMP TABLE reasonmap(old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+        self.cur.executemany("INSERT INTO policymap VALUES(?,?)", policymap.items())
+        self.cur.executemany("INSERT INTO reasonmap VALUES(?,?)", reasonmap.items())
+        self.cur.execute("INSERT INTO finalresults (day, domain_id, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure) "
+                         "SELECT day, domain_id, tlsrptrecord_id, new_id, SUM(cntrtotal), SUM(cntrfailure) "
+                         "FROM finalresults JOIN policymap ON policy_id=old_id WHERE true "
+                         "GROUP BY day, domain_id, tlsrptrecord_id, new_id "
+                         "ON CONFLICT(day, domain_id, tlsrptrecord_id, policy_id) "
+                         "DO UPDATE SET cntrtotal=cntrtotal+excluded.cntrtotal, "
+                         "cntrfailure=cntrfailure+excluded.cntrfailure")
+        self.cur.execute("DELETE FROM finalresults WHERE policy_id IN (SELECT old_id FROM policymap)")
+        self.cur.execute("INSERT INTO failures (day, domain_id, tlsrptrecord_id, policy_id, reason_id, cntr) "
+                         "SELECT day, domain_id, tlsrptrecord_id, COALESCE(p.new_id, policy_id), "
+                         "COALESCE(r.new_id, reason_id), SUM(cntr) "
+                         "FROM failures LEFT JOIN policymap AS p ON policy_id=p.old_id "
+                         "LEFT JOIN reasonmap AS r ON reason_id=r.old_id "
+                         "WHERE p.new_id IS NOT NULL OR r.new_id IS NOT NULL "
+                         "GROUP BY 1, 2, 3, 4, 5 "
+                         "ON CONFLICT(day, domain_id, tlsrptrecord_id, policy_id, reason_id) "
+                         "DO UPDATE SET cntr=cntr+excluded.cntr")
+        self.cur.execute("DELETE FROM failures WHERE policy_id IN (SELECT old_id FROM policymap) "
+                         "OR reason_id IN (SELECT old_id FROM reasonmap)")
+        self.cur.execute("DELETE FROM policies WHERE policy_id IN (SELECT old_id FROM policymap)")
+        self.cur.execute("DELETE FROM reasons WHERE reason_id IN (SELECT old_id FROM reasonmap)")
+        self.cur.executemany("UPDATE policies SET policy=? WHERE policy_id=?",
+                             [(v, k) for (k, v) in policyrename.items()])
+        self.cur.executemany("UPDATE reasons SET reason=? WHERE reason_id=?",
+                             [(v, k) for (k, v) in reasonrename.items()])
+        self.cur.execute("DROP TABLE policymap")
+        self.cur.execute("DROP TABLE reasonmap")
+        self.cur.execute("SELECT (SELECT COUNT(*) FROM finalresults) + (SELECT COUNT(*) FROM failures)")
+        (after,) = self.cur.fetchone()
+        self.con.commit()
+        return before, after
+
+    def _reset_id_caches(self):
+        """
+        Forget the ids of the dictionary tables, e.g. after switching to a new database
+        """
+        self.ids = {"domains": {}, "tlsrptrecords": {}, "policies": {}, "reasons": {}}
+        self.domainsperday = set()  # (day, domain_id) known to be in table domainsperday
+
+    def _intern(self, table, column, value):
+        """
+        Look up the id of a string in one of the dictionary tables, inserting it if it is not there yet
+        :param table: the dictionary table
+        :param column: the column holding the string
+        :param value: the string
+        :return: the id of the string
+        """
+        cache = self.ids[table]
+        valueid = cache.get(value)
+        if valueid is None:
+            self.cur.execute(f"INSERT INTO {table}({column}) VALUES(?) ON CONFLICT({column}) DO NOTHING", (value,))
+            self.cur.execute(f"SELECT {column}_id FROM {table} WHERE {column}=?", (value,))
+            valueid = self.cur.fetchone()[0]
+            cache[value] = valueid
+        return valueid
+
+    def _key_ids(self, day, domain, tlsrptrecord, policy):
+        """
+        Map a counter key to the ids of its strings
+        :return: tuple of day, domain_id, tlsrptrecord_id and policy_id
+        """
+        return (day, self._intern("domains", "domain", domain),
+                self._intern("tlsrptrecords", "tlsrptrecord", tlsrptrecord),
+                self._intern("policies", "policy", policy))
+
+    def _flush_pending(self):
+        """
+        Write the accumulated counter deltas to the database with one batched upsert per table.
+        The caches are kept until the caller committed the transaction, so after a failed flush or commit the
+        transaction can be rolled back and the deltas written again with the next commit.
+        The changed counters are marked with the next value of the change sequence.
+        """
+        if len(self.pending_finalresults) == 0 and len(self.pending_failures) == 0:
+            return
+        self.cur.execute("UPDATE changeseq SET seq=seq+1")
+        self.cur.execute("SELECT seq FROM changeseq")
+        (seq,) = self.cur.fetchone()
+        if len(self.pending_finalresults) != 0:
+            rows = []
+            newdomainsperday = set()
+            for (key, (cntrtotal, cntrfailure)) in self.pending_finalresults.items():
+                keyids = self._key_ids(*key)
+                rows.append(keyids + (cntrtotal, cntrfailure, seq))
+                if keyids[:2] not in self.domainsperday:
+                    newdomainsperday.add(keyids[:2])
+            self.cur.executemany(
+                "INSERT INTO finalresults (day, domain_id, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure, seq) "
+                "VALUES(?,?,?,?,?,?,?) "
+                "ON CONFLICT(day, domain_id, tlsrptrecord_id, policy_id) "
+                "DO UPDATE SET cntrtotal=cntrtotal+excluded.cntrtotal, cntrfailure=cntrfailure+excluded.cntrfailure, "
+                "seq=excluded.seq",
+                rows)
+            self.cur.executemany("INSERT INTO domainsperday (day, domain_id) VALUES(?,?) "
+                                 "ON CONFLICT(day, domain_id) DO NOTHING", newdomainsperday)
+            self.domainsperday.update(newdomainsperday)
+        if len(self.pending_failures) != 0:
+            rows = []
+            for (key, cntr) in self.pending_failures.items():
+                rows.append(self._key_ids(*key[:4]) + (self._intern("reasons", "reason", key[4]), cntr, seq))
+            self.cur.executemany(
+                "INSERT INTO failures (day, domain_id, tlsrptrecord_id, policy_id, reason_id, cntr, seq) "
+                "VALUES(?,?,?,?,?,?,?) "
+                "ON CONFLICT(day, domain_id, tlsrptrecord_id, policy_id, reason_id) "
+                "DO UPDATE SET cntr=cntr+excluded.cntr, seq=excluded.seq",
+                rows)
+
+
+class DatagramJournal:
+    """
+    Append-only journal of the data a collectd storage backend accumulated since its last commit.
+    Each batch is appended as one line and synced to disk before it is processed, so the data of a crash or of a
+    hanging commit can be replayed on the next start. The lines carry the generation of the journal: a commit
+    stores the next generation in the database within the same transaction and then truncates the journal, so
+    lines of a generation smaller than the one stored in the database are already committed.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: the name of the journal file
+        """
+        self.filename = filename
+        self.file = open(filename, "ab")
+
+    def append(self, generation, day, deltas):
+        """
+        Append a batch to the journal and sync it to disk
+        :param generation: the current generation of the journal
+        :param day: the day the datagrams were received
+        :param deltas: list of tuples of a delta and the number of datagrams causing it
+        """
+        self.file.write(json.dumps([generation, day, deltas], separators=(",", ":")).encode() + b"\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def read(self):
+        """
+        Read the batches in the journal, a partially written last line is skipped
+        :return: generator of tuples of generation, day and deltas
+        """
+        with open(self.filename, "rb") as f:
+            for line in f:
+                try:
+                    (generation, day, deltas) = json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping incomplete line in journal %s", self.filename)
+                    continue
+                yield generation, day, deltas
+
+    def truncate(self):
+        """
+        Remove all batches from the journal
+        """
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class DatagramSerializer:
+    """
+    Serialization of received datagrams into the deltas of the collectd database layout, shared by the storage
+    backends writing that layout. Requires a policy_cache attribute holding an LRUCache.
+    """
+    def _policy_entry(self, dpv, domain, policy):
+        """
+        Serialize one of the policies found in the received datagram, using the policy cache
+        :param dpv: the datagram protocol version
+        :param domain: The domain this report entry will be about
+        :param policy: the policy dict
+        :return: tuple of normalized domain, serialized policy, session count, failed session count and tuples of
+                 serialized failure details and their counts
+        """
+        # Policies of the same shape repeat over and over, so their serialization is cached.
+        # The key covers all fields of the policy including the failure details.
+        cachekey = (dpv, domain, repr(policy))
+        entry = self.policy_cache.get(cachekey)
+        if entry is None:
+            (entry, failure_count_ok) = self._serialize_policy(domain, policy, dpv)
+            if failure_count_ok:  # do not cache erroneous policies, so each of them gets logged
+                self.policy_cache.put(cachekey, entry)
+        return entry
+
+    @staticmethod
+    def _serialize_policy(domain, policy, dpv=DATAGRAM_PROTOCOL_VERSION_SINGLE):
+        """
+        Normalize the domain and serialize a policy and its failure details as stored in the database
+        :param domain: The domain this report entry will be about
+        :param policy: the policy dict, it is not modified
+        :param dpv: the datagram protocol version, version 2 adds session counts to policies and failure details
+        :return: tuple of the tuple of normalized domain, serialized policy, session count, failed session count and
+                 tuples of serialized failure details and their counts, and whether the failure count matches the
+                 failure details
+        """
+        # Normalize domain name
+        normalized_domain = normalize_domain_name(domain)
+        if normalized_domain != domain:
+            logger.debug("Normalized domain name '%s' to '%s'", domain, normalized_domain)
+            domain = normalized_domain
+        # Remove unneeded keys from a copy of the policy before writing to database, keeping needed values
+        policy = dict(policy)
+        policy_failed = policy.pop("f")  # final result: boolean for one session or number of failed sessions
+        failures = policy.pop("failure-details", [])  # the failures encountered
+        failure_count = policy.pop("t", None)  # number of failures
+        sessions = 1
+        fkeys = []
+        if dpv == DATAGRAM_PROTOCOL_VERSION_COUNTED:
+            # pre-aggregated by the sender: "cnt" sessions, "cnt" occurrences of each failure detail
+            sessions = policy.pop("cnt", 1)
+            if isinstance(sessions, bool) or not isinstance(sessions, int) or sessions < 1:
+                raise ValueError(f"Invalid session count {sessions}")
+            if isinstance(policy_failed, bool) or not isinstance(policy_failed, int) or \
+                    not 0 <= policy_failed <= sessions:
+                raise ValueError(f"Invalid failed session count {policy_failed} for {sessions} sessions")
+            for f in failures:
+                f = dict(f)
+                cntr = f.pop("cnt", 1)
+                if isinstance(cntr, bool) or not isinstance(cntr, int) or cntr < 1:
+                    raise ValueError(f"Invalid failure count {cntr}")
+                fkeys.append((canonical_json(f), cntr))
+        else:
+            fkeys = [(canonical_json(f), 1) for f in failures]
+        detail_count = sum(cntr for (f, cntr) in fkeys)
+        failure_count_ok = failure_count == detail_count
+        if not failure_count_ok:
+            logger.error("Failure count mismatch in received datagram: %d reported versus %d failured details: %s",
+                         failure_count, detail_count, json.dumps(failures))
+        return (domain, canonical_json(policy), sessions, int(policy_failed), tuple(fkeys)), failure_count_ok
+
+    @staticmethod
+    def _check_datagram(datagram):
+        """
+        Check the protocol version of a received datagram
+        :param datagram: The received datagram
+        :return: the datagram protocol version to process the datagram with or None if it contains no policies
+        """
+        if "policies" not in datagram:
+            logger.warning("No policies found in datagram: %s", datagram)
+            return None
+        if "dpv" not in datagram:
+            logger.debug("No datagram protocol version found in datagram: %s", datagram)
+        elif datagram["dpv"] in DATAGRAM_PROTOCOL_VERSIONS:
+            return datagram["dpv"]
+        else:
+            logger.error("Wrong datagram protocol version: Expected one of %s but got '%s' in datagram: %s",
+                         DATAGRAM_PROTOCOL_VERSIONS, datagram["dpv"], datagram)
+        return DATAGRAM_PROTOCOL_VERSION_SINGLE
+
+    def _cached_datagram_delta(self, datagram):
+        """
+        Serialize all policies of a datagram using the policy cache
+        :param datagram: The received datagram
+        :return: tuple of the TLSRPT record and the serialized policies like datagram_delta
+        """
+        dpv = self._check_datagram(datagram)
+        if dpv is None:
+            return None, ()
+        # serialize all policies before counting any of them, so an invalid policy does not count partially
+        return datagram["pr"], tuple(self._policy_entry(dpv, datagram["d"], policy)
+                                     for policy in datagram["policies"])
+
+    def datagram_delta(self, datagram):
+        """
+        Serialize all policies of a datagram without touching the database or the policy cache.
+        This is thread-safe, so the pipeline can compute and cache the delta in its parse stage.
+        :param datagram: The received datagram, it is not modified
+        :return: tuple of the TLSRPT record and the serialized policies
+        """
+        return self.checked_datagram_delta(datagram)[0]
+
+    def checked_datagram_delta(self, datagram):
+        dpv = self._check_datagram(datagram)
+        if dpv is None:
+            return (None, ()), False
+        ok = "dpv" not in datagram or datagram["dpv"] in DATAGRAM_PROTOCOL_VERSIONS
+        entries = []
+        for policy in datagram["policies"]:
+            (entry, failure_count_ok) = self._serialize_policy(datagram["d"], policy, dpv)
+            entries.append(entry)
+            ok = ok and failure_count_ok
+        return (datagram["pr"], tuple(entries)), ok
+
 
+class TLSRPTCollectdSQLite(DatagramSerializer, TLSRPTCollectd, VersionedSQLiteCollectdBase):
+    # upper bounds of the buckets of the commit latency histogram in milliseconds, slower commits go to a last bucket
+    COMMIT_LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
 
-class TLSRPTCollectdSQLite(TLSRPTCollectd, VersionedSQLiteCollectdBase):
     def __init__(self, url: str, config: ConfigCollectd):
         """
         :url str: URL defining the parameters for this reciever instance
@@ -482,19 +1173,41 @@ class TLSRPTCollectdSQLite(TLSRPTCollectd, VersionedSQLiteCollectdBase):
         self.cfg = config
         self.url = url
         self.today = tlsrpt_utc_date_now()
+        # Commit and roll-over are due at deadlines on the monotonic clock, so checking them is a plain comparison
+        self.next_rollover = 0.0
+        self._schedule_rollover()
         self.uncommitted_datagrams = 0
         self.total_datagrams_read = 0
-        super().__init__(parsed.path)
+        self.policy_cache = LRUCache(self.cfg.policy_cache_size)  # (domain, raw policy) -> serialized policy
+        # The empty database for the next day is prepared in the background to keep the roll-over short
+        self.next_db_thread = None
+        self.next_db_ready = False
+        self.max_rollover_stall = 0.0
+        self.last_rollover_stall = 0.0
+        # Counters published via statistics()
+        self.policies_processed = 0
+        self.commits = 0
+        self.failed_commits = 0
+        self.commit_latency_histogram = [0] * (len(self.COMMIT_LATENCY_BUCKETS_MS) + 1)
+        # The journal holds the data accumulated since the last commit, see DatagramJournal
+        self.journal = None
+        self.journal_generation = 0
+        super().__init__(parsed.path, parse_sqlite_pragmas(parsed.query))
         if self._check_database():
             logger.info("Database %s looks OK", self.dbname)
         else:
             logger.info("Create new database %s", self.dbname)
             self._setup_database()
             self.switch_to_next_day(RolloverReason.INITIALIZE)  # prepare yesterday´s DB as well
+        if self.next_db_thread is None:
+            self._start_next_database_preparation()
 
         # Settings for flushing to disk
         self.commitEveryN = self.cfg.max_uncommited_datagrams
-        self.next_commit = tlsrpt_utc_time_now()
+        self.commit_at_datagrams = self.commitEveryN
+        self.next_commit = time.monotonic()
+        if self.cfg.datagram_journal:
+            self._replay_journal()
 
     def switch_to_next_day(self, rolloverreason):
         """
@@ -508,6 +1221,9 @@ class TLSRPTCollectdSQLite(TLSRPTCollectd, VersionedSQLiteCollectdBase):
         elif rolloverreason == RolloverReason.INITIALIZE:
             commit_message = commit_message + " FOR INITIALIZATION"
         logger.info("Performing %s", commit_message)
+        begin = time.monotonic()
+        logger.info("Policy cache: %d hits, %d misses, %d of %d entries used", self.policy_cache.hits,
+                    self.policy_cache.misses, len(self.policy_cache), self.policy_cache.maxsize)
 
         if rolloverreason == RolloverReason.MANUALLYINDUCED:
             self.con.set_trace_callback(print)  # show updates in this development-only if-branch
@@ -516,9 +1232,14 @@ class TLSRPTCollectdSQLite(TLSRPTCollectd, VersionedSQLiteCollectdBase):
             logger.debug("Updated %d rows in finalresults", self.cur.rowcount)
             self.cur.execute("UPDATE failures SET day=? WHERE day=?", (yesterday, self.today))
             logger.debug("Updated %d rows in failuredetails", self.cur.rowcount)
+            self.cur.execute("UPDATE domainsperday SET day=? WHERE day=?", (yesterday, self.today))
+            logger.debug("Updated %d rows in domainsperday", self.cur.rowcount)
             self.con.commit()
 
         self._db_commit(commit_message)
+        if self.uncommitted_datagrams != 0:
+            # the commit failed, make a last attempt to save the pending deltas together with the day status
+            self._flush_pending()
         # check for dangling day status
         self.cur.execute("SELECT daycomplete FROM daystatus")
         alldata = self.cur.fetchall()
@@ -532,33 +1253,134 @@ class TLSRPTCollectdSQLite(TLSRPTCollectd, VersionedSQLiteCollectdBase):
         # set day status
         self.cur.execute("INSERT INTO daystatus (daycomplete)  VALUES(?)", (yesterday, ))
         self.con.commit()
+        self.pending_finalresults = {}
+        self.pending_failures = {}
+        if self.uncommitted_datagrams != 0:
+            logger.warning("Saved %d uncommitted datagrams with the day status", self.uncommitted_datagrams)
+            self.uncommitted_datagrams = 0
+            if self.journal is not None:
+                self.journal.truncate()
         self.cur.close()
         self.con.close()
         yesterdaydbname = make_yesterday_dbname(self.dbname)
-        if os.path.isfile(yesterdaydbname):
-            os.remove(yesterdaydbname)
+        remove_sqlite_database(yesterdaydbname)
         os.rename(self.dbname, yesterdaydbname)
         # start new day
         self.today = tlsrpt_utc_date_now()
-        logger.info("Old database moved to %s, create new database %s", yesterdaydbname, self.dbname)
-        self.con = sqlite3.connect("file:///"+self.dbname, uri=True)
-        self.cur = self.con.cursor()
+        self._schedule_rollover()
+        precreated = self._use_next_database()
+        if precreated:
+            logger.info("Old database moved to %s, using pre-created database %s", yesterdaydbname, self.dbname)
+        else:
+            logger.info("Old database moved to %s, create new database %s", yesterdaydbname, self.dbname)
+        self._connect()
+        self._reset_id_caches()
+        self.journal_generation = 0  # the journal was truncated by the commit above, the new database starts at 0
         self.total_datagrams_read = 0
         if self.uncommitted_datagrams != 0:
             logger.error("%d uncommitted datagrams during day roll-over", self.uncommitted_datagrams)
             self.uncommitted_datagrams = 0
-        self._setup_database()
+        if not precreated:
+            self._setup_database()
+        stall = time.monotonic() - begin
+        self.last_rollover_stall = stall
+        self.max_rollover_stall = max(self.max_rollover_stall, stall)
+        logger.info("Day roll-over blocked processing of datagrams for %.1f ms (maximum %.1f ms)", stall * 1000,
+                    self.max_rollover_stall * 1000)
+        self._start_next_database_preparation()
         # finally start hook script
-        script = self.cfg.daily_rollover_script
-        if script is not None and script != "":
+        run_daily_rollover_script(self.cfg.daily_rollover_script, self.url, yesterdaydbname)
+
+    def statistics(self):
+        counters = {"policies": self.policies_processed, "commits": self.commits,
+                    "failed_commits": self.failed_commits,
+                    "last_rollover_us": int(self.last_rollover_stall * 1000000),
+                    "max_rollover_us": int(self.max_rollover_stall * 1000000)}
+        for (limit, count) in zip(self.COMMIT_LATENCY_BUCKETS_MS, self.commit_latency_histogram):
+            counters["commit_latency_le_%dms" % limit] = count
+        counters["commit_latency_gt_%dms" % self.COMMIT_LATENCY_BUCKETS_MS[-1]] = self.commit_latency_histogram[-1]
+        return counters
+
+    def close(self):
+        """
+        Wait for the preparation of the next day's database and close the database connection and the journal
+        """
+        if self.next_db_thread is not None:
+            self.next_db_thread.join()
+        self.con.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _replay_journal(self):
+        """
+        Open the journal and add the data not committed before the last shutdown or crash to the database
+        """
+        self.journal = DatagramJournal(make_journal_name(self.dbname))
+        self.cur.execute("PRAGMA user_version")
+        (self.journal_generation,) = self.cur.fetchone()
+        replayed = 0
+        for (generation, day, deltas) in self.journal.read():
+            if generation < self.journal_generation:
+                continue  # already committed, the journal was not truncated after the commit
+            day = datetime.date.fromisoformat(day)
+            for ((tlsrptrecord, entries), n) in deltas:
+                for entry in entries:
+                    self._count_policy(day, tlsrptrecord, entry, n)
+                replayed += n
+        if replayed == 0:
+            self.journal.truncate()
+            return
+        logger.warning("Replaying %d uncommitted datagrams from journal %s", replayed, self.journal.filename)
+        self.uncommitted_datagrams += replayed
+        self._db_commit("Database commit after journal replay")
+
+    def _start_next_database_preparation(self):
+        """
+        Start preparing the empty database for the next day in a background thread
+        """
+        self.next_db_ready = False
+        self.next_db_thread = threading.Thread(target=self._prepare_next_database, name="collectd-nextdb", daemon=True)
+        self.next_db_thread.start()
+
+    def _prepare_next_database(self):
+        """
+        Create and validate the empty database for the next day.
+        Runs in a background thread and only touches the file of the next day's database.
+        """
+        nextdbname = make_next_dbname(self.dbname)
+        try:
+            remove_sqlite_database(nextdbname)
+            nextdb = VersionedSQLiteCollectdBase(nextdbname, self.pragmas)
             try:
-                args = script.split()
-                args.append(self.url)
-                args.append(yesterdaydbname)
-                logger.info("Starting daily rollover script '%s'", args)
-                subprocess.Popen(args)
-            except Exception as e:
-                logger.error("Unexpected problem while starting daily rollover script '%s': %s", script, e)
+                for ddlstatement in nextdb._ddl():
+                    nextdb.cur.execute(ddlstatement)
+                nextdb.con.commit()
+                nextdb.cur.execute("SELECT version, purpose FROM dbversion")
+                if nextdb.cur.fetchall() != [(nextdb._db_version(), nextdb._db_purpose())]:
+                    raise Exception("unexpected version information")
+            finally:
+                nextdb.con.close()
+            self.next_db_ready = True
+            logger.debug("Prepared database %s for the next day", nextdbname)
+        except Exception as e:
+            logger.warning("Preparing database %s for the next day failed: %s", nextdbname, e)
+
+    def _use_next_database(self):
+        """
+        Move the database prepared for the next day into place
+        :return: True if the prepared database is used, False if a new database needs to be set up
+        """
+        if self.next_db_thread is not None:
+            self.next_db_thread.join()
+        if not self.next_db_ready:
+            return False
+        self.next_db_ready = False
+        try:
+            os.rename(make_next_dbname(self.dbname), self.dbname)
+            return True
+        except OSError as e:
+            logger.warning("Could not use database prepared for the next day: %s", e)
+            return False
 
     def _db_commit(self, reason):
         """
@@ -569,96 +1391,145 @@ class TLSRPTCollectdSQLite(TLSRPTCollectd, VersionedSQLiteCollectdBase):
         try:
             # adjust next_commit now BEFORE the actual commit might fail!
             # This way we avoid retrying it after each datagram and wasting too much time blocking in timeouts
-            self.next_commit = tlsrpt_utc_time_now() + datetime.timedelta(seconds=self.cfg.sockettimeout)
+            self.next_commit = time.monotonic() + self.cfg.sockettimeout
+            # follow adjustments of the system clock at least once per sockettimeout
+            self._schedule_rollover()
             if self.uncommitted_datagrams == 0:
                 return  # do not perform unneeded commits and do not flood debug logs
+            begin = time.monotonic()
+            self._flush_pending()
+            if self.journal is not None:
+                # mark the journal entries written so far as committed within the same transaction
+                self.cur.execute(f"PRAGMA user_version={self.journal_generation + 1}")
             self.con.commit()
-            logger.debug("%s with %d datagrams (%d total)", reason, self.uncommitted_datagrams,
-                         self.total_datagrams_read)
+            self.pending_finalresults = {}
+            self.pending_failures = {}
+            latency_ms = (time.monotonic() - begin) * 1000
+            self.commit_latency_histogram[bisect.bisect_left(self.COMMIT_LATENCY_BUCKETS_MS, latency_ms)] += 1
+            self.commits += 1
+            if self.journal is not None:
+                self.journal.truncate()
+                self.journal_generation += 1
+            logger.debug("%s with %d datagrams (%d total), policy cache %d hits %d misses %d entries", reason,
+                         self.uncommitted_datagrams, self.total_datagrams_read, self.policy_cache.hits,
+                         self.policy_cache.misses, len(self.policy_cache))
             self.uncommitted_datagrams = 0
+            self.commit_at_datagrams = self.commitEveryN
         except sqlite3.OperationalError as e:
             logger.error("Failed %s with %d datagrams: %s", reason, self.uncommitted_datagrams, e)
+            self.failed_commits += 1
+            if self.con.in_transaction:
+                # undo the partial flush, the pending deltas are written again by the next commit
+                try:
+                    self.con.rollback()
+                except sqlite3.Error as err:
+                    logger.error("Failed rollback after failed commit: %s", err)
+            self._reset_id_caches()  # ids inserted by the rolled back transaction are gone
+            # a database problem can cause a commit-attempt to hang
+            # do not retry after each additional datagram but wait for more data to accumulate before retrying
+            self.commit_at_datagrams = self.uncommitted_datagrams + self.cfg.retry_commit_datagram_count
 
     def timed_commit(self):
         self._db_commit("Database commit due to timeout")
 
     def commit_after_n_datagrams(self):
-        if tlsrpt_utc_time_now() > self.next_commit:
+        if time.monotonic() >= self.next_commit:
             self._db_commit("Database commit due to overdue")
-        if self.uncommitted_datagrams >= self.commitEveryN:
-            # a database problem can cause a commit-attempt to hang
-            # do not retry after each additional datagram but wait for more data to accumulate before retrying
-            if (self.uncommitted_datagrams-self.commitEveryN) % self.cfg.retry_commit_datagram_count == 0:
-                self._db_commit("Database commit")
+        if self.uncommitted_datagrams >= self.commit_at_datagrams:
+            self._db_commit("Database commit")
 
-    def _add_policy(self, day, domain, tlsrptrecord, policy):
+    def _count_policy(self, day, tlsrptrecord, entry, n=1):
         """
-        Process one of the policies found in the received datagram
+        Accumulate the counters of a serialized policy
         :param day: The day this datagram was received
-        :param domain: The domain this report entry will be about
         :param tlsrptrecord: The tlsrpt DNS record
-        :param policy: the policy dict
+        :param entry: the serialized policy as returned by _serialize_policy
+        :param n: the number of identical policies to count
         """
-        # Normalize domain name
-        normalized_domain = normalize_domain_name(domain)
-        if normalized_domain != domain:
-            logger.debug("Normalized domain name '%s' to '%s'", domain, normalized_domain)
-            domain = normalized_domain
-        # Remove unneeded keys from policy before writing to database, keeping needed values
-        policy_failed = policy.pop("f")  # boolean defining success or failure as final result
-        failures = policy.pop("failure-details", [])  # the failures encountered
-        failure_count = policy.pop("t", None)  # number of failures
-        if failure_count != len(failures):
-            logger.error("Failure count mismatch in received datagram: %d reported versus %d failured details: %s",
-                         failure_count, len(failures), json.dumps(failures))
-        p = json.dumps(policy)
-        self.cur.execute(
-            "INSERT INTO finalresults (day, domain, tlsrptrecord, policy, cntrtotal, cntrfailure) VALUES(?,?,?,?,1,?) "
-            "ON CONFLICT(day, domain, tlsrptrecord, policy) "
-            "DO UPDATE SET cntrtotal=cntrtotal+1, cntrfailure=cntrfailure+?",
-            (day, domain, tlsrptrecord, p, policy_failed, policy_failed))
-
-        for f in failures:
-            self.cur.execute(
-                "INSERT INTO failures (day, domain, tlsrptrecord, policy, reason, cntr) VALUES(?,?,?,?,?,1) "
-                "ON CONFLICT(day, domain, tlsrptrecord, policy, reason) "
-                "DO UPDATE SET cntr=cntr+1",
-                (day, domain, tlsrptrecord, p, json.dumps(f)))
-
-    def _add_policies_from_datagram(self, day, datagram):
-        """
-        Process the policies found in the received datagram
-        :param day: The day this datagram was received
-        :param datagram: The received datagram
+        (domain, p, sessions, failed, fkeys) = entry
+        # Only accumulate the counter deltas here, they are written to the database in _db_commit
+        key = (day, domain, tlsrptrecord, p)
+        counters = self.pending_finalresults.get(key)
+        if counters is None:
+            self.pending_finalresults[key] = [n * sessions, n * failed]
+        else:
+            counters[0] += n * sessions
+            counters[1] += n * failed
+
+        for (f, cntr) in fkeys:
+            fkey = key + (f,)
+            self.pending_failures[fkey] = self.pending_failures.get(fkey, 0) + n * cntr
+
+    def _apply_deltas(self, day, deltas):
         """
-        if "policies" not in datagram:
-            logger.warning("No policies found in datagram: %s", datagram)
-            return
-        if "dpv" not in datagram:
-            logger.debug("No datagram protocol version found in datagram: %s", datagram)
-        elif datagram["dpv"] != "1":
-            logger.error("Wrong datagram protocol version: Expected '1' but got '%s' in datagram: %s", datagram["dpv"], datagram)
-        for policy in datagram["policies"]:
-            self._add_policy(day, datagram["d"], datagram["pr"], policy)
+        Append deltas to the journal if it is enabled and accumulate their counters
+        :param day: The day the datagrams were received
+        :param deltas: list of tuples of a delta and the number of datagrams causing it
+        """
+        if self.journal is not None and len(deltas) != 0:
+            self.journal.append(self.journal_generation, str(day), deltas)
+        for ((tlsrptrecord, entries), n) in deltas:
+            self.policies_processed += n * len(entries)
+            for entry in entries:
+                self._count_policy(day, tlsrptrecord, entry, n)
 
     def add_datagram(self, datagram):
-        # process the datagram
-        datenow = tlsrpt_utc_date_now()
-        if self.today != datenow:
+        self.add_datagrams([datagram])
+
+    def _schedule_rollover(self):
+        """
+        Set the monotonic deadline of the roll-over to the end of the current UTC day according to the system clock
+        """
+        self.next_rollover = time.monotonic() + tlsrpt_utc_seconds_until_day_end(self.today)
+
+    def seconds_until_rollover(self):
+        return max(0.0, self.next_rollover - time.monotonic())
+
+    def _switch_day_if_due(self):
+        """
+        Switch to the next day if the roll-over deadline passed and the UTC day according to the system clock changed.
+        The deadline is recomputed on every commit, so adjustments of the system clock delay the roll-over by at most
+        one sockettimeout.
+        """
+        if time.monotonic() < self.next_rollover:
+            return
+        if self.today != tlsrpt_utc_date_now():
             self.switch_to_next_day(RolloverReason.MIDNIGHT)
-        self._add_policies_from_datagram(datenow, datagram)
+        else:  # the system clock was set back, wait for its midnight
+            self._schedule_rollover()
+
+    def add_datagrams(self, datagrams):
+        # check for day change only once per batch
+        self._switch_day_if_due()
+        # process the datagrams
+        deltas = []
+        for datagram in datagrams:
+            try:
+                deltas.append((self._cached_datagram_delta(datagram), 1))
+            except (KeyError, ValueError) as err:
+                logger.error("%s %s during processing datagram: %s", err.__class__.__name__, str(err),
+                             json.dumps(datagram))
+            self.uncommitted_datagrams += 1
+            self.total_datagrams_read += 1
+        self._apply_deltas(self.today, deltas)
+        # database maintenance
+        self.commit_after_n_datagrams()
+
+    def add_deltas(self, deltas):
+        # check for day change only once per batch
+        self._switch_day_if_due()
+        self._apply_deltas(self.today, deltas)
+        for (delta, n) in deltas:
+            self.uncommitted_datagrams += n
+            self.total_datagrams_read += n
         # database maintenance
-        self.uncommitted_datagrams += 1
-        self.total_datagrams_read += 1
         self.commit_after_n_datagrams()
 
     def socket_timeout(self):
         """
         Commit database to disk periodically
         """
-        datenow = tlsrpt_utc_date_now()
-        if self.today != datenow:
-            self.switch_to_next_day(RolloverReason.MIDNIGHT)
+        self._switch_day_if_due()
         self.timed_commit()
 
 
@@ -687,6 +1558,31 @@ class TLSRPTFetcher(metaclass=ABCMeta):
         """
         pass
 
+    def fetch_day_details(self, day):
+        """
+        Print out report details for all domains on a specific day, one JSON object per line
+        :param day: The day for which to print the report details
+        :raises NotImplementedError: if the fetcher implementation only supports fetching domain by domain
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support bulk mode")
+
+    def fetch_day_counts(self, day, since=None):
+        """
+        Print out the counters of all domains on a specific day in the compact format of protocol version 2
+        :param day: The day for which to print the counters
+        :param since: None to print all counters of a completed day or the checkpoint printed by a previous export
+                      of the same day, "0" for the first one, to print only the domains changed since then
+        :raises NotImplementedError: if the fetcher implementation does not support protocol version 2 or the
+                                     intraday export
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support protocol version 2")
+
+    def refresh(self):
+        """
+        Prepare for the next request of a session, e.g. pick up data the collectd rolled over since the last request
+        """
+        pass
+
     @staticmethod
     def factory(url: str, config: ConfigFetcher):
         if url.startswith("sqlite:"):  # fast path for default implementation
@@ -699,23 +1595,80 @@ class TLSRPTFetcherSQLite(TLSRPTFetcher, VersionedSQLiteCollectdBase):
     """
     Fetcher class for SQLite collectd
     """
+    SCHEME = "sqlite"  # scheme of the storage URLs, subclasses reading the same database layout use their own
+
     def __init__(self, url: str, config: ConfigFetcher):
         """
         :url str: URL defining the parameters for this fetcher instance
         :type config: ConfigFetcher
         """
         parsed = urllib.parse.urlparse(urllib.parse.unquote(url))
-        if parsed.scheme != "sqlite":
+        if parsed.scheme != self.SCHEME:
             raise Exception(f"{self.__class__.__name__} can not be instantiated from '{url}'")
 
         self.cfg = config
+        self.path = parsed.path
         self.uncommitted_datagrams = 0
         self.total_datagrams_read = 0
-        super().__init__(make_yesterday_dbname(parsed.path))
-        if self._check_database():
-            logger.info("Database %s looks OK", self.dbname)
+        pragmas = parse_sqlite_pragmas(parsed.query)
+        for k in SQLITE_PERSISTENT_PRAGMAS:
+            if pragmas.pop(k, None) is not None:
+                logger.debug("Ignoring SQLite setting %s of the collectd databases", k)
+        if config.shards < 1:
+            raise Exception(f"Invalid number of shards {config.shards}, must be at least 1")
+        if config.shards == 1:
+            super().__init__(make_yesterday_dbname(parsed.path), pragmas)
+            self.databases = [self]
         else:
-            raise Exception(f"DB check failed for database {self.dbname}")
+            # this instance reads the first shard, the other shards are read via additional connections
+            super().__init__(make_yesterday_dbname(make_shard_name(parsed.path, 0)), pragmas)
+            self.databases = [self] + [VersionedSQLiteCollectdBase(
+                make_yesterday_dbname(make_shard_name(parsed.path, index)), pragmas)
+                for index in range(1, config.shards)]
+        for database in self.databases:
+            if database._check_database():
+                logger.info("Database %s looks OK", database.dbname)
+            else:
+                raise Exception(f"DB check failed for database {database.dbname}")
+            database.inode = os.stat(database.dbname).st_ino
+
+    def refresh(self):
+        """
+        Reopen the databases replaced by a day roll-over of the collectd since they were opened
+        """
+        for database in self.databases:
+            try:
+                inode = os.stat(database.dbname).st_ino
+            except FileNotFoundError:
+                continue  # in the middle of a roll-over, keep the old database until the new one appears
+            if inode != database.inode:
+                logger.info("Reopening database %s replaced by a day roll-over", database.dbname)
+                database.con.close()
+                database._connect()
+                if not database._check_database():
+                    raise Exception(f"DB check failed for database {database.dbname}")
+                database.inode = inode
+
+    def _print_header(self, versionstring):
+        """
+        Print the protocol header
+        :param versionstring: the protocol version of the following data
+        """
+        # protocol header line 1: the protocol version
+        print(versionstring)
+        # line 2: current time so fetching can be rescheduled to account for clock offset, or warn about too big delay
+        print(tlsrpt_utc_time_now().strftime(TLSRPT_TIMEFORMAT))
+        # line 3: available day, the shards roll over independently so a day is only complete once all shards are
+        daycomplete = None
+        for database in self.databases:
+            dlcursor = database.con.cursor()
+            dlcursor.execute("SELECT daycomplete FROM daystatus")
+            row = dlcursor.fetchone()
+            if row is not None and (daycomplete is None or row[0] < daycomplete):
+                daycomplete = row[0]
+            dlcursor.close()
+        if daycomplete is not None:
+            print(daycomplete)
 
     def fetch_domain_list(self, day):
         """
@@ -723,22 +1676,17 @@ class TLSRPTFetcherSQLite(TLSRPTFetcher, VersionedSQLiteCollectdBase):
         :param day: The day for which to create a report
         """
         logger.info("TLSRPT fetcher domain list starting for day %s", day)
-        # protocol header line 1: the protocol version
-        print(TLSRPT_FETCHER_VERSION_STRING_V1)
-        # line 2: current time so fetching can be rescheduled to account for clock offset, or warn about too big delay
-        print(tlsrpt_utc_time_now().strftime(TLSRPT_TIMEFORMAT))
-        # line 3: available day
-        dlcursor = self.con.cursor()
-        dlcursor.execute("SELECT daycomplete FROM daystatus")
-        alldata = dlcursor.fetchall()
-        for row in alldata:
-            print(row[0])
-            break
+        self._print_header(TLSRPT_FETCHER_VERSION_STRING_V1)
+        domains = {}  # domains of all shards in order of first occurrence
+        for database in self.databases:
+            dlcursor = database.con.cursor()
+            dlcursor.execute("SELECT domain FROM domainsperday JOIN domains USING(domain_id) WHERE day=?", (day,))
+            for row in dlcursor.fetchall():
+                domains[row] = True
+            dlcursor.close()
         # protocol header finished
         # send domains
-        dlcursor.execute("SELECT DISTINCT domain FROM finalresults WHERE day=?", (day,))
-        alldata = dlcursor.fetchall()
-        dlcursor.close()
+        alldata = list(domains)
         linenumber = 0
         for row in alldata:
             try:
@@ -758,26 +1706,592 @@ class TLSRPTFetcherSQLite(TLSRPTFetcher, VersionedSQLiteCollectdBase):
         """
         logger.info("TLSRPT fetcher domain details starting for day %s and domain %s", day, domain)
         policies = {}
-        dlcursor = self.con.cursor()
-        dlcursor.execute("SELECT domain, policy, tlsrptrecord, cntrtotal, cntrfailure "
-                         "FROM finalresults WHERE day=? AND domain=?",
-                         (day, domain))
-        for (domain, policy, tlsrptrecord, cntrtotal, cntrfailure) in dlcursor:
+        # the counters of all shards are summed up
+        for database in self.databases:
+            dlcursor = database.con.cursor()
+            dlcursor.execute("SELECT tlsrptrecord, policy, cntrtotal, cntrfailure "
+                             "FROM finalresults JOIN domains USING(domain_id) "
+                             "JOIN tlsrptrecords USING(tlsrptrecord_id) JOIN policies USING(policy_id) "
+                             "WHERE day=? AND domain=?",
+                             (day, domain))
+            results = dlcursor.fetchall()
+            dlcursor.execute("SELECT tlsrptrecord, policy, reason, cntr "
+                             "FROM failures JOIN domains USING(domain_id) JOIN tlsrptrecords USING(tlsrptrecord_id) "
+                             "JOIN policies USING(policy_id) JOIN reasons USING(reason_id) WHERE day=? AND domain=?",
+                             (day, domain))
+            self._add_details(policies, results, dlcursor)
+            dlcursor.close()
+        details = {"d": domain, "policies": policies}
+        print(json.dumps(details, indent=4))
+
+    @staticmethod
+    def _add_details(policies, results, failures):
+        """
+        Sum up the counters of a domain
+        :param policies: dict of TLSRPT records, policies and their counters to add to
+        :param results: iterable of tuples of TLSRPT record, policy, total and failed sessions
+        :param failures: iterable of tuples of TLSRPT record, policy, failure reason and count
+        """
+        for (tlsrptrecord, policy, cntrtotal, cntrfailure) in results:
             if tlsrptrecord not in policies:  # need to create new dict entry
                 policies[tlsrptrecord] = {}
             if policy not in policies[tlsrptrecord]:  # need to create new dict entry
                 policies[tlsrptrecord][policy] = {"cntrtotal": 0, "cntrfailure": 0, "failures": {}}
             policies[tlsrptrecord][policy]["cntrtotal"] += cntrtotal
             policies[tlsrptrecord][policy]["cntrfailure"] += cntrfailure
-
-        dlcursor.execute("SELECT tlsrptrecord, policy, reason, cntr FROM failures WHERE day=? AND domain=?",
-                         (day, domain))
-        for (tlsrptrecord, policy, reason, cntr) in dlcursor:
+        for (tlsrptrecord, policy, reason, cntr) in failures:
             if reason not in policies[tlsrptrecord][policy]["failures"]:  # need to create new dict entry
                 policies[tlsrptrecord][policy]["failures"][reason] = 0
             policies[tlsrptrecord][policy]["failures"][reason] += cntr
-        details = {"d": domain, "policies": policies}
-        print(json.dumps(details, indent=4))
+
+    # Queries for the results and failures of a day, with the TLSRPT records, policies and reasons as strings
+    DAY_DETAILS_QUERIES = ("SELECT domain, tlsrptrecord, policy, cntrtotal, cntrfailure "
+                           "FROM finalresults JOIN domains USING(domain_id) "
+                           "JOIN tlsrptrecords USING(tlsrptrecord_id) JOIN policies USING(policy_id) "
+                           "WHERE day=? ORDER BY domain",
+                           "SELECT domain, tlsrptrecord, policy, reason, cntr "
+                           "FROM failures JOIN domains USING(domain_id) JOIN tlsrptrecords USING(tlsrptrecord_id) "
+                           "JOIN policies USING(policy_id) JOIN reasons USING(reason_id) WHERE day=? ORDER BY domain")
+    # The same queries with the ids of the TLSRPT records, policies and reasons in the database
+    DAY_COUNTS_QUERIES = ("SELECT domain, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure "
+                          "FROM finalresults JOIN domains USING(domain_id) WHERE day=? ORDER BY domain",
+                          "SELECT domain, tlsrptrecord_id, policy_id, reason_id, cntr "
+                          "FROM failures JOIN domains USING(domain_id) WHERE day=? ORDER BY domain")
+    # Condition selecting the domains with counters changed after a value of the change sequence
+    CHANGED_DOMAINS = "domain_id IN (SELECT domain_id FROM finalresults WHERE day=? AND seq>?)"
+    # The queries of all counters of the domains changed after a value of the change sequence
+    DAY_CHANGES_QUERIES = ("SELECT domain, tlsrptrecord_id, policy_id, cntrtotal, cntrfailure "
+                           "FROM finalresults JOIN domains USING(domain_id) WHERE day=? AND " + CHANGED_DOMAINS +
+                           " ORDER BY domain",
+                           "SELECT domain, tlsrptrecord_id, policy_id, reason_id, cntr "
+                           "FROM failures JOIN domains USING(domain_id) WHERE day=? AND " + CHANGED_DOMAINS +
+                           " ORDER BY domain")
+
+    @staticmethod
+    def _day_details(database, day, queries=DAY_DETAILS_QUERIES, since=None):
+        """
+        Read the counters of all domains of a day from one database
+        :param database: the database to read
+        :param day: the day to read
+        :param queries: the queries for the results and the failures, DAY_DETAILS_QUERIES, DAY_COUNTS_QUERIES or
+                        DAY_CHANGES_QUERIES
+        :param since: the value of the change sequence for DAY_CHANGES_QUERIES
+        :return: generator of tuples of domain, list of results and list of failures, ordered by domain
+        """
+        parameters = (day,) if since is None else (day, day, since)
+        rcursor = database.con.cursor()
+        rcursor.execute(queries[0], parameters)
+        fcursor = database.con.cursor()
+        fcursor.execute(queries[1], parameters)
+        # both queries are ordered by domain and failures only exist for domains with results
+        failuregroups = itertools.groupby(fcursor, key=lambda row: row[0])
+        failuregroup = next(failuregroups, None)
+        for (domain, rows) in itertools.groupby(rcursor, key=lambda row: row[0]):
+            failures = []
+            while failuregroup is not None and failuregroup[0] < domain:  # failures without results are ignored
+                failuregroup = next(failuregroups, None)
+            if failuregroup is not None and failuregroup[0] == domain:
+                failures = [row[1:] for row in failuregroup[1]]
+                failuregroup = next(failuregroups, None)
+            yield domain, [row[1:] for row in rows], failures
+        rcursor.close()
+        fcursor.close()
+
+    def fetch_day_details(self, day):
+        """
+        Print out report details for all domains on a specific day, one JSON object per line
+        :param day: The day for which to print the report details
+        """
+        logger.info("TLSRPT fetcher bulk domain details starting for day %s", day)
+        duration = Duration()
+        self._print_header(TLSRPT_FETCHER_VERSION_STRING_V1_BULK)
+        # merge the domains of all shards, the counters of a domain found in several shards are summed up
+        streams = [self._day_details(database, day) for database in self.databases]
+        dc = 0  # domain count
+        for (domain, group) in itertools.groupby(heapq.merge(*streams, key=lambda entry: entry[0]),
+                                                 key=lambda entry: entry[0]):
+            policies = {}
+            for (_, results, failures) in group:
+                self._add_details(policies, results, failures)
+            try:
+                print(json.dumps({"d": domain, "policies": policies}))
+            except BrokenPipeError as err:
+                logger.warning("Error when writing details of domain %d: %s", dc + 1, err)
+                return
+            dc += 1
+        # terminate the details with a single dot
+        print(".")
+        duration.add(dc)
+        logger.info("Printing details of %d domains took %s, %s domains per second", dc, duration.time(),
+                    duration.rate())
+
+    def _day_counts(self, dictionary, database, day, since=None):
+        """
+        Read the counters of all domains of a day from one database, referring to the TLSRPT records, policies and
+        reasons by their ids in the stream
+        :param dictionary: the FetcherDictionary of the stream
+        :param database: the database to read
+        :param day: the day to read
+        :param since: None to read all domains or a value of the change sequence to read the domains changed after it
+        :return: generator of tuples of domain, list of results and list of failures, ordered by domain
+        """
+        (records, policies, reasons) = dictionary.stream_ids(database, day, since)
+        queries = self.DAY_COUNTS_QUERIES if since is None else self.DAY_CHANGES_QUERIES
+        for (domain, results, failures) in self._day_details(database, day, queries, since):
+            yield (domain,
+                   [(records[r], policies[p], total, failure) for (r, p, total, failure) in results],
+                   [(records[r], policies[p], reasons[f], cntr) for (r, p, f, cntr) in failures])
+
+    def _current_day_database(self, shard):
+        """
+        Open the database the collectd is currently writing
+        :param shard: the index of the shard
+        :return: ReadOnlyCollectdDatabase
+        """
+        path = self.path if self.cfg.shards == 1 else make_shard_name(self.path, shard)
+        return ReadOnlyCollectdDatabase(path)
+
+    def _close_current_day_databases(self, databases):
+        """
+        Close the databases opened by _current_day_database
+        :param databases: the databases read by an export
+        """
+        for database in databases:
+            if database not in self.databases:
+                database.con.close()
+
+    @staticmethod
+    def _holds_completed_day(database, day):
+        """
+        Check if a database of yesterday holds a day, either because the day is complete or because data of the day
+        is in it
+        :param database: the database of yesterday of a shard
+        :param day: the day to export
+        :return: True if the day is exported from this database
+        """
+        cur = database.con.cursor()
+        cur.execute("SELECT 1 FROM daystatus WHERE daycomplete>=? "
+                    "UNION ALL SELECT 1 FROM domainsperday WHERE day=? LIMIT 1", (day, day))
+        result = cur.fetchone() is not None
+        cur.close()
+        return result
+
+    def _incremental_databases(self, day, since):
+        """
+        Find the databases holding a day for an export of the counters changed since a checkpoint.
+        Until the roll-over at the end of the day this is the database the collectd is currently writing.
+        :param day: the day to export
+        :param since: the checkpoint of the previous export of the day, a comma-separated list of the database id and
+                      the value of the change sequence of each shard, separated by a colon, or "0" for the first export
+        :return: tuple of the list of databases, the list of values of their change sequences to export the changes
+                 after, the checkpoint for the next export and True if the checkpoint belongs to other databases and
+                 all counters of the day are exported again, or None if the database the collectd is currently
+                 writing holds another day already or could not be read, e.g. because the collectd locked it
+        :raises ValueError: if the checkpoint is invalid
+        :raises NotImplementedError: if a database does not support the intraday export
+        """
+        if since == "0":
+            previous = None
+        else:
+            previous = [value.split(":") for value in since.split(",")]
+            if len(previous) != len(self.databases) or any(len(position) != 2 for position in previous):
+                raise ValueError(f"Checkpoint {since} does not match {len(self.databases)} shards")
+            previous = [(dbid, int(seq)) for (dbid, seq) in previous]
+        databases = []
+        positions = []
+        try:
+            for (shard, database) in enumerate(self.databases):
+                if not self._holds_completed_day(database, day):
+                    database = self._current_day_database(shard)
+                    databases.append(database)
+                    cur = database.con.cursor()
+                    cur.execute("SELECT 1 FROM domainsperday WHERE day<>? LIMIT 1", (day,))
+                    if cur.fetchone() is not None:  # rolled over before the database of yesterday was replaced
+                        logger.warning("Database %s does not hold day %s anymore", database.dbname, day)
+                        self._close_current_day_databases(databases)
+                        return None
+                else:
+                    databases.append(database)
+                    cur = database.con.cursor()
+                # the checkpoint is read before the counters: changes committed in between are exported again
+                cur.execute("SELECT dbid, seq FROM changeseq")
+                positions.append(cur.fetchone())
+                cur.close()
+        except sqlite3.Error as e:
+            self._close_current_day_databases(databases)
+            if "no such table" not in str(e):  # e.g. the collectd holds a lock during a commit
+                logger.warning("Error reading database %s, export of day %s to be retried: %s", database.dbname, day, e)
+                return None
+            # a collectd not yet writing database version 3
+            raise NotImplementedError(f"Database {database.dbname} does not support the intraday export: {e}")
+        checkpoint = ",".join("%s:%d" % position for position in positions)
+        if previous is None:  # the first export includes the counters written before a migration with 0
+            return databases, [-1] * len(positions), checkpoint, False
+        if [dbid for (dbid, _) in previous] != [dbid for (dbid, _) in positions]:
+            # e.g. the day was exported from the database of the next day after a roll-over
+            logger.warning("Checkpoint %s does not fit the databases, exporting all counters of %s", since, day)
+            return databases, [-1] * len(positions), checkpoint, True
+        return databases, [seq for (_, seq) in previous], checkpoint, False
+
+    def fetch_day_counts(self, day, since=None):
+        """
+        Print out the counters of all domains on a specific day in the compact format of protocol version 2
+        :param day: The day for which to print the counters
+        :param since: None to print all counters of a completed day or the checkpoint printed by a previous export
+                      of the same day, "0" for the first one, to print all counters of the domains changed since then
+        """
+        if since is None:
+            logger.info("TLSRPT fetcher bulk domain counts starting for day %s", day)
+            (databases, sinces, checkpoint) = (self.databases, [None] * len(self.databases), None)
+        else:
+            logger.info("TLSRPT fetcher incremental domain counts starting for day %s since %s", day, since)
+            prepared = self._incremental_databases(day, since)
+            if prepared is None:  # without a checkpoint line reportd retries later
+                self._print_header(TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL)
+                print(".")
+                return
+            (databases, sinces, checkpoint, reset) = prepared
+            checkpoint = (checkpoint, reset)
+        try:
+            self._print_day_counts(day, databases, sinces, checkpoint)
+        finally:
+            self._close_current_day_databases(databases)
+
+    def _print_day_counts(self, day, databases, sinces, checkpoint):
+        """
+        Print out the counters of the domains of a day read from some databases
+        :param day: The day for which to print the counters
+        :param databases: the databases to read, one per shard
+        :param sinces: the values of the change sequences to print the changes after or None to print all domains
+        :param checkpoint: None for a completed day or tuple of the checkpoint for the next export and True if the
+                           counters printed replace all counters exported before
+        """
+        duration = Duration()
+        encoder = json.JSONEncoder(separators=(",", ":"))
+        domains = self._day_count_lines(encoder, day, databases, sinces)
+        if checkpoint is None:
+            self._print_header(TLSRPT_FETCHER_VERSION_STRING_V2_BULK)
+        else:
+            # The database the collectd writes is read completely before anything is printed, so a read failing while
+            # the collectd locks it ends without a checkpoint line like an export to be retried later.
+            try:
+                domains = list(domains)
+            except sqlite3.OperationalError as e:
+                logger.warning("Error reading the counters of day %s, export to be retried: %s", day, e)
+                self._print_header(TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL)
+                print(".")
+                return
+            self._print_header(TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL)
+            if checkpoint[1]:
+                print(encoder.encode(["reset"]))
+            print(encoder.encode(["c", checkpoint[0]]))
+        dc = 0  # domain count
+        for lines in domains:
+            try:
+                for line in lines:
+                    print(line)
+            except BrokenPipeError as err:
+                logger.warning("Error when writing counts of domain %d: %s", dc + 1, err)
+                return
+            dc += 1
+        # terminate the counts with a single dot
+        print(".")
+        duration.add(dc)
+        logger.info("Printing counts of %d domains took %s, %s domains per second", dc, duration.time(),
+                    duration.rate())
+
+    def _day_count_lines(self, encoder, day, databases, sinces):
+        """
+        Read the counters of the domains of a day from some databases and encode them as lines of protocol version 2
+        :param encoder: the JSONEncoder for the lines
+        :param day: The day for which to read the counters
+        :param databases: the databases to read, one per shard
+        :param sinces: the values of the change sequences to read the changes after or None to read all domains
+        :return: generator of lists of lines per domain, the dictionary entries of new strings and the domain counters
+        """
+        dictionary = FetcherDictionary()
+        # merge the domains of all shards, the counters of a domain found in several shards are summed up
+        streams = [self._day_counts(dictionary, database, day, since) for (database, since) in zip(databases, sinces)]
+        for (domain, group) in itertools.groupby(heapq.merge(*streams, key=lambda entry: entry[0]),
+                                                 key=lambda entry: entry[0]):
+            counts = {}  # counters by TLSRPT record and policy
+            for (_, results, failures) in group:
+                for (r, p, cntrtotal, cntrfailure) in results:
+                    entry = counts.get((r, p))
+                    if entry is None:
+                        counts[(r, p)] = [r, p, cntrtotal, cntrfailure, []]
+                    else:  # found in several shards
+                        entry[2] += cntrtotal
+                        entry[3] += cntrfailure
+                for (r, p, f, cntr) in failures:
+                    entryfailures = counts[(r, p)][4]
+                    for i in range(0, len(entryfailures), 2):
+                        if entryfailures[i] == f:  # found in several shards
+                            entryfailures[i + 1] += cntr
+                            break
+                    else:
+                        entryfailures.extend((f, cntr))
+            lines = []
+            if dictionary.pending:
+                lines.extend(encoder.encode(entry) for entry in dictionary.entries())
+            lines.append(encoder.encode(["d", domain, list(counts.values())]))
+            yield lines
+
+
+class ReadOnlyCollectdDatabase:
+    """
+    Read-only connection to a collectd database that is still written by the collectd, for the intraday export.
+    Unlike the databases of completed days it is neither checked nor migrated.
+    """
+    BUSY_TIMEOUT = 5.0  # seconds to wait for a lock held by the collectd
+
+    def __init__(self, dbname):
+        """
+        :param dbname: the name of the database file
+        """
+        self.dbname = dbname
+        self.con = sqlite3.connect("file:" + urllib.request.pathname2url(os.path.abspath(dbname)) + "?mode=ro",
+                                   uri=True, timeout=self.BUSY_TIMEOUT)
+
+
+class FetcherDictionary:
+    """
+    The TLSRPT records, policies and failure reasons of a protocol version 2 stream.
+    Each string is sent once in a dictionary entry and referred to by its id in the stream, which is independent of
+    its ids in the databases of the shards. The ids of each kind are numbered consecutively from 0, so a dictionary
+    entry consists of the kind, the id of its first string and a list of strings.
+    """
+    MAX_STRINGS_PER_ENTRY = 1000
+    # Table, column and table referring to it for each kind of dictionary entry
+    TABLES = {"r": ("tlsrptrecords", "tlsrptrecord", "finalresults"),
+              "p": ("policies", "policy", "finalresults"),
+              "f": ("reasons", "reason", "failures")}
+
+    def __init__(self):
+        self.ids = {kind: {} for kind in self.TABLES}  # stream ids of the strings
+        self.new = {kind: [] for kind in self.TABLES}  # strings not printed yet
+        self.pending = False  # True if there are strings not printed yet
+
+    def stream_ids(self, database, day, since=None):
+        """
+        Assign stream ids to the strings used on a day in a database, creating dictionary entries for new strings
+        :param database: the database to read
+        :param day: the day to read
+        :param since: None for all strings of the day or a value of the change sequence for the strings of the domains
+                      changed after it
+        :return: tuple of dicts mapping the ids in the database to the stream ids, for TLSRPT records, policies and
+                 failure reasons
+        """
+        result = []
+        cur = database.con.cursor()
+        if since is None:
+            (condition, parameters) = ("", (day,))
+        else:
+            (condition, parameters) = (" AND " + TLSRPTFetcherSQLite.CHANGED_DOMAINS, (day, day, since))
+        for (kind, (table, column, usedby)) in self.TABLES.items():
+            ids = self.ids[kind]
+            database_ids = {}
+            cur.execute(f"SELECT {column}_id, {column} FROM {table} "
+                        f"WHERE {column}_id IN (SELECT {column}_id FROM {usedby} WHERE day=?{condition})", parameters)
+            for (database_id, string) in cur:
+                stream_id = ids.get(string)
+                if stream_id is None:
+                    stream_id = len(ids)
+                    ids[string] = stream_id
+                    self.new[kind].append(string)
+                    self.pending = True
+                database_ids[database_id] = stream_id
+            result.append(database_ids)
+        cur.close()
+        return tuple(result)
+
+    def entries(self):
+        """
+        Get the dictionary entries for the strings not printed yet
+        :return: generator of dictionary entries
+        """
+        for (kind, strings) in self.new.items():
+            first = len(self.ids[kind]) - len(strings)
+            for start in range(0, len(strings), self.MAX_STRINGS_PER_ENTRY):
+                yield [kind, first + start, strings[start:start + self.MAX_STRINGS_PER_ENTRY]]
+            self.new[kind] = []
+        self.pending = False
+
+
+class ChunkedReplyReader(io.RawIOBase):
+    """
+    Readable stream of one reply of a fetcher session written by ChunkWriter, ending at the terminating chunk.
+    If the session breaks in the middle of a reply, the reply just ends early and the session is marked as broken.
+    """
+    def __init__(self, pipe):
+        """
+        :param pipe: the binary stream of the fetcher session
+        """
+        self.pipe = pipe
+        self.remaining = 0  # bytes left in the current chunk
+        self.finished = False
+        self.broken = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.finished:
+            return 0
+        if self.remaining == 0:
+            header = self.pipe.readline(32)
+            if not header.endswith(b"\n") or not header.rstrip().isdigit():
+                logger.warning("Fetcher session ended in the middle of a reply")
+                self.finished = self.broken = True
+                return 0
+            self.remaining = int(header)
+            if self.remaining == 0:
+                self.finished = True
+                return 0
+        data = self.pipe.read(min(len(b), self.remaining))
+        if len(data) == 0:
+            logger.warning("Fetcher session ended in the middle of a reply")
+            self.finished = self.broken = True
+            return 0
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def drain(self):
+        """
+        Skip the rest of the reply, e.g. if it was not read completely because of an error
+        """
+        buffer = bytearray(65536)
+        while self.readinto(buffer) != 0:
+            pass
+
+
+class ZlibReader(io.RawIOBase):
+    """
+    Readable stream decompressing the output a fetcher compressed with ZlibWriter while it is read
+    """
+    def __init__(self, source):
+        """
+        :param source: the binary stream to read the compressed data from
+        """
+        self.source = source
+        self.decompressor = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.decompressor.eof:
+            compressed = self.decompressor.unconsumed_tail
+            if len(compressed) == 0:
+                compressed = self.source.read(65536)
+                if len(compressed) == 0:
+                    logger.warning("Compressed fetcher output ended prematurely")
+                    return 0
+            try:
+                data = self.decompressor.decompress(compressed, len(b))
+            except zlib.error as e:
+                raise OSError(f"Invalid compressed fetcher output: {e}") from e
+            if len(data) != 0:
+                b[:len(data)] = data
+                return len(data)
+        return 0
+
+
+def decompress_fetcher_output(stream, compression):
+    """
+    Check the header of compressed fetcher output and decompress the data following it
+    :param stream: the binary output of the fetcher
+    :param compression: the compression requested from the fetcher, empty for uncompressed output
+    :return: binary stream of the decompressed output
+    :raises OSError: if the output does not start with the header of the requested compression
+    """
+    if compression == "":
+        return stream
+    line = stream.readline(256)
+    if line == b"":
+        return stream  # no output at all, e.g. from a fetcher rejecting an option, is left to the caller
+    header = line.decode("utf-8", errors="replace").rstrip()
+    if header != TLSRPT_FETCHER_COMPRESSION_STRINGS[compression]:
+        raise OSError(f"Expected fetcher output compressed with {compression} but got '{header}'")
+    return io.BufferedReader(ZlibReader(stream), 65536)
+
+
+class FetcherSession:
+    """
+    A fetcher process answering requests over its standard input and output, see tlsrpt_fetcher_session
+    """
+    def __init__(self, fetcher, timeout, compression, protocol):
+        """
+        Start the fetcher in session mode
+        :param fetcher: the fetcher command
+        :param timeout: seconds to wait for the fetcher to terminate when closing the session
+        :param compression: the compression of the replies, empty for uncompressed replies
+        :param protocol: the protocol version of the replies to bulk requests
+        :raises OSError: if the fetcher can not be started
+        """
+        self.fetcher = fetcher
+        self.timeout = timeout
+        self.compression = compression
+        self.reply = None
+        args = fetcher.split()
+        args.append("--session=1")
+        if compression != "":
+            args.append("--compression=" + compression)
+        if protocol != 1:
+            args.append("--protocol=%d" % protocol)
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        greeting = self.process.stdout.readline().decode("utf-8", errors="replace").rstrip()
+        # fetchers without session mode reject the option and terminate without any output
+        self.supported = greeting == TLSRPT_FETCHER_SESSION_STRING
+        self.broken = not self.supported
+
+    def is_alive(self):
+        """
+        Check if the session can take more requests
+        :return: False if the fetcher terminated or a reply was broken
+        """
+        if self.reply is not None and self.reply.broken:
+            self.broken = True
+        return not self.broken and self.process.poll() is None
+
+    def request(self, request):
+        """
+        Send a request to the fetcher
+        :param request: list of the words of the request, e.g. ["list", "2001-02-03"]
+        :return: binary stream of the reply
+        """
+        if self.reply is not None:
+            self.reply.drain()
+        try:
+            self.process.stdin.write((" ".join(request) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except OSError as e:
+            logger.warning("Fetcher session %s terminated: %s", self.fetcher, e)
+            self.broken = True
+            return io.BytesIO()
+        self.reply = ChunkedReplyReader(self.process.stdout)
+        return io.BufferedReader(self.reply)
+
+    def close(self):
+        """
+        End the session and wait for the fetcher to terminate
+        """
+        try:
+            if not self.broken:
+                if self.reply is not None:
+                    self.reply.drain()
+                self.process.stdin.write(b"quit\n")
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("Killing fetcher session %s", self.fetcher)
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
 
 
 class TLSRPTReportdSetupException(Exception):
@@ -798,6 +2312,8 @@ class TLSRPTReportd(VersionedSQLite):
         :type config: ConfigReportd
         """
         self.cfg = config
+        # Protocol version negotiated with each fetcher by the configuration check, by fetcher index
+        self.fetcher_protocols = {}
         self._config_check()  # will throw Exceptions when Errors in config are found
 
         # Some config sanity checks
@@ -813,11 +2329,22 @@ class TLSRPTReportd(VersionedSQLite):
                                              self.cfg.mail_destination_map,
                                              self.cfg.http_upload_map)
 
+        try:
+            pragmas = parse_sqlite_pragmas(self.cfg.sqlite_pragmas)
+        except ValueError as e:
+            raise TLSRPTReportdSetupException(f"Invalid option sqlite_pragmas: {e}")
+
         # Proceed with startup
-        super().__init__(self.cfg.dbname)
+        super().__init__(self.cfg.dbname, pragmas)
         self.curtoupdate = self.con.cursor()
         self.randPoolDelivery = randpool.RandPool(self.cfg.spread_out_delivery)
+        # Fetcher processes kept running during the collection phase, by fetcher index
+        self.fetcher_sessions = {}
+        self.fetchers_without_session = set()
+        # Compression supported by fetchers run once per request, by fetcher index
+        self.fetcher_compressions = {}
         self.wakeuptime = tlsrpt_utc_time_now()
+        self.next_intraday_export = self.wakeuptime
         if self._check_database():
             logger.info("Database %s looks OK", self.dbname)
         else:
@@ -832,6 +2359,8 @@ class TLSRPTReportd(VersionedSQLite):
         Severe issues will throw an exception, other checks just report errors or warnings to the log
         """
         self._config_check_colliding_options()
+        if self.cfg.fetcher_compression not in ("",) + tuple(TLSRPT_FETCHER_COMPRESSION_STRINGS):
+            raise TLSRPTReportdSetupException(f"Unsupported fetcher compression: {self.cfg.fetcher_compression}")
         for (n, fetcher) in enumerate(self.get_fetchers(), start=1):
             logger.debug("CHECK FETCHER %s: %s", n, fetcher)
             self._config_check_fetcher(n, fetcher)
@@ -856,28 +2385,27 @@ class TLSRPTReportd(VersionedSQLite):
         :param fetcherindex: The number of the fetcher
         :param fetcher: The fetcher to check if it can be run without problems
         """
-        fetchertimeout = 30  # timeout in case of unresponsive script
-        args = fetcher.split()
-        args.append("1999-01-01")  # use date way in the past in order to not get a domain list
         try:
-            fetcherpipe = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            try:
-                (fetcherstdoutdata, fetcherstderrdata) = fetcherpipe.communicate(timeout=fetchertimeout)
-            except subprocess.TimeoutExpired as e:
-                fetcherpipe.kill()
-                logger.error("Test timed out for fetcher %s '%s' after %s seconds", fetcherindex, fetcher,
-                             fetchertimeout)
-                (fetcherstdoutdata, fetcherstderrdata) = fetcherpipe.communicate(timeout=fetchertimeout)  # clean up
-
-            fetcherstdoutlines = fetcherstdoutdata.decode('utf-8').splitlines()
+            # Negotiate the protocol version: a fetcher supporting version 2 answers a bulk request with its version
+            # header, older fetchers reject the options and are checked with a domain list request of version 1
+            for (protocol, options, expected_versionheader) in (
+                    (2, ["--protocol=2", "--bulk=1"], TLSRPT_FETCHER_VERSION_STRING_V2_BULK),
+                    (1, [], TLSRPT_FETCHER_VERSION_STRING_V1)):
+                (returncode, fetcherstdoutlines) = self._run_fetcher_check(fetcherindex, fetcher, options)
+                if protocol != 1 and (returncode != 0 or fetcherstdoutlines[:1] != [expected_versionheader]):
+                    logger.debug("Fetcher %s '%s' does not support protocol version %d", fetcherindex, fetcher,
+                                 protocol)
+                    continue
+                logger.info("Using protocol version %d for fetcher %s '%s'", protocol, fetcherindex, fetcher)
+                self.fetcher_protocols[fetcherindex] = protocol
+                break
             # Check exit code before everything else
-            returncode = fetcherpipe.returncode
             if returncode != 0:
                 logger.error("Test for fetcher %s '%s' failed with return code '%s'", fetcherindex, fetcher, returncode)
                 return
             # Protocol line 1: Check protocol version
             versionheader = fetcherstdoutlines[0].rstrip()
-            if versionheader != TLSRPT_FETCHER_VERSION_STRING_V1:
+            if versionheader != expected_versionheader:
                 logger.error("Unsupported protocol version from fetcher %d '%s' :%s", fetcherindex, fetcher,
                              versionheader)
                 return
@@ -906,11 +2434,49 @@ class TLSRPTReportd(VersionedSQLite):
         except Exception as e:
             logger.error("Test failed for fetcher %s '%s' with exception: %s", fetcherindex, fetcher, e.__str__())
 
+    def _run_fetcher_check(self, fetcherindex: int, fetcher: str, options):
+        """
+        Run a fetcher for the configuration check
+        :param fetcherindex: The number of the fetcher
+        :param fetcher: The fetcher to run
+        :param options: additional options for the fetcher
+        :return: tuple of the return code and the lines of output of the fetcher
+        """
+        fetchertimeout = 30  # timeout in case of unresponsive script
+        args = fetcher.split()
+        args.extend(options)
+        args.append("1999-01-01")  # use date way in the past in order to not get a domain list
+        fetcherpipe = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            (fetcherstdoutdata, fetcherstderrdata) = fetcherpipe.communicate(timeout=fetchertimeout)
+        except subprocess.TimeoutExpired as e:
+            fetcherpipe.kill()
+            logger.error("Test timed out for fetcher %s '%s' after %s seconds", fetcherindex, fetcher,
+                         fetchertimeout)
+            (fetcherstdoutdata, fetcherstderrdata) = fetcherpipe.communicate(timeout=fetchertimeout)  # clean up
+        return fetcherpipe.returncode, fetcherstdoutdata.decode('utf-8').splitlines()
+
     def _db_purpose(self):
         return "TLSRPT-Reportd-DB" + DB_Purpose_Suffix
 
+    def _db_version(self):
+        return 2
+
+    @staticmethod
+    def _ddl_v2_tables():
+        # counters of the current day pulled by the intraday export, moved to reportdata after the end of the day
+        return ["CREATE TABLE stagingdata(day, domain, data, fetcherindex, fetcher, "
+                "its datetime default CURRENT_TIMESTAMP, "
+                "PRIMARY KEY(day, domain, fetcherindex))",
+                "CREATE TABLE stagingcheckpoints(day, fetcherindex, fetcher, checkpoint, "
+                "its datetime default CURRENT_TIMESTAMP, "
+                "PRIMARY KEY(day, fetcherindex))"]
+
+    def _migrations(self):
+        return {1: self._ddl_v2_tables()}
+
     def _ddl(self):
-        return ["CREATE TABLE fetchjobs(day, fetcherindex, fetcher, retries, status, nexttry, "
+        return self._ddl_v2_tables() + ["CREATE TABLE fetchjobs(day, fetcherindex, fetcher, retries, status, nexttry, "
                 "its datetime default CURRENT_TIMESTAMP, "
                 "PRIMARY KEY(day, fetcherindex))",
                 "CREATE TABLE reportdata(day, domain, data, fetcher, fetcherindex, retries, status, nexttry, "
@@ -924,7 +2490,7 @@ class TLSRPTReportd(VersionedSQLite):
                 "FOREIGN KEY(d_r_id) REFERENCES reports(r_id))",
                 "CREATE TABLE dbversion(version, installdate, purpose)",
                 "INSERT INTO dbversion(version, installdate, purpose) "
-                " VALUES(1,strftime('%Y-%m-%d %H-%M-%f','now'),'"+self._db_purpose()+"')"]
+                " VALUES("+str(self._db_version())+",strftime('%Y-%m-%d %H-%M-%f','now'),'"+self._db_purpose()+"')"]
 
     def get_fetchers(self):
         """
@@ -977,6 +2543,12 @@ class TLSRPTReportd(VersionedSQLite):
         d = cur.rowcount
         if d > 0:
             logger.info("Deleted %d old reportdata", d)
+        # staged data is left over if a fetcher was removed from the configuration before the end of the day
+        cur.execute("DELETE FROM stagingdata WHERE julianday(?)-julianday(day)>?", (now, limit))
+        d = cur.rowcount
+        if d > 0:
+            logger.info("Deleted %d old stagingdata", d)
+        cur.execute("DELETE FROM stagingcheckpoints WHERE julianday(?)-julianday(day)>?", (now, limit))
         cur.execute("DELETE FROM destinations WHERE d_r_id in (SELECT r_id FROM reports "
                     "WHERE julianday(?)-julianday(day)>?)", (now, limit))
         d = cur.rowcount
@@ -1042,34 +2614,36 @@ class TLSRPTReportd(VersionedSQLite):
         :type fetcherindex: The fetchers index in the configuration
         :return: True if the job completed successfully, False if a retry is necessary
         """
+        # fetch the details of all domains at once and only fall back to fetching domain by domain for old fetchers
+        bulkresult = self.collect_day_details_from(day, fetcher, fetcherindex)
+        if bulkresult is not None:
+            return bulkresult
+        logger.info("Fetcher %d %s does not support bulk mode, fetching domain by domain", fetcherindex, fetcher)
         logger.debug("Collect domains from %d %s", fetcherindex, fetcher)
-        duration = Duration()
-        args = fetcher.split()
-        args.append(day.__str__())
         try:
-            fetcherpipe = subprocess.Popen(args, stdout=subprocess.PIPE)
-        except Exception as e:
+            with self.fetcher_output(fetcherindex, fetcher, ["list", day.__str__()]) as stdout:
+                return self._read_domain_list(day, fetcher, fetcherindex, stdout)
+        except OSError as e:
             logger.error("Could not collect domains from fetcher '%s': %s", fetcher, e.__str__())
             return False
-        versionheader = fetcherpipe.stdout.readline().decode('utf-8').rstrip()
+
+    def _read_domain_list(self, day, fetcher, fetcherindex, stdout):
+        """
+        Read the list of domains sent by a fetcher and create the jobs to fetch their details
+
+        :param day: Day for which to fetch the domain list
+        :type fetcher: The fetcher running
+        :type fetcherindex: The fetchers index in the configuration
+        :param stdout: the output of the fetcher
+        :return: True if the job completed successfully, False if a retry is necessary
+        """
+        duration = Duration()
+        versionheader = stdout.readline().decode('utf-8').rstrip()
         logger.debug("From fetcher %d got version header: %s", fetcherindex, versionheader)
         if versionheader != TLSRPT_FETCHER_VERSION_STRING_V1:
             logger.error("Unsupported protocol version from fetcher %d '%s' :%s", fetcherindex, fetcher, versionheader)
             return False
-        # get current time of this collectd
-        collectd_time_string = fetcherpipe.stdout.readline().decode('utf-8').rstrip()
-        collectd_time = datetime.datetime.strptime(collectd_time_string, TLSRPT_TIMEFORMAT). \
-            replace(tzinfo=datetime.timezone.utc)
-        reportd_time = tlsrpt_utc_time_now()
-        dt = reportd_time - collectd_time
-        if abs(dt.total_seconds()) > self.cfg.max_collectd_timediff:
-            logger.warning("Collectd time %s and reportd time %s differ more then %s on fetcher %d %s", collectd_time,
-                           reportd_time, self.cfg.max_collectd_timediff, fetcherindex, fetcher)
-        # Protocol line 3: available day
-        available_day = fetcherpipe.stdout.readline().decode('utf-8').rstrip()
-        if available_day != day:
-            logger.warning("Fetcher not ready %d %s: expected %s but got %s", fetcherindex, fetcher, day,
-                           available_day)
+        if not self._check_fetcher_header(day, fetcher, fetcherindex, stdout):
             return False
         self.cur.execute("SAVEPOINT domainlist")
         # read the domain list
@@ -1077,7 +2651,7 @@ class TLSRPTReportd(VersionedSQLite):
         dc = 0  # domain count
         try:
             while result:
-                dom = fetcherpipe.stdout.readline().decode('utf-8').rstrip()
+                dom = stdout.readline().decode('utf-8').rstrip()
                 logger.debug("Got line '%s'", dom)
                 if dom == ".":  # end of domain list reached
                     break
@@ -1111,94 +2685,525 @@ class TLSRPTReportd(VersionedSQLite):
         logger.info("Fetching %d domains took %s, %s domains per second", dc, duration.time(), duration.rate())
         return result
 
-    def select_incomplete_days(self, cursor):
+    def _check_fetcher_header(self, day, fetcher, fetcherindex, stdout):
         """
-        Get days with incomplete fetchjobs from the database
-        :param cursor: the DB cursor to use for the query
-        :return: the row set of incomplete days
+        Read the current time and the available day from the protocol header of a fetcher
+        :param day: Day for which the data is fetched
+        :type fetcher: The fetcher running
+        :type fetcherindex: The fetchers index in the configuration
+        :param stdout: the output of the fetcher, positioned after the version header
+        :return: True if the fetcher has the data of the day, False if a retry is necessary
         """
-        # select days that are not fully fetched yet for debug loglevel
-        cursor.execute("SELECT day FROM fetchjobs WHERE status IS NULL")
-        incompletedays = cursor.fetchall()
-        return incompletedays
+        # get current time of this collectd
+        collectd_time_string = stdout.readline().decode('utf-8').rstrip()
+        collectd_time = datetime.datetime.strptime(collectd_time_string, TLSRPT_TIMEFORMAT). \
+            replace(tzinfo=datetime.timezone.utc)
+        reportd_time = tlsrpt_utc_time_now()
+        dt = reportd_time - collectd_time
+        if abs(dt.total_seconds()) > self.cfg.max_collectd_timediff:
+            logger.warning("Collectd time %s and reportd time %s differ more then %s on fetcher %d %s", collectd_time,
+                           reportd_time, self.cfg.max_collectd_timediff, fetcherindex, fetcher)
+        # Protocol line 3: available day
+        available_day = stdout.readline().decode('utf-8').rstrip()
+        if available_day != day:
+            logger.warning("Fetcher not ready %d %s: expected %s but got %s", fetcherindex, fetcher, day,
+                           available_day)
+            return False
+        return True
 
-    def fetch_data(self):
-        """
-        Fetch details for the domains not yet processed
+    def collect_day_details_from(self, day, fetcher, fetcherindex):
         """
-        logger.debug("Fetch data")
-        curtofetch = self.con.cursor()
-        incompletedays = self.select_incomplete_days(curtofetch)
-        if len(incompletedays) != 0:
-            logger.debug("The are %d incomplete days: %s", len(incompletedays), incompletedays.__str__())
+        Fetch the details of all domains from one of the fetchers in bulk mode, with a single fetcher run instead of
+        one run per domain
 
-        # select jobs that are due
-        now = tlsrpt_utc_time_now()
-        curtofetch.execute(
-            "SELECT day, fetcher, fetcherindex, domain FROM reportdata "
-            "WHERE data IS NULL AND nexttry<? AND day NOT IN (SELECT day FROM fetchjobs WHERE status IS NULL)",
-            (now,))
-        for (day, fetcher, fetcherindex, domain) in curtofetch:
-            self.fetch_data_from_fetcher_for_domain(day, fetcher, fetcherindex, domain)
+        :param day: Day for which to fetch the domain details
+        :type fetcher: The fetcher to run
+        :type fetcherindex: The fetchers index in the configuration
+        :return: True if the job completed successfully, False if a retry is necessary,
+                 None if the fetcher does not support bulk mode
+        """
+        logger.debug("Collect day details from %d %s", fetcherindex, fetcher)
+        if self.staging_checkpoint(day, fetcher, fetcherindex) is not None:
+            # most of the day was pulled by the intraday export already, only the remaining changes are pulled
+            result = self.pull_day_counts(day, fetcher, fetcherindex, True)
+            if result is not None:
+                return result
+            logger.warning("Fetcher %d %s does not support the intraday export anymore, dropping staged data",
+                           fetcherindex, fetcher)
+            self.drop_staging(day, fetcherindex)
+            self.con.commit()
+        try:
+            with self.fetcher_output(fetcherindex, fetcher, ["bulk", day.__str__()]) as stdout:
+                result = self._read_day_details(day, fetcher, fetcherindex, stdout)
+        except OSError as e:
+            logger.error("Could not collect day details from fetcher '%s': %s", fetcher, e.__str__())
+            return False
+        if result is None and self.fetcher_protocols.get(fetcherindex, 1) != 1:
+            # the fetcher was replaced by an older version since the configuration check
+            logger.warning("Fetcher %d %s does not support protocol version %d anymore", fetcherindex, fetcher,
+                           self.fetcher_protocols[fetcherindex])
+            self.fetcher_protocols[fetcherindex] = 1
+            return self.collect_day_details_from(day, fetcher, fetcherindex)
+        return result
 
-    def fetch_data_from_fetcher_for_domain(self, day, fetcher, fetcherindex, dom):
+    def fetcher_session(self, fetcherindex, fetcher):
         """
-        Fetch details for one domain from one fetcher for a specific day
-        :param day: Day for which to fetch the domain details
+        Get the session of a fetcher, starting the fetcher in session mode if it is not running yet
+        :type fetcherindex: The fetchers index in the configuration
         :type fetcher: The fetcher to run
+        :return: the FetcherSession or None if the fetcher does not support sessions
+        """
+        session = self.fetcher_sessions.get(fetcherindex)
+        if session is not None:
+            if session.is_alive():
+                return session
+            session.close()
+            del self.fetcher_sessions[fetcherindex]
+        if fetcherindex in self.fetchers_without_session:
+            return None
+        try:
+            session = FetcherSession(fetcher, self.cfg.max_collectd_timeout, self.cfg.fetcher_compression,
+                                     self.fetcher_protocols.get(fetcherindex, 1))
+        except OSError as e:
+            logger.error("Could not start fetcher session %d %s: %s", fetcherindex, fetcher, e)
+            return None
+        if not session.supported:
+            logger.info("Fetcher %d %s does not support sessions, running it for every request", fetcherindex,
+                        fetcher)
+            session.close()
+            self.fetchers_without_session.add(fetcherindex)
+            return None
+        logger.info("Started fetcher session %d %s", fetcherindex, fetcher)
+        self.fetcher_sessions[fetcherindex] = session
+        return session
+
+    def close_fetcher_sessions(self):
+        """
+        Terminate the fetchers kept running for the collection phase
+        """
+        for (fetcherindex, session) in self.fetcher_sessions.items():
+            logger.info("Closing fetcher session %d %s", fetcherindex, session.fetcher)
+            session.close()
+        self.fetcher_sessions = {}
+        # check again next time in case the fetcher was upgraded
+        self.fetchers_without_session = set()
+        self.fetcher_compressions = {}
+
+    def fetcher_compression(self, fetcherindex, fetcher):
+        """
+        Find out if a fetcher run once per request can compress its output, running it once with the compression option
         :type fetcherindex: The fetchers index in the configuration
-        :param dom: The domain for which to fetch the details
+        :type fetcher: The fetcher to run
+        :return: the compression to request from the fetcher, empty for uncompressed output
         """
-        logger.debug("Fetch data from %d %s for domain %s", fetcherindex, fetcher, dom)
+        if self.cfg.fetcher_compression == "":
+            return ""
+        compression = self.fetcher_compressions.get(fetcherindex)
+        if compression is not None:
+            return compression
         args = fetcher.split()
-        args.append(day.__str__())
-        args.append(dom)
-        try:
-            fetcherpipe = subprocess.Popen(args, stdout=subprocess.PIPE)
-        except FileNotFoundError as e:
-            logger.error("File not found when trying to run fetcher %s: %s", fetcher, e.__str__())
-            return
-        alldata = fetcherpipe.stdout.read(TLSRPT_MAX_READ_FETCHER)
+        args.append("--compression=" + self.cfg.fetcher_compression)
+        args.append("1999-01-01")  # use date way in the past in order to not get a domain list
         try:
-            j = json.loads(alldata)
-        except json.JSONDecodeError as e:
-            logger.error("Invalid JSON: %s", e.__str__())
-            return
-        gotdom = j.pop("d")
-        if gotdom != dom:
-            logger.error("Domain mismatch! Asked for %s but got reply for %s", dom, gotdom)
-            return
-        data = j.pop("policies")
-        self.curtoupdate.execute("UPDATE reportdata SET data=?, status='fetched' "
-                                 "WHERE day=? AND fetcherindex=? AND domain=?",
-                                 (json.dumps(data), day, fetcherindex, dom))
-        self.con.commit()
+            output = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    timeout=self.cfg.max_collectd_timeout).stdout
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning("Could not check compression of fetcher %d %s: %s", fetcherindex, fetcher, e)
+            return ""
+        header = output.split(b"\n", 1)[0].decode("utf-8", errors="replace")
+        if header == TLSRPT_FETCHER_COMPRESSION_STRINGS[self.cfg.fetcher_compression]:
+            compression = self.cfg.fetcher_compression
+        else:
+            logger.info("Fetcher %d %s does not support compression, transferring uncompressed", fetcherindex,
+                        fetcher)
+            compression = ""
+        self.fetcher_compressions[fetcherindex] = compression
+        return compression
 
-    def aggregate_report_from_data(self, r, data):
+    def collection_finished(self):
         """
-        Aggregate data into report
-        :param r: the report into which to aggregate the data
-        :param data: the data
+        Check if all domain lists and domain details have been fetched
+        :return: True if no fetcher needs to be run anymore for now
         """
-        # spolicy is the whole policy as a string, do not to be confused with the "policy-string" inside it
-        for spolicy in data:
-            tmp = data[spolicy]
-            cntrtotal = tmp["cntrtotal"]
-            cntrfailure = tmp["cntrfailure"]
-            failures = tmp["failures"]
-            if spolicy not in r:
-                r[spolicy] = {"cntrtotal": 0, "cntrfailure": 0, "failures": {}}
-            r[spolicy]["cntrtotal"] += cntrtotal
-            r[spolicy]["cntrfailure"] += cntrfailure
-            for failure in failures:
-                if failure not in r[spolicy]["failures"]:
-                    r[spolicy]["failures"][failure] = 0
-                r[spolicy]["failures"][failure] += failures[failure]
+        cur = self.con.cursor()
+        if len(self.select_incomplete_days(cur)) != 0:
+            return False
+        cur.execute("SELECT 1 FROM reportdata WHERE data IS NULL LIMIT 1")
+        return cur.fetchone() is None
 
-    def render_report(self, day, dom, tlsrptrecord, data, report):
+    @contextlib.contextmanager
+    def fetcher_output(self, fetcherindex, fetcher, request):
         """
-        Render a report into its final form
-        :param day: Day for which to create the report
+        Run a request on a fetcher, via its session if it supports sessions or as a new fetcher process otherwise
+        :type fetcherindex: The fetchers index in the configuration
+        :type fetcher: The fetcher to run
+        :param request: list of the words of the request: "list" and the day, "details", the day and the domain,
+                        "bulk" and the day or "incremental", the day and the checkpoint
+        :return: context manager yielding the binary output of the fetcher
+        :raises OSError: if the fetcher can not be run
+        """
+        session = self.fetcher_session(fetcherindex, fetcher)
+        if session is not None:
+            reply = session.request(request)
+            try:
+                yield decompress_fetcher_output(reply, session.compression)
+            finally:
+                if session.reply is not None:
+                    session.reply.drain()  # keep the session in sync if the reply was not read completely
+            return
+        compression = self.fetcher_compression(fetcherindex, fetcher)
+        args = fetcher.split()
+        if request[0] == "bulk":
+            args.append("--bulk=1")
+            if self.fetcher_protocols.get(fetcherindex, 1) != 1:
+                args.append("--protocol=%d" % self.fetcher_protocols[fetcherindex])
+        elif request[0] == "incremental":
+            args.extend(["--bulk=1", "--protocol=2", "--since=" + request[2]])
+            request = request[:2]
+        if compression != "":
+            args.append("--compression=" + compression)
+        args.extend(request[1:])
+        fetcherpipe = subprocess.Popen(args, stdout=subprocess.PIPE)
+        try:
+            yield decompress_fetcher_output(fetcherpipe.stdout, compression)
+        finally:
+            fetcherpipe.stdout.close()  # a fetcher still writing terminates with a broken pipe
+            try:
+                fetcherpipe.wait(timeout=self.cfg.max_collectd_timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning("Killing fetcher %d %s", fetcherindex, fetcher)
+                fetcherpipe.kill()
+                fetcherpipe.wait()
+
+    def _read_day_details(self, day, fetcher, fetcherindex, stdout):
+        """
+        Read the details of all domains sent by a fetcher in bulk mode and store them as they arrive
+        :param day: Day for which to fetch the domain details
+        :type fetcher: The fetcher running
+        :type fetcherindex: The fetchers index in the configuration
+        :param stdout: the output of the fetcher
+        :return: True if the job completed successfully, False if a retry is necessary,
+                 None if the fetcher does not support bulk mode
+        """
+        duration = Duration()
+        versionheader = stdout.readline().decode('utf-8').rstrip()
+        logger.debug("From fetcher %d got version header: %s", fetcherindex, versionheader)
+        if versionheader == TLSRPT_FETCHER_VERSION_STRING_V1_BULK:
+            protocol = 1
+        elif versionheader == TLSRPT_FETCHER_VERSION_STRING_V2_BULK:
+            protocol = 2
+            dictionary = {kind: {} for kind in FetcherDictionary.TABLES}
+        else:
+            return None
+        if not self._check_fetcher_header(day, fetcher, fetcherindex, stdout):
+            return False
+        self.cur.execute("SAVEPOINT daydetails")
+        # read the details, one domain per line
+        result = True
+        dc = 0  # domain count
+        try:
+            while True:
+                line = stdout.readline(TLSRPT_MAX_READ_FETCHER + 1)
+                if line.rstrip() == b".":  # end of details reached
+                    break
+                if not line:  # EOF
+                    # this is a warning instead of an error because a remote connection could have been interrupted
+                    # and a retry might succeed
+                    logger.warning("Unexpected end of day details")
+                    result = False
+                    break
+                if not line.endswith(b"\n"):
+                    logger.error("Details of domain %d exceed %d bytes", dc + 1, TLSRPT_MAX_READ_FETCHER)
+                    result = False
+                    break
+                j = json.loads(line)
+                if protocol == 1:
+                    dom = j.pop("d")
+                    data = j.pop("policies")
+                elif j[0] == "d":
+                    dom = j[1]
+                    data = self._policies_from_counts(dictionary, j[2])
+                else:  # dictionary entry with consecutive ids
+                    dictionary[j[0]].update(enumerate(j[2], j[1]))
+                    continue
+                try:
+                    self.cur.execute("INSERT INTO reportdata "
+                                     "(day, domain, data, fetcherindex, fetcher, retries, status, nexttry) "
+                                     "VALUES (?,?,?,?,?,0,'fetched',?)",
+                                     (day, dom, json.dumps(data), fetcherindex, fetcher, tlsrpt_utc_time_now()))
+                    dc += 1
+                except sqlite3.IntegrityError as e:
+                    logger.warning(e)
+        except Exception as e:
+            logger.error("Unexpected exception: %s", e.__str__())
+            result = False
+
+        if result:
+            logger.info("DB-commit for fetcher %d %s", fetcherindex, fetcher)
+            self.cur.execute("RELEASE SAVEPOINT daydetails")
+            self.con.commit()
+        else:
+            logger.info("DB-rollback for fetcher %d %s", fetcherindex, fetcher)
+            self.cur.execute("ROLLBACK TO SAVEPOINT daydetails")
+            self.con.commit()
+        duration.add(dc)
+        logger.info("Fetching details of %d domains took %s, %s domains per second", dc, duration.time(),
+                    duration.rate())
+        return result
+
+    def staging_checkpoint(self, day, fetcher, fetcherindex):
+        """
+        Get the checkpoint of the last intraday export of a day from a fetcher
+        :param day: Day of the export
+        :type fetcher: The fetcher
+        :type fetcherindex: The fetchers index in the configuration
+        :return: the checkpoint or None if nothing was pulled from this fetcher for the day yet
+        """
+        cur = self.con.cursor()
+        cur.execute("SELECT checkpoint FROM stagingcheckpoints WHERE day=? AND fetcherindex=? AND fetcher=?",
+                    (str(day), fetcherindex, fetcher))
+        row = cur.fetchone()
+        return None if row is None else row[0]
+
+    def drop_staging(self, day, fetcherindex):
+        """
+        Delete the data staged by the intraday export of a day from a fetcher
+        :param day: Day of the export
+        :type fetcherindex: The fetchers index in the configuration
+        """
+        self.cur.execute("DELETE FROM stagingdata WHERE day=? AND fetcherindex=?", (str(day), fetcherindex))
+        self.cur.execute("DELETE FROM stagingcheckpoints WHERE day=? AND fetcherindex=?", (str(day), fetcherindex))
+
+    def export_intraday(self):
+        """
+        Pull the counters of the current day changed since the last pull from the fetchers supporting protocol
+        version 2, so only the remaining changes need to be fetched after the end of the day
+        """
+        if self.cfg.interval_intraday_export <= 0:
+            return
+        now = tlsrpt_utc_time_now()
+        if now < self.next_intraday_export:
+            self.wake_up_at(self.next_intraday_export)
+            return
+        self.next_intraday_export = self.wake_up_in(self.cfg.interval_intraday_export)
+        day = str(tlsrpt_utc_date_now())
+        for (fetcherindex, fetcher) in enumerate(self.get_fetchers(), start=1):
+            if self.fetcher_protocols.get(fetcherindex, 1) != 2:
+                continue
+            logger.debug("Intraday export of %s from %d %s", day, fetcherindex, fetcher)
+            if self.pull_day_counts(day, fetcher, fetcherindex, False) is None:
+                logger.info("Fetcher %d %s does not support the intraday export", fetcherindex, fetcher)
+
+    def pull_day_counts(self, day, fetcher, fetcherindex, final):
+        """
+        Pull the counters changed since the last pull of a day from a fetcher into the staging tables
+        :param day: Day for which to pull the counters
+        :type fetcher: The fetcher to run
+        :type fetcherindex: The fetchers index in the configuration
+        :param final: True for the last pull after the end of the day, moving the staged data to the reportdata
+        :return: True if the pull completed successfully, False if a retry is necessary,
+                 None if the fetcher does not support the intraday export
+        """
+        checkpoint = self.staging_checkpoint(day, fetcher, fetcherindex)
+        request = ["incremental", str(day), "0" if checkpoint is None else checkpoint]
+        try:
+            with self.fetcher_output(fetcherindex, fetcher, request) as stdout:
+                return self._read_day_counts(str(day), fetcher, fetcherindex, stdout, final)
+        except OSError as e:
+            logger.error("Could not pull day counts from fetcher '%s': %s", fetcher, e.__str__())
+            return False
+
+    def _read_day_counts(self, day, fetcher, fetcherindex, stdout, final):
+        """
+        Read the counters of the changed domains sent by a fetcher in incremental mode and stage them
+        :param day: Day for which the counters are pulled
+        :type fetcher: The fetcher running
+        :type fetcherindex: The fetchers index in the configuration
+        :param stdout: the output of the fetcher
+        :param final: True for the last pull after the end of the day, moving the staged data to the reportdata
+        :return: True if the job completed successfully, False if a retry is necessary,
+                 None if the fetcher does not support the intraday export
+        """
+        duration = Duration()
+        versionheader = stdout.readline().decode('utf-8').rstrip()
+        logger.debug("From fetcher %d got version header: %s", fetcherindex, versionheader)
+        if versionheader != TLSRPT_FETCHER_VERSION_STRING_V2_INCREMENTAL:
+            return None
+        if final:
+            if not self._check_fetcher_header(day, fetcher, fetcherindex, stdout):
+                return False
+        else:  # the current day is not complete yet
+            stdout.readline()
+            stdout.readline()
+        dictionary = {kind: {} for kind in FetcherDictionary.TABLES}
+        self.cur.execute("SAVEPOINT daycounts")
+        result = True
+        checkpoint = None
+        dc = 0  # domain count
+        try:
+            while True:
+                line = stdout.readline(TLSRPT_MAX_READ_FETCHER + 1)
+                if line.rstrip() == b".":  # end of counters reached
+                    break
+                if not line:  # EOF
+                    logger.warning("Unexpected end of day counts")
+                    result = False
+                    break
+                if not line.endswith(b"\n"):
+                    logger.error("Counters of domain %d exceed %d bytes", dc + 1, TLSRPT_MAX_READ_FETCHER)
+                    result = False
+                    break
+                j = json.loads(line)
+                if j[0] == "d":
+                    self.cur.execute("INSERT INTO stagingdata (day, domain, data, fetcherindex, fetcher) "
+                                     "VALUES (?,?,?,?,?) ON CONFLICT(day, domain, fetcherindex) "
+                                     "DO UPDATE SET data=excluded.data, its=CURRENT_TIMESTAMP",
+                                     (day, j[1], json.dumps(self._policies_from_counts(dictionary, j[2])),
+                                      fetcherindex, fetcher))
+                    dc += 1
+                elif j[0] == "c":
+                    checkpoint = j[1]
+                    self.cur.execute("INSERT INTO stagingcheckpoints (day, fetcherindex, fetcher, checkpoint) "
+                                     "VALUES (?,?,?,?) ON CONFLICT(day, fetcherindex) "
+                                     "DO UPDATE SET fetcher=excluded.fetcher, checkpoint=excluded.checkpoint, "
+                                     "its=CURRENT_TIMESTAMP",
+                                     (day, fetcherindex, fetcher, j[1]))
+                elif j[0] == "reset":  # the counters sent replace everything staged before
+                    self.drop_staging(day, fetcherindex)
+                else:  # dictionary entry with consecutive ids
+                    dictionary[j[0]].update(enumerate(j[2], j[1]))
+            if result and checkpoint is None:
+                logger.warning("Fetcher not ready %d %s: no checkpoint for %s", fetcherindex, fetcher, day)
+                result = False
+            if result and final:
+                self.cur.execute("INSERT INTO reportdata "
+                                 "(day, domain, data, fetcherindex, fetcher, retries, status, nexttry) "
+                                 "SELECT day, domain, data, fetcherindex, fetcher, 0, 'fetched', ? FROM stagingdata "
+                                 "WHERE day=? AND fetcherindex=? ON CONFLICT DO NOTHING",
+                                 (tlsrpt_utc_time_now(), day, fetcherindex))
+                self.drop_staging(day, fetcherindex)
+        except Exception as e:
+            logger.error("Unexpected exception: %s", e.__str__())
+            result = False
+
+        if result:
+            logger.info("DB-commit for fetcher %d %s", fetcherindex, fetcher)
+            self.cur.execute("RELEASE SAVEPOINT daycounts")
+            self.con.commit()
+        else:
+            logger.info("DB-rollback for fetcher %d %s", fetcherindex, fetcher)
+            self.cur.execute("ROLLBACK TO SAVEPOINT daycounts")
+            self.con.commit()
+        duration.add(dc)
+        logger.info("Pulling counters of %d changed domains took %s, %s domains per second", dc, duration.time(),
+                    duration.rate())
+        return result
+
+    @staticmethod
+    def _policies_from_counts(dictionary, counts):
+        """
+        Convert the counters of a domain sent with protocol version 2 to the details sent with protocol version 1
+        :param dictionary: the TLSRPT records, policies and failure reasons of the stream by kind and id
+        :param counts: list of TLSRPT record id, policy id, total and failed sessions and a flat list of failure
+                       reason ids and their counters
+        :return: dict of TLSRPT records, policies and their counters
+        """
+        (records, policies, reasons) = (dictionary["r"], dictionary["p"], dictionary["f"])
+        result = {}
+        for (r, p, cntrtotal, cntrfailure, failures) in counts:
+            result.setdefault(records[r], {})[policies[p]] = {
+                "cntrtotal": cntrtotal, "cntrfailure": cntrfailure,
+                "failures": {reasons[f]: cntr for (f, cntr) in zip(failures[0::2], failures[1::2])}}
+        return result
+
+    def select_incomplete_days(self, cursor):
+        """
+        Get days with incomplete fetchjobs from the database
+        :param cursor: the DB cursor to use for the query
+        :return: the row set of incomplete days
+        """
+        # select days that are not fully fetched yet for debug loglevel
+        cursor.execute("SELECT day FROM fetchjobs WHERE status IS NULL")
+        incompletedays = cursor.fetchall()
+        return incompletedays
+
+    def fetch_data(self):
+        """
+        Fetch details for the domains not yet processed
+        """
+        logger.debug("Fetch data")
+        curtofetch = self.con.cursor()
+        incompletedays = self.select_incomplete_days(curtofetch)
+        if len(incompletedays) != 0:
+            logger.debug("The are %d incomplete days: %s", len(incompletedays), incompletedays.__str__())
+
+        # select jobs that are due
+        now = tlsrpt_utc_time_now()
+        curtofetch.execute(
+            "SELECT day, fetcher, fetcherindex, domain FROM reportdata "
+            "WHERE data IS NULL AND nexttry<? AND day NOT IN (SELECT day FROM fetchjobs WHERE status IS NULL)",
+            (now,))
+        for (day, fetcher, fetcherindex, domain) in curtofetch:
+            self.fetch_data_from_fetcher_for_domain(day, fetcher, fetcherindex, domain)
+
+    def fetch_data_from_fetcher_for_domain(self, day, fetcher, fetcherindex, dom):
+        """
+        Fetch details for one domain from one fetcher for a specific day
+        :param day: Day for which to fetch the domain details
+        :type fetcher: The fetcher to run
+        :type fetcherindex: The fetchers index in the configuration
+        :param dom: The domain for which to fetch the details
+        """
+        logger.debug("Fetch data from %d %s for domain %s", fetcherindex, fetcher, dom)
+        try:
+            with self.fetcher_output(fetcherindex, fetcher, ["details", day.__str__(), dom]) as stdout:
+                alldata = stdout.read(TLSRPT_MAX_READ_FETCHER)
+        except OSError as e:
+            logger.error("Error when trying to run fetcher %s: %s", fetcher, e.__str__())
+            return
+        try:
+            j = json.loads(alldata)
+        except json.JSONDecodeError as e:
+            logger.error("Invalid JSON: %s", e.__str__())
+            return
+        gotdom = j.pop("d")
+        if gotdom != dom:
+            logger.error("Domain mismatch! Asked for %s but got reply for %s", dom, gotdom)
+            return
+        data = j.pop("policies")
+        self.curtoupdate.execute("UPDATE reportdata SET data=?, status='fetched' "
+                                 "WHERE day=? AND fetcherindex=? AND domain=?",
+                                 (json.dumps(data), day, fetcherindex, dom))
+        self.con.commit()
+
+    def aggregate_report_from_data(self, r, data):
+        """
+        Aggregate data into report
+        :param r: the report into which to aggregate the data
+        :param data: the data
+        """
+        # spolicy is the whole policy as a string, do not to be confused with the "policy-string" inside it
+        for rawspolicy in data:
+            tmp = data[rawspolicy]
+            cntrtotal = tmp["cntrtotal"]
+            cntrfailure = tmp["cntrfailure"]
+            failures = tmp["failures"]
+            # data from older collectds may contain the same policy serialized in different ways
+            spolicy = canonical_json(json.loads(rawspolicy))
+            if spolicy not in r:
+                r[spolicy] = {"cntrtotal": 0, "cntrfailure": 0, "failures": {}}
+            r[spolicy]["cntrtotal"] += cntrtotal
+            r[spolicy]["cntrfailure"] += cntrfailure
+            for rawfailure in failures:
+                failure = canonical_json(json.loads(rawfailure))
+                if failure not in r[spolicy]["failures"]:
+                    r[spolicy]["failures"][failure] = 0
+                r[spolicy]["failures"][failure] += failures[rawfailure]
+
+    def render_report(self, day, dom, tlsrptrecord, data, report):
+        """
+        Render a report into its final form
+        :param day: Day for which to create the report
         :param dom: Domain for which to create the report
         :param tlsrptrecord: TLSRPT DNS record describing the recipients of the report
         :param data: The data from which to create the report
@@ -1566,6 +3571,9 @@ class TLSRPTReportd(VersionedSQLite):
             self.check_day()
             self.collect_domains()
             self.fetch_data()
+            self.export_intraday()
+            if self.collection_finished():
+                self.close_fetcher_sessions()
             self.create_reports()
             self.send_out_reports()
             dt = self.wakeuptime - tlsrpt_utc_time_now()
@@ -1579,6 +3587,7 @@ class TLSRPTReportd(VersionedSQLite):
                     signumb = interrupt_read.recv(1)
                     signum = ord(signumb)
                     logger.info("Caught signal %d, cleaning up", signum)
+                    self.close_fetcher_sessions()
                     self.con.commit()
                     logger.info("Done")
                     return 0
@@ -1665,35 +3674,924 @@ def remove_datagram_socket(server_address, when):
     except OSError as err:
         logger.error("Failed to remove existing socket %s during %s: %s", server_address, when, err)
 
-def tlsrpt_collectd_daemon(config: ConfigCollectd):
+class ReceiveStatistics:
     """
-    Daemon function for collectd to be run after configuration was setup
+    Counters for the batched receive loop of collectd
+    """
+    def __init__(self):
+        self.total_batches = 0
+        self.total_datagrams = 0
+        self.total_bytes = 0
+        self.max_batch = 0
+        self.batches = 0
+        self.datagrams = 0
+        self.last_log = time.monotonic()
+
+    def add_batch(self, size, nbytes=0):
+        """
+        Account for a batch of datagrams read from the socket
+        :param size: number of datagrams in the batch
+        :param nbytes: total size of the datagrams in the batch
+        """
+        self.total_bytes += nbytes
+        self.batches += 1
+        self.datagrams += size
+        self.total_batches += 1
+        self.total_datagrams += size
+        if size > self.max_batch:
+            self.max_batch = size
+
+    @staticmethod
+    def _average(datagrams, batches):
+        if batches == 0:
+            return 0.0
+        return datagrams / batches
+
+    def log_if_due(self, interval):
+        """
+        Log and reset the counters of the current interval if at least interval seconds have passed
+        :param interval: the logging interval in seconds
+        :return: True if the interval was due
+        """
+        now = time.monotonic()
+        if now - self.last_log < interval:
+            return False
+        self.last_log = now
+        if self.batches != 0:
+            logger.debug("Received %d datagrams in %d batches, average batch size %.1f, maximum %d",
+                         self.datagrams, self.batches, self._average(self.datagrams, self.batches), self.max_batch)
+        self.batches = 0
+        self.datagrams = 0
+        self.max_batch = 0
+        return True
+
+    def log_totals(self):
+        """
+        Log the counters accumulated since startup
+        """
+        logger.info("Received %d datagrams in %d batches, average batch size %.1f", self.total_datagrams,
+                    self.total_batches, self._average(self.total_datagrams, self.total_batches))
+
+
+def receive_datagram_batch(sock, max_datagrams, buffer):
+    """
+    Read datagrams from a non-blocking socket until no more data is available or max_datagrams were read
+    :param sock: the non-blocking socket to read from
+    :param max_datagrams: the maximum number of datagrams to read
+    :param buffer: a preallocated bytearray reused as receive buffer, must be larger than the largest datagram
+    :return: list of the raw datagrams read
+    """
+    batch = []
+    view = memoryview(buffer)
+    while len(batch) < max_datagrams:
+        try:
+            nbytes, ancdata, msg_flags, srcaddress = sock.recvmsg_into([view])
+        except (BlockingIOError, InterruptedError):
+            break
+        if msg_flags & socket.MSG_TRUNC:
+            logger.error("Discarding truncated datagram exceeding the receive buffer size of %d bytes", len(buffer))
+            continue
+        batch.append(bytes(view[:nbytes]))
+    return batch
+
+
+# Socket types collectd can listen on, connection-oriented sockets carry length-prefixed records
+SOCKET_TYPES = ("dgram", "seqpacket", "stream")
+
+
+class RecordStream:
+    """
+    Splits the data received on a connection into records, each prefixed with its length as 32 bit unsigned integer in
+    network byte order
+    """
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, max_record_size):
+        """
+        :param max_record_size: the maximum allowed record length
+        """
+        self.max_record_size = max_record_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received data and extract the records completed by it
+        :param data: the received bytes
+        :return: list of the complete records
+        """
+        self.buffer += data
+        records = []
+        start = 0
+        while len(self.buffer) - start >= self.HEADER.size:
+            (length,) = self.HEADER.unpack_from(self.buffer, start)
+            if length > self.max_record_size:
+                raise ValueError(f"Record length {length} exceeds the maximum of {self.max_record_size} bytes")
+            end = start + self.HEADER.size + length
+            if end > len(self.buffer):
+                break
+            records.append(bytes(self.buffer[start + self.HEADER.size:end]))
+            start = end
+        del self.buffer[:start]
+        return records
+
+    def pending(self):
+        """
+        :return: the number of bytes received of an incomplete record
+        """
+        return len(self.buffer)
+
+
+class InvalidDatagramQuarantine:
+    """
+    Rate-limited quarantine for invalid datagrams.
+    The ingest path only counts invalid datagrams and keeps a limited number of samples per minute in memory.
+    The samples are written to a ring of files by flush, which is called from the main thread.
+    """
+    def __init__(self, path, samples, per_minute):
+        """
+        :param path: the file name to save samples to, empty to only count and log invalid datagrams
+        :param samples: the number of sample files, they are named path.0 to path.(samples-1), or path if it is 1
+        :param per_minute: the maximum number of samples saved and logged per minute
+        """
+        self.path = path
+        self.samples = samples
+        self.per_minute = per_minute
+        self.pending = collections.deque()  # (raw datagram, reason) waiting to be written
+        self.rejected = 0  # total number of invalid datagrams
+        self.sampled = 0  # number of samples taken in the current minute
+        self.next_file = 0
+        self.minute_start = time.monotonic()
+        self.minute_rejected = 0
+
+    def add(self, alldata, reason):
+        """
+        Count an invalid datagram and keep it as sample if the limit for this minute is not yet reached
+        :param alldata: the raw datagram
+        :param reason: description of the problem
+        """
+        self.rejected += 1
+        if self.sampled < self.per_minute:
+            self.sampled += 1
+            self.pending.append((alldata, reason))
+
+    def flush(self):
+        """
+        Log and save the queued samples and log the number of invalid datagrams once per minute
+        """
+        while len(self.pending) != 0:
+            (alldata, reason) = self.pending.popleft()
+            logger.error("%s", reason)
+            if self.path is None or self.path == "" or self.samples < 1:
+                continue
+            filename = self.path
+            if self.samples > 1:
+                filename = "%s.%d" % (self.path, self.next_file)
+                self.next_file = (self.next_file + 1) % self.samples
+            try:
+                Path(filename).write_bytes(alldata)
+            except OSError as err:
+                logger.error("Could not save invalid datagram to %s: %s", filename, err)
+        now = time.monotonic()
+        if now - self.minute_start >= 60:
+            rejected = self.rejected - self.minute_rejected
+            if rejected != 0:
+                logger.warning("Rejected %d invalid datagrams in the last %.0f seconds, %d since start", rejected,
+                               now - self.minute_start, self.rejected)
+            self.minute_start = now
+            self.minute_rejected = self.rejected
+            self.sampled = 0
+
+
+# Locates the domain of a raw datagram without decoding its JSON
+DATAGRAM_DOMAIN_RE = re.compile(rb'"d"\s*:\s*"([^"]*)"')
+
+
+def datagram_shard(alldata, shards):
+    """
+    Select the shard of a sharded collectd responsible for a raw datagram by a hash of its normalized domain.
+    Datagrams without a recognizable domain go to the first shard, which rejects them if they are invalid.
+    :param alldata: the raw datagram
+    :param shards: the number of shards
+    :return: the index of the shard
+    """
+    match = DATAGRAM_DOMAIN_RE.search(alldata)
+    if match is None:
+        return 0
+    domain = normalize_domain_name(match.group(1).decode("utf-8", errors="replace"))
+    return zlib.crc32(domain.encode("utf-8")) % shards
+
+
+def decode_datagram(alldata, quarantine=None):
+    """
+    Decode a raw datagram, invalid datagrams are handed to the quarantine
+    :param alldata: the raw datagram
+    :param quarantine: the InvalidDatagramQuarantine for invalid datagrams
+    :return: the decoded datagram or None if the datagram is invalid
+    """
+    try:
+        return json.loads(alldata)
+    except UnicodeDecodeError as err:
+        reason = "Malformed utf8 data received: " + str(err)
+    except json.decoder.JSONDecodeError as err:
+        reason = "JSON decode error: " + str(err)
+    if quarantine is None:
+        logger.error("%s", reason)
+    else:
+        quarantine.add(alldata, reason)
+    return None
+
+
+QUEUE_OVERFLOW_POLICIES = ("block", "drop")
+
+# Maximum number of seconds between updates of the stats file
+STATS_FILE_INTERVAL = 1
+
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+# Messages of the socket handover between a running and a restarted collectd
+HANDOVER_SOCKET = b"s"
+HANDOVER_SERVICE_SOCKET = b"m"  # the socket belongs to a service manager and must not be removed
+HANDOVER_DONE = b"d"
+
+
+def parse_storage_overflow_policies(config: ConfigCollectd, count):
+    """
+    Determine the overflow policy of the queue of each storage backend
     :param config: the ConfigCollectd for this daemon
-    :return: exitcode to be returned from the process, zero on successful termination
+    :param count: the number of storage backends
+    :return: list of the overflow policies
+    :raises ValueError: if the option storage_overflow_policy is invalid
+    """
+    if config.storage_overflow_policy == "":
+        return [config.queue_overflow_policy] * count
+    policies = [policy.strip() for policy in config.storage_overflow_policy.split(",")]
+    if len(policies) != count:
+        raise ValueError(f"storage_overflow_policy has {len(policies)} entries for {count} storage backends")
+    for policy in policies:
+        if policy not in QUEUE_OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid policy '{policy}' in storage_overflow_policy, must be one of "
+                             f"{', '.join(QUEUE_OVERFLOW_POLICIES)}")
+    return policies
+
+
+class DeltaBatch:
+    """
+    Batch of deltas passed from the parse stage to the writer stage if the datagram cache is used
+    """
+    def __init__(self, deltas, datagrams):
+        """
+        :param deltas: list of tuples of the deltas per storage backend and the number of datagrams causing them
+        :param datagrams: the number of datagrams in this batch
+        """
+        self.deltas = deltas
+        self.datagrams = datagrams
+
+    def __len__(self):
+        return self.datagrams
+
+
+class CollectdPipeline:
+    """
+    Threaded ingest pipeline of collectd.
+    A receive thread drains the socket, a parse thread decodes the datagrams and one writer thread per storage backend
+    hands them to its backend. The stages are connected by bounded queues of batches so a slow database commit does
+    not stop the socket from being read and a slow storage backend does not slow down the others.
+    """
+    STOP = "stop"  # control item to shut down the parse and writer stages
+    ROLLOVER = "rollover"  # control item to enforce a day roll-over in the writer threads
+
+    def __init__(self, sock, collectds, config: ConfigCollectd, record_connection=False):
+        """
+        :param sock: the non-blocking socket to receive datagrams from
+        :param collectds: the storage backends
+        :param config: the ConfigCollectd for this daemon
+        :param record_connection: True if sock is a connection carrying length-prefixed records instead of a socket
+                                  clients send to or connect to
+        """
+        self.sock = sock
+        self.collectds = collectds
+        self.cfg = config
+        self.receive_queue = queue.Queue(maxsize=config.receive_queue_size)
+        # each storage backend has its own writer thread fed by its own queue of (enqueue time, batch)
+        self.write_queues = [queue.Queue(maxsize=config.write_queue_size) for collectd in collectds]
+        self.write_names = ["write-%d" % i for i in range(len(collectds))]
+        self.overflow_policies = {"receive": config.queue_overflow_policy}
+        self.overflow_policies.update(zip(self.write_names, parse_storage_overflow_policies(config, len(collectds))))
+        self.stopping = threading.Event()
+        self.wakeup_read, self.wakeup_write = socket.socketpair()
+        self.receive_stats = ReceiveStatistics()
+        self.quarantine = InvalidDatagramQuarantine(config.dump_path_for_invalid_datagram,
+                                                    config.invalid_datagram_samples,
+                                                    config.invalid_datagram_samples_per_minute)
+        # connection-oriented sockets are listening sockets, their connections carry length-prefixed records
+        self.connected = sock is not None and sock.type != socket.SOCK_DGRAM
+        self.record_connection = record_connection
+        self.max_depth = {name: 0 for name in self.overflow_policies}
+        self.dropped = {name: 0 for name in self.overflow_policies}
+        self.lag = {name: 0.0 for name in self.write_names}  # seconds a batch waited for its writer thread
+        self.max_lag = {name: 0.0 for name in self.write_names}
+        self.stop_queued = [False for collectd in collectds]  # writer threads the parse thread could send STOP to
+        self.exitcode = 0
+        self.stats_file = None  # StatsFile publishing the counters, created in start()
+        # raw datagram -> tuple of deltas per storage backend and whether all backends accepted it without complaint,
+        # only used by the parse thread
+        self.datagram_cache = None
+        # repeated datagrams which failed the checks when first decoded, logged at most once per minute
+        self.flawed_cache_hits = 0
+        self.flawed_cache_hits_logged = 0
+        self.next_flawed_cache_hits_log = time.monotonic()
+        if config.datagram_cache_size > 0:
+            if all(type(c).datagram_delta is not TLSRPTCollectd.datagram_delta for c in collectds):
+                self.datagram_cache = LRUCache(config.datagram_cache_size)
+            else:
+                logger.warning("Datagram cache disabled because not all storage backends support it")
+        self.threads = [threading.Thread(target=self._run, args=(self._receive_loop,), name="collectd-receive"),
+                        threading.Thread(target=self._run, args=(self._parse_loop,), name="collectd-parse")]
+        for (i, name) in enumerate(self.write_names):
+            self.threads.append(threading.Thread(target=self._run, args=(self._write_loop, i),
+                                                 name="collectd-" + name))
+
+    @staticmethod
+    def _run(loop, *args):
+        """
+        Run one of the pipeline loops, logging unexpected exceptions that terminate the thread
+        :param loop: the loop function to run
+        :param args: the arguments of the loop function
+        """
+        try:
+            loop(*args)
+        except Exception as e:
+            logger.error("Exception %s in thread %s: %s", e.__class__.__name__, threading.current_thread().name, e,
+                         exc_info=1)
+
+    def start(self):
+        """
+        Create the stats file if configured and start the pipeline threads
+        """
+        if self.cfg.stats_file != "":
+            try:
+                self.stats_file = StatsFile(self.cfg.stats_file, self.statistics())
+            except (OSError, UnicodeError, StatsFileException) as e:
+                logger.error("Error while creating stats file %s: %s", self.cfg.stats_file, e)
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def is_alive(self):
+        """
+        Check if all pipeline threads are still running
+        :return: True if no pipeline thread has terminated
+        """
+        return all(thread.is_alive() for thread in self.threads)
+
+    def request_rollover(self):
+        """
+        Enforce a day roll-over for development, performed by the writer threads
+        """
+        for (q, name) in zip(self.write_queues, self.write_names):
+            self._put_control(q, name, CollectdPipeline.ROLLOVER, (time.monotonic(), CollectdPipeline.ROLLOVER))
+
+    def _put_control(self, q, name, control, item=None):
+        """
+        Put a control item into a queue. A queue with the drop policy is given at most the socket timeout to make
+        room, so a stalled stage cannot hang the caller.
+        :param q: the queue
+        :param name: the name of the queue for the overflow policy
+        :param control: the control item
+        :param item: the item to put into the queue if it is not the control item itself
+        :return: True if the item was queued
+        """
+        if item is None:
+            item = control
+        if self.overflow_policies[name] != "drop":
+            q.put(item)
+            return True
+        try:
+            q.put(item, timeout=self.cfg.sockettimeout)
+        except queue.Full:
+            logger.error("Queue %s still full after %d seconds, could not queue %s", name, self.cfg.sockettimeout,
+                         control)
+            return False
+        return True
+
+    def _put(self, q, name, batch, item=None):
+        """
+        Put a batch into a queue, applying the configured overflow policy if the queue is full
+        :param q: the queue
+        :param name: the name of the queue for the metrics and the overflow policy
+        :param batch: the batch of datagrams
+        :param item: the item to put into the queue if it is not the batch itself
+        """
+        if item is None:
+            item = batch
+        if self.overflow_policies[name] == "drop":
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                self.dropped[name] += len(batch)
+        else:
+            q.put(item)
+        depth = q.qsize()
+        if depth > self.max_depth[name]:
+            self.max_depth[name] = depth
+
+    def _receive_loop(self):
+        """
+        Receive thread: drain the socket in batches and queue the raw datagrams
+        """
+        sel = DefaultSelector()
+        sel.register(self.wakeup_read, EVENT_READ)
+        sel.register(self.sock, EVENT_READ, RecordStream(TLSRPT_MAX_READ_COLLECTD) if self.record_connection else None)
+        receive_buffer = bytearray(TLSRPT_MAX_READ_COLLECTD)  # allocated once and reused for every datagram
+        while not self.stopping.is_set():
+            for key, _ in sel.select():
+                if key.fileobj == self.sock and key.data is None:
+                    if self.connected:
+                        self._accept_connections(sel)
+                        continue
+                    # drain the socket before handing the whole batch to the next stage
+                    rawbatch = receive_datagram_batch(self.sock, self.cfg.max_datagrams_per_batch, receive_buffer)
+                    self.receive_stats.add_batch(len(rawbatch), sum(map(len, rawbatch)))
+                    if len(rawbatch) != 0:
+                        self._put(self.receive_queue, "receive", rawbatch)
+                elif key.fileobj != self.wakeup_read:
+                    self._receive_records(sel, key.fileobj, key.data, receive_buffer)
+        # process datagrams already waiting in the socket buffer before shutting down
+        if self.connected:
+            if not self.record_connection:
+                self._accept_connections(sel)
+            for key in list(sel.get_map().values()):
+                if key.data is not None:
+                    while self._receive_records(sel, key.fileobj, key.data, receive_buffer):
+                        pass
+                    if key.fileobj.fileno() != -1:  # not yet closed by _receive_records
+                        if key.data.pending() != 0:
+                            logger.error("Discarding an incomplete record of %d bytes during shutdown",
+                                         key.data.pending())
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+        else:
+            while True:
+                rawbatch = receive_datagram_batch(self.sock, self.cfg.max_datagrams_per_batch, receive_buffer)
+                if len(rawbatch) == 0:
+                    break
+                self.receive_stats.add_batch(len(rawbatch), sum(map(len, rawbatch)))
+                self._put(self.receive_queue, "receive", rawbatch)
+        sel.close()
+
+    def _accept_connections(self, sel):
+        """
+        Accept all pending connections on a connection-oriented listening socket
+        :param sel: the selector of the receive loop to register the connections with
+        """
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            conn.setblocking(False)
+            sel.register(conn, EVENT_READ, RecordStream(TLSRPT_MAX_READ_COLLECTD))
+
+    def _receive_records(self, sel, conn, stream, buffer):
+        """
+        Read the length-prefixed records available on a connection and queue them as one batch.
+        The connection is closed when the client closed it or sent invalid data.
+        :param sel: the selector of the receive loop the connection is registered with
+        :param conn: the connection
+        :param stream: the RecordStream of the connection
+        :param buffer: the preallocated receive buffer
+        :return: True if the batch limit was reached and more data might be waiting
+        """
+        view = memoryview(buffer)
+        rawbatch = []
+        close = False
+        while len(rawbatch) < self.cfg.max_datagrams_per_batch:
+            try:
+                nbytes, ancdata, msg_flags, srcaddress = conn.recvmsg_into([view])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as err:
+                logger.error("Error receiving from connection: %s", err)
+                close = True
+                break
+            if nbytes == 0:
+                if stream.pending() != 0:
+                    logger.error("Connection closed with an incomplete record of %d bytes", stream.pending())
+                close = True
+                break
+            if msg_flags & socket.MSG_TRUNC:
+                logger.error("Closing connection after a packet exceeding the receive buffer size of %d bytes",
+                             len(buffer))
+                close = True
+                break
+            try:
+                rawbatch.extend(stream.feed(view[:nbytes]))
+            except ValueError as err:
+                logger.error("Closing connection after invalid data: %s", err)
+                close = True
+                break
+        if close:
+            sel.unregister(conn)
+            conn.close()
+        self.receive_stats.add_batch(len(rawbatch), sum(map(len, rawbatch)))
+        if len(rawbatch) != 0:
+            self._put(self.receive_queue, "receive", rawbatch)
+        return not close and len(rawbatch) >= self.cfg.max_datagrams_per_batch
+
+    def _parse_loop(self):
+        """
+        Parse thread: decode the raw datagrams
+        """
+        while True:
+            rawbatch = self.receive_queue.get()
+            if rawbatch == CollectdPipeline.STOP:
+                for (index, (q, name)) in enumerate(zip(self.write_queues, self.write_names)):
+                    self.stop_queued[index] = self._put_control(q, name, CollectdPipeline.STOP,
+                                                                (time.monotonic(), CollectdPipeline.STOP))
+                return
+            if self.datagram_cache is not None:
+                batch = self._delta_batch(rawbatch)
+            else:
+                batch = []
+                for alldata in rawbatch:
+                    j = decode_datagram(alldata, self.quarantine)
+                    if j is not None:
+                        batch.append(j)
+            if len(batch) != 0:
+                enqueued = time.monotonic()
+                for (q, name) in zip(self.write_queues, self.write_names):
+                    self._put(q, name, batch, (enqueued, batch))
+
+    def _delta_batch(self, rawbatch):
+        """
+        Turn raw datagrams into deltas, decoding only datagrams not found in the datagram cache.
+        The raw bytes themselves are the cache key, so datagrams differing in a single byte are decoded separately.
+        :param rawbatch: list of raw datagrams
+        :return: DeltaBatch with identical datagrams of this batch combined
+        """
+        counts = {}
+        datagrams = 0
+        for alldata in rawbatch:
+            cached = self.datagram_cache.get(alldata)
+            if cached is None:
+                cached = self._datagram_deltas(alldata)
+                if cached is None:
+                    continue
+                self.datagram_cache.put(alldata, cached)
+            elif not cached[1]:
+                self._log_flawed_cache_hit(alldata)
+            deltas = cached[0]
+            counted = counts.get(alldata)
+            if counted is None:
+                counts[alldata] = [deltas, 1]
+            else:
+                counted[1] += 1
+            datagrams += 1
+        return DeltaBatch(list(counts.values()), datagrams)
+
+    def _datagram_deltas(self, alldata):
+        """
+        Decode a raw datagram and compute its deltas for all storage backends
+        :param alldata: the raw datagram
+        :return: tuple of the tuple of the deltas per storage backend and whether the datagram passed the checks of all
+                 storage backends, or None if the datagram is invalid
+        """
+        j = decode_datagram(alldata, self.quarantine)
+        if j is None:
+            return None
+        try:
+            checked = [collectd.checked_datagram_delta(j) for collectd in self.collectds]
+        except (KeyError, ValueError) as err:
+            logger.error("%s %s during processing datagram: %s", err.__class__.__name__, str(err), json.dumps(j))
+            return None
+        return tuple(delta for (delta, ok) in checked), all(ok for (delta, ok) in checked)
+
+    def _log_flawed_cache_hit(self, alldata):
+        """
+        Count a repeated datagram taken from the datagram cache which failed the checks when it was first decoded,
+        logging it at most once per minute
+        :param alldata: the raw datagram
+        """
+        self.flawed_cache_hits += 1
+        now = time.monotonic()
+        if now < self.next_flawed_cache_hits_log:
+            return
+        logger.error("Counted %d repeated datagrams failing the checks logged when first received, latest: %s",
+                     self.flawed_cache_hits - self.flawed_cache_hits_logged, alldata.decode(errors="replace"))
+        self.flawed_cache_hits_logged = self.flawed_cache_hits
+        self.next_flawed_cache_hits_log = now + 60
+
+    def _write_loop(self, index):
+        """
+        Writer thread of one storage backend: the only thread calling into this backend
+        :param index: the index of the storage backend
+        """
+        collectd = self.collectds[index]
+        q = self.write_queues[index]
+        name = self.write_names[index]
+        while True:
+            try:
+                # wake up for the day roll-over in time even if no datagrams arrive
+                timeout = self.cfg.sockettimeout
+                until_rollover = collectd.seconds_until_rollover()
+                if until_rollover is not None:
+                    timeout = min(timeout, until_rollover)
+                try:
+                    (enqueued, batch) = q.get(timeout=timeout)
+                except queue.Empty:
+                    collectd.socket_timeout()
+                    continue
+                lag = time.monotonic() - enqueued
+                self.lag[name] = lag
+                if lag > self.max_lag[name]:
+                    self.max_lag[name] = lag
+                if batch == CollectdPipeline.STOP:
+                    self._shutdown_collectd(collectd)
+                    return
+                if batch == CollectdPipeline.ROLLOVER:
+                    collectd.switch_to_next_day(RolloverReason.MANUALLYINDUCED)
+                    continue
+                if isinstance(batch, DeltaBatch):
+                    collectd.add_deltas([(deltas[index], n) for (deltas, n) in batch.deltas])
+                else:
+                    collectd.add_datagrams(batch)
+            except sqlite3.OperationalError as err:
+                logger.error("Database error: %s", str(err))
+
+    def _shutdown_collectd(self, collectd):
+        """
+        Trigger a final socket timeout on a storage backend to commit pending data
+        :param collectd: the storage backend
+        """
+        logger.info("Triggering socket timeout on collectd")
+        try:
+            collectd.socket_timeout()
+            collectd.close()
+        except Exception as e:  # catch all exceptions to avoid interrupting shutdown
+            logger.error("Exception %s during shutdown: %s", e.__class__.__name__, e)
+            self.exitcode = EXIT_SHUTDOWN_COLLECTDPLUGIN
+
+    def stop(self):
+        """
+        Stop receiving, then drain the queues and let the writer thread commit all pending data
+        :return: the exit code of the writer stage
+        """
+        self.stopping.set()
+        self.wakeup_write.send(b"x")
+        self.threads[0].join()
+        if self._put_control(self.receive_queue, "receive", CollectdPipeline.STOP):
+            self.threads[1].join()
+        for (name, thread, queued) in zip(self.write_names, self.threads[2:], self.stop_queued):
+            if queued:
+                thread.join()
+            else:
+                logger.error("Abandoning the stalled writer thread %s and its pending data", name)
+                self.exitcode = EXIT_SHUTDOWN_COLLECTDPLUGIN
+        self.wakeup_read.close()
+        self.wakeup_write.close()
+        self.receive_stats.log_totals()
+        self.log_queue_statistics()
+        self.quarantine.flush()
+        if self.quarantine.rejected != 0:
+            logger.warning("Rejected %d invalid datagrams since start", self.quarantine.rejected)
+        if self.stats_file is not None:
+            self.stats_file.close()
+        return self.exitcode
+
+    def log_queue_statistics(self):
+        """
+        Log the current and maximum queue depths and the number of dropped datagrams
+        """
+        logger.debug("Queue depth receive %d of %d (maximum %d)", self.receive_queue.qsize(),
+                     self.cfg.receive_queue_size, self.max_depth["receive"])
+        for (q, name) in zip(self.write_queues, self.write_names):
+            logger.debug("Queue depth %s %d of %d (maximum %d), lag %.3f seconds (maximum %.3f seconds)", name,
+                         q.qsize(), self.cfg.write_queue_size, self.max_depth[name], self.lag[name],
+                         self.max_lag[name])
+        if any(dropped != 0 for dropped in self.dropped.values()):
+            logger.warning("Dropped datagrams due to full queues: %s",
+                           ", ".join("%d before %s" % (dropped, name) for (name, dropped) in self.dropped.items()))
+        if self.datagram_cache is not None:
+            logger.debug("Datagram cache %d hits %d misses %d of %d entries used", self.datagram_cache.hits,
+                         self.datagram_cache.misses, len(self.datagram_cache), self.datagram_cache.maxsize)
+
+    def statistics(self):
+        """
+        Collect the counters of the pipeline and of its storage backends, the latter prefixed with storage_<index>_
+        :return: dict of counter names and values, always with the same keys
+        """
+        counters = {"datagrams": self.receive_stats.total_datagrams, "bytes": self.receive_stats.total_bytes,
+                    "batches": self.receive_stats.total_batches, "parse_errors": self.quarantine.rejected,
+                    "queue_depth_receive": self.receive_queue.qsize(), "dropped_receive": self.dropped["receive"]}
+        for (i, (collectd, q, name)) in enumerate(zip(self.collectds, self.write_queues, self.write_names)):
+            counters["queue_depth_" + name] = q.qsize()
+            counters["dropped_" + name] = self.dropped[name]
+            counters["lag_us_" + name] = int(self.lag[name] * 1000000)
+            for (key, value) in collectd.statistics().items():
+                counters["storage_%d_%s" % (i, key)] = value
+        return counters
+
+    def log_statistics_if_due(self):
+        """
+        Publish the counters in the stats file, log the receive and queue statistics once per sockettimeout and save
+        the samples of invalid datagrams
+        """
+        if self.stats_file is not None:
+            self.stats_file.update(self.statistics())
+        self.quarantine.flush()
+        if self.receive_stats.log_if_due(self.cfg.sockettimeout):
+            self.log_queue_statistics()
+
+
+def make_shard_config(config: ConfigCollectd, index):
+    """
+    Create the configuration of a worker process of a sharded collectd.
+    The paths of the storage URLs, the stats file and the samples of invalid datagrams get a suffix per shard.
+    :param config: the ConfigCollectd of the sharded collectd
+    :param index: the index of the shard
+    :return: the ConfigCollectd of the worker process
+    """
+    urls = []
+    for url in config.storage.split(","):
+        (base, separator, query) = url.partition("?")
+        if urllib.parse.urlparse(base).path != "":  # the path is the end of the URL before the query string
+            url = make_shard_name(base, index) + separator + query
+        urls.append(url)
+    replacements = {"storage": ",".join(urls), "shards": 1}
+    for option in ("stats_file", "dump_path_for_invalid_datagram"):
+        if getattr(config, option) != "":
+            replacements[option] = make_shard_name(getattr(config, option), index)
+    return config._replace(**replacements)
+
+
+class ShardingPipeline(CollectdPipeline):
+    """
+    Ingest pipeline of the receiving process of a sharded collectd.
+    Instead of parsing the datagrams its parse thread routes them by domain to worker processes. Each worker process
+    runs its own CollectdPipeline writing its own shard of the storage, so parsing and writing scale with the cores.
+    The datagrams are forwarded as length-prefixed records over a stream connection, so datagrams of any size accepted
+    by this process reach the worker processes.
+    The worker processes ignore the signals handled by this process and shut down when their control connection is
+    closed, so they still receive all datagrams accepted by this process before it shuts down.
+    """
+    ROLLOVER = b"r"  # control message to enforce a day roll-over in the worker processes
+
+    def __init__(self, sock, config: ConfigCollectd):
+        """
+        :param sock: the non-blocking socket to receive datagrams from
+        :param config: the ConfigCollectd for this daemon
+        """
+        super().__init__(sock, [], config._replace(datagram_cache_size=0, storage_overflow_policy=""))
+        self.routed = [0] * config.shards  # number of datagrams per shard
+        self.shard_sockets = []  # sending ends of the record connections to the worker processes
+        self.controls = []  # control connections to the worker processes
+        self.workers = []
+        self.worker_ends = []  # ends of the connections handed over to the worker processes
+        context = multiprocessing.get_context("spawn")  # workers must not inherit the connections of other workers
+        for index in range(config.shards):
+            (shard_socket, worker_socket) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            (control, worker_control) = socket.socketpair()
+            self.shard_sockets.append(shard_socket)
+            self.controls.append(control)
+            self.worker_ends += [worker_socket, worker_control]
+            self.workers.append(context.Process(target=collectd_shard_worker, name="collectd-shard-%d" % index,
+                                                args=(make_shard_config(config, index), worker_socket,
+                                                      worker_control)))
+
+    def start(self):
+        """
+        Start the worker processes and the pipeline threads
+        """
+        for worker in self.workers:
+            worker.start()
+        for worker_end in self.worker_ends:
+            worker_end.close()
+        super().start()
+
+    def is_alive(self):
+        return super().is_alive() and all(worker.is_alive() for worker in self.workers)
+
+    def request_rollover(self):
+        for control in self.controls:
+            control.send(ShardingPipeline.ROLLOVER)
+
+    def _parse_loop(self):
+        """
+        Routing thread: forward the raw datagrams to the worker processes, blocking while a worker falls behind
+        """
+        while True:
+            rawbatch = self.receive_queue.get()
+            if rawbatch == CollectdPipeline.STOP:
+                return
+            for alldata in rawbatch:
+                shard = datagram_shard(alldata, len(self.shard_sockets))
+                try:
+                    self.shard_sockets[shard].sendall(RecordStream.HEADER.pack(len(alldata)) + alldata)
+                    self.routed[shard] += 1
+                except OSError as err:
+                    logger.error("Error forwarding datagram of %d bytes to shard %d: %s", len(alldata), shard, err)
+
+    def statistics(self):
+        counters = super().statistics()
+        for (index, routed) in enumerate(self.routed):
+            counters["datagrams_shard_%d" % index] = routed
+        return counters
+
+    def stop(self):
+        """
+        Stop receiving and forwarding, then let the worker processes process all forwarded datagrams and shut down
+        :return: the exit code of the pipeline and the worker processes
+        """
+        exitcode = super().stop()
+        for control in self.controls:
+            control.close()
+        for (index, worker) in enumerate(self.workers):
+            worker.join()
+            if worker.exitcode != 0:
+                logger.error("Worker process of shard %d terminated with exit code %s", index, worker.exitcode)
+                exitcode = EXIT_OTHER if worker.exitcode is None or worker.exitcode < 0 else worker.exitcode
+        for shard_socket in self.shard_sockets:
+            shard_socket.close()
+        logger.info("Forwarded datagrams per shard: %s", ", ".join(str(routed) for routed in self.routed))
+        return exitcode
+
+
+# Signals handled by the receiving process of a sharded collectd, or sent to the whole process group, which the worker
+# processes ignore because the receiving process shuts them down or rolls them over via their control connections
+SHARD_WORKER_IGNORED_SIGNALS = ("SIGINT", "SIGTERM", "SIGUSR2", "SIGHUP")
+
+
+def collectd_shard_worker(config: ConfigCollectd, sock, control):
+    """
+    Main function of a worker process of a sharded collectd, see ShardingPipeline
+    :param config: the ConfigCollectd of this shard as created by make_shard_config
+    :param sock: the connection the receiving process forwards the datagrams of this shard to
+    :param control: the control connection to the receiving process
+    """
+    for signame in SHARD_WORKER_IGNORED_SIGNALS:
+        if hasattr(signal, signame):  # not all signals exist on all platforms
+            signal.signal(getattr(signal, signame), signal.SIG_IGN)
+    setup_logging(config.logfilename, config.log_level, "tlsrpt_collectd " + multiprocessing.current_process().name)
+    sock.setblocking(False)
+    collectds = []
+    try:
+        for r in config.storage.split(","):
+            if r != "":
+                collectds.append(TLSRPTCollectd.factory(r, config))
+    except Exception as e:
+        logger.error("Exception %s while setting up storage %s: %s", e.__class__.__name__, config.storage, e)
+        sys.exit(EXIT_DB_SETUP_FAILURE)
+    pipeline = CollectdPipeline(sock, collectds, config, record_connection=True)
+    pipeline.start()
+    sel = DefaultSelector()
+    sel.register(control, EVENT_READ)
+    timeout = config.sockettimeout
+    if config.stats_file != "":
+        timeout = min(timeout, STATS_FILE_INTERVAL)
+    exitcode = None
+    while exitcode is None:
+        for key, _ in sel.select(timeout=timeout):
+            message = control.recv(1)
+            if message == ShardingPipeline.ROLLOVER:
+                pipeline.request_rollover()
+            elif message == b"":  # the receiving process shuts down
+                exitcode = pipeline.stop()
+        if exitcode is None and not pipeline.is_alive():
+            logger.error("Collectd pipeline thread terminated unexpectedly")
+            exitcode = EXIT_OTHER
+        pipeline.log_statistics_if_due()
+    sock.close()
+    sys.exit(exitcode)
+
+
+def create_collectd_socket(config: ConfigCollectd):
+    """
+    Create and bind the unix domain socket collectd listens on and adjust its owner and permissions
+    :param config: the ConfigCollectd for this daemon
+    :return: the socket or None if it could not be created
     """
     server_address = config.socketname
-    logger.info("TLSRPT collectd starting")
     # Make sure the socket does not already exist
     remove_datagram_socket(server_address, "startup")
 
     # Create a Unix Domain Socket
     try:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock = socket.socket(socket.AF_UNIX, getattr(socket, "SOCK_" + config.socket_type.upper()))
     except Exception as e:
         logger.error("Error %s while creating socket: %s", e.__class__.__name__, e)
-        return EXIT_SOCKET
+        return None
 
     # Bind the socket to the port
-    if server_address is None or server_address == "":
-        logger.error("No collectd_socketname configured")
-        return EXIT_USAGE
-    logger.info("Listening on socket '%s'", server_address)
+    logger.info("Listening on %s socket '%s'", config.socket_type, server_address)
     try:
         sock.bind(server_address)
-        sock.setblocking(False)
+        if config.socket_type != "dgram":
+            sock.listen()
     except Exception as e:
         logger.error("Error %s while binding socket: %s", e.__class__.__name__, e)
-        return EXIT_SOCKET
+        sock.close()
+        return None
 
     # adjust socket user/group
     kwargs = {}
@@ -1718,78 +4616,378 @@ def tlsrpt_collectd_daemon(config: ConfigCollectd):
             os.chmod(path=server_address, mode=mode)
     except Exception as e:
         logger.error("Could not chmod socket %s to mode %s: %s", server_address, config.socketmode, e)
+    return sock
 
-    # Multiple collectds to be set-up from configuration
-    collectds = []
-    for r in config.storage.split(","):
-        if r != "":
-            collectds.append(TLSRPTCollectd.factory(r, config))
-    if len(collectds) == 0:
+
+def socket_from_listen_fds():
+    """
+    Use the socket passed by a service manager like systemd via socket activation, see sd_listen_fds(3)
+    :return: the first socket passed or None if no socket was passed to this process
+    """
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    count = os.environ.get("LISTEN_FDS", "0")
+    # the sockets are meant for this process only, not for worker processes or hook scripts
+    for variable in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(variable, None)
+    if not count.isdigit() or int(count) < 1:
+        return None
+    if int(count) > 1:
+        logger.warning("Using the first of %s sockets passed by the service manager", count)
+    sock = socket.socket(fileno=SD_LISTEN_FDS_START)
+    sock.set_inheritable(False)
+    return sock
+
+
+def listen_for_handover(path):
+    """
+    Listen for a restarted collectd asking to take over the socket
+    :param path: the name of the unix domain socket for the handover
+    :return: the listening socket or None if it could not be created
+    """
+    remove_datagram_socket(path, "startup")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(1)
+    except OSError as e:
+        logger.error("Error %s while creating handover socket %s: %s", e.__class__.__name__, path, e)
+        listener.close()
+        return None
+    return listener
+
+
+def take_over_socket(path, timeout):
+    """
+    Take over the listening socket of a running collectd and wait until it committed its data
+    :param path: the name of the unix domain socket for the handover
+    :param timeout: maximum number of seconds to wait for the running collectd
+    :return: tuple of the listening socket or None if no collectd is running and whether to remove the socket
+    :raises OSError: if the running collectd did not hand over its socket or did not finish in time
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.info("No running collectd to take over the socket from at %s", path)
+            return None, True
+        conn.settimeout(timeout)
+        fds = array.array("i")
+        (msg, ancdata, flags, address) = conn.recvmsg(1, socket.CMSG_LEN(fds.itemsize))
+        for (level, kind, data) in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        if msg not in (HANDOVER_SOCKET, HANDOVER_SERVICE_SOCKET) or len(fds) != 1:
+            for fd in fds:
+                os.close(fd)
+            raise OSError(f"Invalid handover message from the running collectd at {path}")
+        sock = socket.socket(fileno=fds[0])
+        # datagrams queue up in the socket buffer until the running collectd finished its commits
+        logger.info("Took over the socket, waiting for the running collectd to commit its data")
+        begin = time.monotonic()
+        try:
+            conn.recv(1)  # HANDOVER_DONE or EOF if the running collectd terminated
+        except socket.timeout:
+            sock.close()
+            raise OSError(f"Running collectd did not commit its data within {timeout} seconds")
+        logger.info("Running collectd finished after %.3f seconds", time.monotonic() - begin)
+        return sock, msg == HANDOVER_SOCKET
+    finally:
+        conn.close()
+
+
+def collectd_handover(pipeline: CollectdPipeline, sock, listener, remove_socket=True):
+    """
+    Hand the listening socket over to a restarted collectd, then stop receiving and commit the pending data
+    :param pipeline: the running ingest pipeline
+    :param sock: the listening socket
+    :param listener: the socket listening for the handover
+    :param remove_socket: False to pass on that the unix domain socket belongs to a service manager
+    :return: exitcode to be returned from the process or None if the socket was not handed over
+    """
+    message = HANDOVER_SOCKET if remove_socket else HANDOVER_SERVICE_SOCKET
+    try:
+        (conn, address) = listener.accept()
+        conn.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [sock.fileno()]))])
+    except OSError as e:
+        logger.error("Error %s while handing over the socket: %s", e.__class__.__name__, e)
+        return None
+    logger.info("Handed over the socket to a restarted collectd, committing pending data")
+    listener.close()  # the restarted collectd binds the handover socket again
+    exitcode = pipeline.stop()
+    sock.close()  # neither remove the unix domain socket nor the handover socket, both belong to the new collectd
+    try:
+        conn.sendall(HANDOVER_DONE)
+    except OSError as e:
+        logger.warning("Error %s while confirming the handover: %s", e.__class__.__name__, e)
+    conn.close()
+    logger.info("Done")
+    return exitcode
+
+
+def tlsrpt_collectd_daemon(config: ConfigCollectd):
+    """
+    Daemon function for collectd to be run after configuration was setup
+    :param config: the ConfigCollectd for this daemon
+    :return: exitcode to be returned from the process, zero on successful termination
+    """
+    server_address = config.socketname
+    logger.info("TLSRPT collectd starting")
+
+    if config.socket_type not in SOCKET_TYPES:
+        logger.error("Invalid socket_type '%s', must be one of %s", config.socket_type, ", ".join(SOCKET_TYPES))
+        return EXIT_USAGE
+    if server_address is None or server_address == "":
+        logger.error("No collectd_socketname configured")
+        return EXIT_USAGE
+
+    urls = [r for r in config.storage.split(",") if r != ""]
+    if len(urls) == 0:
         logger.error("No collectd storage configured")
         return EXIT_USAGE
+    if config.shards < 1:
+        logger.error("Invalid number of shards %d, must be at least 1", config.shards)
+        return EXIT_USAGE
+    if not check_storage_sqlite_pragmas(urls):
+        return EXIT_USAGE
+
+    if config.max_datagrams_per_batch < 1:
+        logger.error("Invalid max_datagrams_per_batch %d, must be at least 1", config.max_datagrams_per_batch)
+        return EXIT_USAGE
+
+    if config.queue_overflow_policy not in QUEUE_OVERFLOW_POLICIES:
+        logger.error("Invalid queue_overflow_policy '%s', must be one of %s", config.queue_overflow_policy,
+                     ", ".join(QUEUE_OVERFLOW_POLICIES))
+        return EXIT_USAGE
+    try:
+        parse_storage_overflow_policies(config, len(urls))
+    except ValueError as e:
+        logger.error("%s", e)
+        return EXIT_USAGE
+    if config.policy_cache_size < 0 or config.datagram_cache_size < 0:
+        logger.error("Invalid cache sizes %d and %d, must not be negative", config.policy_cache_size,
+                     config.datagram_cache_size)
+        return EXIT_USAGE
+    if config.receive_queue_size < 1 or config.write_queue_size < 1:
+        logger.error("Invalid queue sizes %d and %d, must be at least 1", config.receive_queue_size,
+                     config.write_queue_size)
+        return EXIT_USAGE
 
+    # Use the socket of a service manager or of a running collectd if there is one, create it otherwise
+    remove_socket = True
+    try:
+        sock = socket_from_listen_fds()
+        if sock is not None:
+            logger.info("Using socket passed by the service manager")
+            remove_socket = False  # the service manager keeps the socket across restarts
+        elif config.handover_socket != "":
+            (sock, remove_socket) = take_over_socket(config.handover_socket, config.handover_timeout)
+    except OSError as e:
+        logger.error("Error %s while taking over the socket: %s", e.__class__.__name__, e)
+        return EXIT_SOCKET
+    if sock is None:
+        sock = create_collectd_socket(config)
+        if sock is None:
+            return EXIT_SOCKET
+    elif sock.family != socket.AF_UNIX or sock.type != getattr(socket, "SOCK_" + config.socket_type.upper()):
+        logger.error("Socket taken over is not a unix domain socket of socket_type %s", config.socket_type)
+        return EXIT_SOCKET
+    sock.setblocking(False)
+
+    if config.shards == 1:
+        # Multiple collectds to be set-up from configuration
+        collectds = [TLSRPTCollectd.factory(r, config) for r in urls]
+        pipeline = CollectdPipeline(sock, collectds, config)
+    else:
+        logger.info("Distributing datagrams to %d worker processes", config.shards)
+        pipeline = ShardingPipeline(sock, config)
+    pipeline.start()
     sel = DefaultSelector()
     sel.register(interrupt_read, EVENT_READ)
-    sel.register(sock, EVENT_READ)
+    handover_listener = None
+    if config.handover_socket != "":
+        handover_listener = listen_for_handover(config.handover_socket)
+        if handover_listener is not None:
+            sel.register(handover_listener, EVENT_READ)
+    timeout = config.sockettimeout
+    if config.stats_file != "":
+        timeout = min(timeout, STATS_FILE_INTERVAL)
     while True:
-        alldata = None  # clear old data to prevent accidentally processing it twice
-        try:
-            # Uncomment to test very low throughput
-            # time.sleep(1)
+        for key, _ in sel.select(timeout=timeout):
+            if key.fileobj == interrupt_read:
+                signumb = interrupt_read.recv(1)
+                signum = ord(signumb)
+                if signum == signal.SIGUSR2:
+                    logger.info("Caught signal %d, enforce debug day roll-over for development", signum)
+                    pipeline.request_rollover()
+                else:
+                    logger.info("Caught signal %d, cleaning up", signum)
+                    if handover_listener is not None:
+                        handover_listener.close()
+                        remove_datagram_socket(config.handover_socket, "shutdown")
+                    return collectd_shutdown(pipeline, sock, server_address, remove_socket)
+            elif key.fileobj == handover_listener:
+                exitcode = collectd_handover(pipeline, sock, handover_listener, remove_socket)
+                if exitcode is not None:
+                    return exitcode
+        if not pipeline.is_alive():
+            # a graceful shutdown is not possible without all stages, just stop listening
+            logger.error("Collectd pipeline thread terminated unexpectedly")
+            sock.close()
+            if remove_socket:
+                remove_datagram_socket(server_address, "shutdown")
+            return EXIT_OTHER
+        pipeline.log_statistics_if_due()
+
+
+def collectd_shutdown(pipeline: CollectdPipeline, sock, server_address, remove_socket=True):
+    """
+    Shut down collectd: stop receiving, remove the socket and commit the pending data
+    :param pipeline: the running ingest pipeline
+    :param sock: the listening socket
+    :param server_address: the name of the unix domain socket
+    :param remove_socket: False to keep the unix domain socket of a service manager
+    :return: exitcode to be returned from the process, zero on successful shutdown
+    """
+    exitcode = 0
+    pipelineexitcode = pipeline.stop()
+    try:
+        sock.close()
+        if remove_socket:
+            remove_datagram_socket(server_address, "shutdown")
+    except Exception as e:  # catch all exceptions to avoid interrupting shutdown
+        logger.error("Exception %s during shutdown: %s", e.__class__.__name__, e)
+        exitcode = EXIT_SHUTDOWN_SOCKETCLOSE
+    if pipelineexitcode != 0:
+        exitcode = pipelineexitcode
+    logger.info("Done")
+    return exitcode
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    Writable stream framing the reply of a fetcher session into chunks, each preceded by a line with its length.
+    A chunk of length zero terminates the reply.
+    """
+    def __init__(self, output):
+        """
+        :param output: the binary stream to write the chunks to
+        """
+        self.output = output
 
-            had_data = 0
-            for key, _ in sel.select(timeout=config.sockettimeout):
-                if key.fileobj == interrupt_read:
-                    signumb = interrupt_read.recv(1)
-                    signum = ord(signumb)
-                    if signum == signal.SIGUSR2:
-                        logger.info("Caught signal %d, enforce debug day roll-over for development", signum)
-                        for collectd in collectds:
-                            collectd.switch_to_next_day(RolloverReason.MANUALLYINDUCED)
-                    else:
-                        logger.info("Caught signal %d, cleaning up", signum)
-                        exitcode = 0
-                        try:
-                            sock.close()
-                            remove_datagram_socket(server_address, "shutdown")
-                        except Exception as e:  # catch all exceptions to avoid interrupting shutdown
-                            logger.error("Exception %s during shutdown: %s", e.__class__.__name__, e)
-                            exitcode = EXIT_SHUTDOWN_SOCKETCLOSE
-                        for collectd in collectds:
-                            logger.info("Triggering socket timeout on collectd")
-                            try:
-                                collectd.socket_timeout()
-                            except Exception as e:  # catch all exceptions to avoid interrupting shutdown
-                                logger.error("Exception %s during shutdown: %s", e.__class__.__name__, e)
-                                exitcode = EXIT_SHUTDOWN_COLLECTDPLUGIN
-                        logger.info("Done")
-                        return exitcode
-                if key.fileobj == sock:
-                    had_data += 1
-                    alldata, srcaddress = sock.recvfrom(TLSRPT_MAX_READ_COLLECTD)
-                    j = json.loads(alldata)
-                    for collectd in collectds:
-                        try:
-                            collectd.add_datagram(j)
-                        except KeyError as err:
-                            logger.error("KeyError %s during processing datagram: %s", str(err), json.dumps(j))
-            if had_data == 0:
-                for collectd in collectds:
-                    collectd.socket_timeout()
-        except socket.timeout:
-            for collectd in collectds:
-                collectd.socket_timeout()
-        except OSError as err:
-            logger.error("OS-Error: %s", str(err))
-            raise
-        except UnicodeDecodeError as err:
-            logger.error("Malformed utf8 data received: %s", str(err))
-            Path(config.dump_path_for_invalid_datagram).write_bytes(alldata)
-        except json.decoder.JSONDecodeError as err:
-            logger.error("JSON decode error: %s", str(err))
-            Path(config.dump_path_for_invalid_datagram).write_text(alldata.decode("utf-8"), encoding="utf-8")
-        except sqlite3.OperationalError as err:
-            logger.error("Database error: %s", str(err))
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if len(b) != 0:
+            self.output.write(b"%d\n" % len(b))
+            self.output.write(b)
+        return len(b)
+
+    def end_reply(self):
+        """
+        Terminate the current reply
+        """
+        self.output.write(b"0\n")
+        self.output.flush()
+
+
+class ZlibWriter(io.RawIOBase):
+    """
+    Writable stream compressing the output of a fetcher with zlib
+    """
+    def __init__(self, output):
+        """
+        :param output: the binary stream to write the compressed data to
+        """
+        self.output = output
+        self.compressor = zlib.compressobj()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.output.write(self.compressor.compress(b))
+        return len(b)
+
+    def finish(self):
+        """
+        Write the end of the compressed data
+        """
+        self.output.write(self.compressor.flush())
+
+
+@contextlib.contextmanager
+def fetcher_stdout(output, compression):
+    """
+    Redirect what the fetcher prints to a binary stream, compressed if requested.
+    Compressed output is preceded by a header line naming the compression.
+    :param output: the binary stream to write to
+    :param compression: the compression to use, empty for uncompressed output
+    """
+    compressor = None
+    if compression != "":
+        output.write((TLSRPT_FETCHER_COMPRESSION_STRINGS[compression] + "\n").encode("utf-8"))
+        compressor = ZlibWriter(output)
+        output = io.BufferedWriter(compressor, 65536)
+    text = io.TextIOWrapper(output, encoding="utf-8", newline="\n")
+    try:
+        with contextlib.redirect_stdout(text):
+            yield
+    finally:
+        text.detach()  # flushes, but keeps the stream open
+        if compressor is not None:
+            output.flush()
+            compressor.finish()
+
+
+def tlsrpt_fetcher_session(fetcher: TLSRPTFetcher, requests, output, compression="", protocol=1):
+    """
+    Answer requests of a reportd, one request per line, until the end of the requests or a "quit" request.
+    The requests are "list DAY", "details DAY DOMAIN", "bulk DAY" and, with protocol version 2, "incremental DAY
+    CHECKPOINT", the replies are framed by ChunkWriter and contain what the fetcher prints when run with the same
+    parameters on the command line.
+    :param fetcher: the fetcher answering the requests
+    :param requests: the binary stream to read the requests from
+    :param output: the binary stream to write the replies to
+    :param compression: the compression of the replies, empty for uncompressed replies
+    :param protocol: the protocol version of the replies to bulk requests
+    """
+    logger.info("TLSRPT fetcher session starting")
+    output.write((TLSRPT_FETCHER_SESSION_STRING + "\n").encode("utf-8"))
+    output.flush()
+    writer = ChunkWriter(output)
+    replies = io.BufferedWriter(writer, 65536)
+    count = 0
+    for line in requests:
+        request = line.decode("utf-8").split()
+        if len(request) == 0:
+            continue
+        if request == ["quit"]:
+            break
+        count += 1
+        try:
+            fetcher.refresh()
+            with fetcher_stdout(replies, compression):
+                if request[0] == "list" and len(request) == 2:
+                    fetcher.fetch_domain_list(request[1])
+                elif request[0] == "details" and len(request) == 3:
+                    fetcher.fetch_domain_details(request[1], request[2])
+                elif request[0] == "bulk" and len(request) == 2 and protocol == 2:
+                    fetcher.fetch_day_counts(request[1])
+                elif request[0] == "incremental" and len(request) == 3 and protocol == 2:
+                    fetcher.fetch_day_counts(request[1], request[2])
+                elif request[0] == "bulk" and len(request) == 2:
+                    fetcher.fetch_day_details(request[1])
+                else:
+                    logger.error("Invalid request %s", request)
+        except Exception as e:  # the incomplete reply makes reportd retry
+            logger.error("Exception %s during request %s: %s", e.__class__.__name__, request, e)
+        replies.flush()
+        writer.end_reply()
+    logger.info("TLSRPT fetcher session finished after %d requests", count)
 
 
 def tlsrpt_fetcher_main():
@@ -1815,23 +5013,54 @@ def tlsrpt_fetcher_main():
     url = urls.pop(0)
     for ignored_url in urls:
         logger.warning("Ignoring additional storage: %s", ignored_url)
+    if not check_storage_sqlite_pragmas([url]):
+        sys.exit(EXIT_USAGE)
     try:
         fetcher = TLSRPTFetcher.factory(url, config)
     except Exception as e:
         logger.error("Can not create fetcher from storage URL '%s': %s", url, str(e))
         sys.exit(EXIT_USAGE)
-    if len(params["day"]) != 1:
-        logger.error("Expected exactly one argument for parameter 'day' but got %s", len(params["day"]))
+    if config.compression != "" and config.compression not in TLSRPT_FETCHER_COMPRESSION_STRINGS:
+        logger.error("Unsupported compression: %s", config.compression)
+        sys.exit(EXIT_USAGE)
+    if config.protocol not in (1, 2):
+        logger.error("Unsupported protocol version: %d", config.protocol)
+        sys.exit(EXIT_USAGE)
+    if config.since != "" and (config.protocol != 2 or not config.bulk):
+        logger.error("Option since requires bulk mode with protocol version 2")
         sys.exit(EXIT_USAGE)
-    day = params["day"][0]
+    day = params["day"]
+    if config.session:
+        if day is not None:
+            logger.error("Session mode reads the days from the requests, but got day %s", day)
+            sys.exit(EXIT_USAGE)
+        tlsrpt_fetcher_session(fetcher, sys.stdin.buffer, sys.stdout.buffer, config.compression, config.protocol)
+        return
     if day is None or day == "":
         logger.error("Invalid value for parameter 'day': '%s'", day)
         sys.exit(EXIT_USAGE)
     domain = params["domain"]
-    if domain is None:
-        fetcher.fetch_domain_list(day)
+    if config.bulk and domain is not None:
+        logger.error("Bulk mode fetches all domains, but got domain %s", domain)
+        sys.exit(EXIT_USAGE)
+    if config.compression == "":
+        output = contextlib.nullcontext()  # print directly to stdout
     else:
-        fetcher.fetch_domain_details(day, domain)
+        output = fetcher_stdout(sys.stdout.buffer, config.compression)
+    with output:
+        if config.bulk:
+            try:
+                if config.protocol == 2:
+                    fetcher.fetch_day_counts(day, None if config.since == "" else config.since)
+                else:
+                    fetcher.fetch_day_details(day)
+            except (NotImplementedError, ValueError) as e:
+                logger.error("%s", e)
+                sys.exit(EXIT_USAGE)
+        elif domain is None:
+            fetcher.fetch_domain_list(day)
+        else:
+            fetcher.fetch_domain_details(day, domain)
 
 
 def tlsrpt_reportd_main():
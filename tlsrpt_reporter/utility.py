@@ -17,7 +17,9 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
 import datetime
+import json
 
 
 def remove_prefix(s:str, prefix:str):
@@ -82,6 +84,15 @@ def normalize_domain_name(domain: str):
         domain = domain[:-1]
     return domain
 
+def canonical_json(value):
+    """
+    Serialize a value to its canonical JSON form: keys sorted and no optional whitespace.
+    Equal values always result in the same string regardless of the order of their keys.
+    :param value: the value to serialize, e.g. a policy or a failure detail
+    :return: the canonical JSON string
+    """
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
 def extract_domain_from_email_address(email: str):
     '''
     Extract the domain part from an email address
@@ -104,6 +115,34 @@ def make_yesterday_dbname(dbname):
     return dbname+".yesterday"
 
 
+def make_next_dbname(dbname):
+    """
+    Create name for the empty database prepared for the next day
+    :param dbname: name of todays database
+    :return: name of the next day's database
+    """
+    return dbname+".next"
+
+
+def make_shard_name(name, index):
+    """
+    Create name for the file of one shard of a sharded collectd, e.g. its database
+    :param name: name of the file of an unsharded collectd
+    :param index: the index of the shard, starting at 0
+    :return: name of the file of the shard
+    """
+    return name+".shard"+str(index)
+
+
+def make_journal_name(dbname):
+    """
+    Create name for the journal of a database
+    :param dbname: name of todays database
+    :return: name of the journal
+    """
+    return dbname+".journal"
+
+
 def tlsrpt_report_start_datetime(day):
     """
     Return start time of report for a specific day.
@@ -157,6 +196,16 @@ def tlsrpt_utc_date_now():
     return tlsrpt_utc_time_now().date()
 
 
+def tlsrpt_utc_seconds_until_day_end(day):
+    """
+    Returns the number of seconds until a UTC day ends.
+    :param day: the date of the day
+    :return: seconds until the following UTC midnight, negative if it already passed
+    """
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(), datetime.timezone.utc)
+    return (end - tlsrpt_utc_time_now()).total_seconds()
+
+
 def tlsrpt_utc_date_yesterday():
     """
     Returns the date of yesterday in UTC.
@@ -171,9 +220,9 @@ class Duration:
     Time duration and rate measurement class
     """
     def __init__(self):
-        self.start()
         self.count = 0
         self.begin = None
+        self.start()
 
     def start(self):
         self.begin = datetime.datetime.now(datetime.timezone.utc)
@@ -188,3 +237,46 @@ class Duration:
 
     def rate(self):
         return self.count / self.time().total_seconds()
+
+
+class LRUCache:
+    """
+    Bounded mapping discarding the least recently used entries, counting hits and misses
+    """
+    def __init__(self, maxsize):
+        """
+        :param maxsize: maximum number of entries, 0 disables caching
+        """
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Look up a key and mark it as recently used
+        :param key: the key to look up
+        :return: the cached value or None
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        Add an entry, discarding the least recently used entry if the cache is full
+        :param key: the key
+        :param value: the value, must not be None
+        """
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Micro-benchmark comparing the per-datagram cost of the collectd receive paths:
+# recvfrom() with a 16 MiB maximum size versus recvmsg_into() with a preallocated buffer.
+# Usage: python3 recv_buffer.py [number of datagrams]
+
+import json
+import socket
+import sys
+import time
+
+from tlsrpt_reporter.tlsrpt import TLSRPT_MAX_READ_COLLECTD, receive_datagram_batch
+
+DATAGRAM = json.dumps({"dpv": "1", "d": "example.com", "pr": "v=TLSRPTv1;rua=mailto:tlsrpt@example.com",
+                       "policies": [{"policy-type": 2, "policy-string": ["mx.example.com"],
+                                     "policy-domain": "example.com", "f": 0, "t": 0}]}).encode()
+BATCH = 100
+
+
+def recv_old(sock, n):
+    for i in range(n):
+        alldata, srcaddress = sock.recvfrom(TLSRPT_MAX_READ_COLLECTD)
+
+
+def recv_new(sock, n):
+    buffer = bytearray(TLSRPT_MAX_READ_COLLECTD)
+    received = 0
+    while received < n:
+        received += len(receive_datagram_batch(sock, n - received, buffer))
+
+
+def measure(name, recvfunc, count):
+    sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.setblocking(False)
+    elapsed = 0.0
+    for start in range(0, count, BATCH):
+        n = min(BATCH, count - start)
+        for i in range(n):
+            sender.send(DATAGRAM)
+        begin = time.perf_counter()
+        recvfunc(receiver, n)
+        elapsed += time.perf_counter() - begin
+    sender.close()
+    receiver.close()
+    print("%-40s %8.2f us per datagram, %10.0f datagrams per second" % (name, elapsed / count * 1e6, count / elapsed))
+
+
+def main():
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    print("Receiving %d datagrams of %d bytes" % (count, len(DATAGRAM)))
+    measure("recvfrom with 16 MiB size (before)", recv_old, count)
+    measure("recvmsg_into preallocated buffer (after)", recv_new, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Benchmark of the SQLite collectd storage with the available SQLite profiles.
+# Measures commits per second with one datagram per commit and datagrams per second with the default commit interval.
+# Usage: python3 sqlite_profiles.py [directory for the test databases] [number of datagrams]
+
+import os
+import sys
+import tempfile
+import time
+
+from tlsrpt_reporter.tlsrpt import ConfigCollectd, SQLITE_PRAGMA_PROFILES, TLSRPTCollectdSQLite, options_collectd
+
+DOMAINS = 1000
+BATCH = 100
+
+
+def make_datagram(i):
+    domain = "example%d.com" % (i % DOMAINS)
+    policy = {"policy-type": 2, "policy-string": ["mx." + domain], "policy-domain": domain, "f": i % 2, "t": i % 2}
+    if i % 2:
+        policy["failure-details"] = [{"c": 202, "n": "mx." + domain}]
+    return {"dpv": "1", "d": domain, "pr": "v=TLSRPTv1;rua=mailto:tlsrpt@" + domain, "policies": [policy]}
+
+
+def make_collectd(directory, profile):
+    configvars = {k: v["default"] for k, v in options_collectd.items()}
+    configvars["sockettimeout"] = 3600  # commit only after max_uncommited_datagrams
+    dbname = os.path.join(directory, "bench-%s.sqlite" % profile)
+    for suffix in ("", "-wal", "-shm", ".yesterday", ".yesterday-wal", ".yesterday-shm", ".next"):
+        if os.path.exists(dbname + suffix):
+            os.remove(dbname + suffix)
+    return TLSRPTCollectdSQLite("sqlite://" + dbname + "?profile=" + profile, ConfigCollectd(**configvars))
+
+
+def bench_commits(collectd, count):
+    begin = time.perf_counter()
+    for i in range(count):
+        collectd.add_datagram(make_datagram(i))
+        collectd.timed_commit()
+    return count / (time.perf_counter() - begin)
+
+
+def bench_datagrams(collectd, count):
+    begin = time.perf_counter()
+    for start in range(0, count, BATCH):
+        collectd.add_datagrams([make_datagram(i) for i in range(start, min(start + BATCH, count))])
+    collectd.timed_commit()
+    return count / (time.perf_counter() - begin)
+
+
+def main():
+    directory = tempfile.gettempdir()
+    count = 100000
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    print("Databases in %s, %d datagrams for %d domains" % (directory, count, DOMAINS))
+    for profile in SQLITE_PRAGMA_PROFILES:
+        collectd = make_collectd(directory, profile)
+        commits = bench_commits(collectd, max(count // 100, 100))
+        datagrams = bench_datagrams(collectd, count)
+        collectd.close()
+        print("%-16s %10.0f commits per second %10.0f datagrams per second" % (profile, commits, datagrams))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Print the live counters a tlsrpt-collectd publishes in its stats file, see the collectd option "stats_file".
+# With --json the counters are printed as one JSON object, e.g. for monitoring systems.
+# Usage: python3 collectd_stats.py [--json] statsfile
+
+import json
+import sys
+
+from tlsrpt_reporter.statsfile import read_stats_file, StatsFileException
+
+
+def main():
+    args = sys.argv[1:]
+    as_json = len(args) != 0 and args[0] == "--json"
+    if as_json:
+        args = args[1:]
+    if len(args) != 1:
+        print("Usage: %s [--json] statsfile" % sys.argv[0], file=sys.stderr)
+        return 2
+    try:
+        counters = read_stats_file(args[0])
+    except (OSError, StatsFileException) as e:
+        print("%s: %s" % (args[0], e), file=sys.stderr)
+        return 1
+    if as_json:
+        print(json.dumps(counters))
+    else:
+        width = max((len(name) for name in counters), default=0)
+        for (name, value) in counters.items():
+            print("%-*s %d" % (width, name, value))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
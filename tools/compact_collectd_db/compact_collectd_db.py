@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#
+#    Copyright (C) 2024-2026 sys4 AG
+#    Author Boris Lohner bl@sys4.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+
+# One-off tool to merge rows of collectd databases written before policies and failure details were stored in
+# canonical JSON form. Rows describing the same policy with keys in a different order are merged into one row.
+# Run it only on databases not currently written by a tlsrpt-collectd, e.g. on collectd.sqlite.yesterday or while
+# the tlsrpt-collectd is stopped.
+# Usage: python3 compact_collectd_db.py database [database ...]
+
+import sys
+
+from tlsrpt_reporter.tlsrpt import VersionedSQLiteCollectdBase
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: %s database [database ...]" % sys.argv[0], file=sys.stderr)
+        return 2
+    for dbname in sys.argv[1:]:
+        db = VersionedSQLiteCollectdBase(dbname)
+        if not db._check_database():  # also migrates older database versions
+            print("%s: not a collectd database" % dbname, file=sys.stderr)
+            return 1
+        (before, after) = db.compact()
+        db.con.close()
+        reduction = 0.0
+        if before != 0:
+            reduction = 100.0 * (before - after) / before
+        print("%s: %d counter rows before, %d after compaction (%.1f%% less)" % (dbname, before, after, reduction))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())